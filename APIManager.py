@@ -1,17 +1,10 @@
-import requests
-import logging
-import os
-from dotenv import load_dotenv
-from S3Manager import build_s3_filename
-from config import HUBLINK_ENDPOINT
+import sqlite3
+from S3Manager import ScanPlan, files_in_inventory
+from DBManager import get_secret_url, get_gateway_id, get_replaced_files
+from EventLog import event_log
+from config import HUBLINK_ENDPOINT, LEASE_ENDPOINT, LEASE_SECONDS
 
-# Load environment variables from the .env file if it exists
-load_dotenv()
-
-# Configuration
-SECRET_URL = os.getenv('SECRET_URL')
-
-def filter_needed_files(id, file_list, max_file_size):
+def filter_needed_files(id, file_list, max_file_size, plan=None):
     """
     Filters out files that are not needed by checking against the Hublink API.
 
@@ -19,64 +12,129 @@ def filter_needed_files(id, file_list, max_file_size):
         id (str): The account ID or identifier.
         file_list (list): A list of tuples, each containing (filename, size).
         max_file_size (int): Maximum file size allowed.
+        plan (ScanPlan): The scan's key plan; keys are checked in the time bucket they will be uploaded to.
 
     Returns:
         list: A filtered list containing only files that are needed.
     """
+    import requests
+
     # Debugging: Log input data
-    print(f"filter_needed_files called with id: {id}, file_list: {file_list}, max_file_size: {max_file_size}")
+    event_log.debug('api.filter', "filter_needed_files called", id=id, file_list=file_list, max_file_size=max_file_size)
     
-    # Prepare the list of filenames for the API request, passing through build_s3_filename
+    if plan is None:
+        plan = ScanPlan('adhoc')
+
+    # CSVs uploaded only as their columnar copy never appear in S3 under their own name
+    replaced = get_replaced_files(id)
+    file_list = [file for file in file_list if file not in replaced]
+
+    # Prepare the list of filenames for the API request, keyed the way the upload will name them
+    sized_list = [file for file in file_list if file[1] <= max_file_size]
+    keys = plan.keys(id, [file[0] for file in sized_list])
     filenames_and_sizes = [
-        {"filename": build_s3_filename(id, file[0]), "size": file[1]}
-        for file in file_list if file[1] <= max_file_size
+        {"filename": key, "size": file[1]}
+        for key, file in zip(keys, sized_list)
     ]
 
     if not filenames_and_sizes:
-        print("No files left after filtering by size.")
+        event_log.info('api.filter', "No files left after filtering by size.")
         return []
 
     try:
         # Send request to the Hublink API to check which files are needed
         response = requests.post(
-            f"{HUBLINK_ENDPOINT}/{SECRET_URL}/files",
+            f"{HUBLINK_ENDPOINT}/{get_secret_url()}/files",
             json={"files": filenames_and_sizes},
-            headers={"Authorization": f"Bearer {SECRET_URL}", "Content-Type": "application/json"},
+            headers={"Authorization": f"Bearer {get_secret_url()}", "Content-Type": "application/json"},
             timeout=5  # Short timeout to handle network issues
         )
         
         # Debugging: Check response status
-        print(f"API response status: {response.status_code}")
+        event_log.debug('api.filter', "API response", status=response.status_code)
         response.raise_for_status()
 
         # Extract the result from the API response
         data = response.json()
 
         # Debugging: Check response content
-        print(f"API response data: {data}")
+        event_log.debug('api.filter', "API response data", data=data)
 
         # Extract the 'exists' field
         needed_files = data.get("exists")
 
         if needed_files is None:
-            print("Warning: 'exists' key missing in response data.")
+            event_log.warning('api.filter', "Warning: 'exists' key missing in response data.")
             return file_list
 
         # Debugging: Log filtered files based on API response
-        print(f"Files needed according to API: {needed_files}")
+        event_log.debug('api.filter', "Files needed according to API", exists=needed_files)
 
         # Filter the file list based on the response
-        filtered_file_list = [file_list[i] for i in range(len(filenames_and_sizes)) if not needed_files[i]]
+        filtered_file_list = [sized_list[i] for i in range(len(filenames_and_sizes)) if not needed_files[i]]
 
         # Debugging: Final filtered file list
-        print(f"Filtered file list: {filtered_file_list}")
+        event_log.info('api.filter', f"{len(filtered_file_list)} of {len(file_list)} files needed.", id=id)
 
         return filtered_file_list
 
     except (requests.exceptions.RequestException, ValueError) as e:
         # Debugging: Log error
-        print(f"Error contacting Hublink API: {e}")
-        logging.error(f"Error contacting Hublink API: {e}")
+        event_log.error('api.filter', f"Error contacting Hublink API: {e}")
+        return filter_with_inventory(id, file_list, max_file_size)
+
+def filter_with_inventory(id, file_list, max_file_size):
+    """Filters out files the local S3 inventory mirror already holds, for when the Hublink API is unavailable."""
+    sized_list = [file for file in file_list if file[1] <= max_file_size]
+    try:
+        uploaded = files_in_inventory(id, sized_list)
+    except sqlite3.Error as e:
+        event_log.error('api.filter', f"Error reading local S3 inventory: {e}")
         # If there's an error, assume all files are needed
         return file_list
+    event_log.info('api.filter', f"Filtered {len(uploaded)} files already in the local S3 inventory.")
+    return [file for i, file in enumerate(sized_list) if i not in uploaded]
+
+
+def claim_lease(mac_address, ttl=LEASE_SECONDS):
+    """Claims, or renews, this gateway's lease on a device for ttl seconds.
+
+    Returns True if this gateway holds the lease. If the lease API can't be
+    reached the claim is treated as granted, so a lone gateway keeps syncing
+    while offline.
+    """
+    import requests
+
+    try:
+        response = requests.post(
+            f"{LEASE_ENDPOINT}/{get_secret_url()}/leases",
+            json={"device": mac_address, "gateway": get_gateway_id(), "ttl": ttl},
+            headers={"Authorization": f"Bearer {get_secret_url()}", "Content-Type": "application/json"},
+            timeout=5
+        )
+        response.raise_for_status()
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        event_log.warning('api.lease', f"Error contacting lease API, connecting without a lease: {e}")
+        return True
 
+    if not data.get("granted"):
+        event_log.info('api.lease', f"{mac_address} is leased by {data.get('holder')}.", mac_address=mac_address, holder=data.get('holder'))
+        return False
+    return True
+
+def release_lease(mac_address, hold=0):
+    """Releases this gateway's lease on a device, keeping it for hold more seconds if given."""
+    import requests
+
+    try:
+        response = requests.post(
+            f"{LEASE_ENDPOINT}/{get_secret_url()}/leases/release",
+            json={"device": mac_address, "gateway": get_gateway_id(), "hold": hold},
+            headers={"Authorization": f"Bearer {get_secret_url()}", "Content-Type": "application/json"},
+            timeout=5
+        )
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        # The lease expires on its own
+        event_log.warning('api.lease', f"Error releasing lease on {mac_address}: {e}")
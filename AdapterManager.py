@@ -0,0 +1,234 @@
+import asyncio
+from bleak import BleakScanner, BleakClient
+from config import BLE_ADAPTERS, MAX_CONNECTIONS_PER_ADAPTER, ADAPTER_LOAD_PENALTY_DB
+from EventLog import event_log
+
+class Adapter:
+    """A BLE controller with its own scanner, connection slots and metrics."""
+
+    def __init__(self, name, max_connections=MAX_CONNECTIONS_PER_ADAPTER):
+        self.name = name
+        self.max_connections = max_connections
+        self.slots = None  # Created lazily so the semaphore binds to the running loop
+        self.scanner = None
+        self.metrics = {
+            'devices_seen': 0,
+            'devices_assigned': 0,
+            'connections_attempted': 0,
+            'connections_succeeded': 0,
+            'connections_failed': 0,
+            'leases_denied': 0,
+            'active_connections': 0,
+            'bytes_received': 0,
+            'transfer_seconds': 0.0,
+        }
+
+    def get_slots(self):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_connections)
+        return self.slots
+
+class ServiceCache:
+    """Tracks devices whose GATT database bleak has cached and that database's characteristic handles.
+
+    A device is only reconnected from cache after a full discovery on an earlier
+    connection succeeded in subscribing; any failure to subscribe with cached
+    services invalidates the entry so the next connection rediscovers.
+    """
+
+    def __init__(self):
+        self.handles = {}
+        self.latencies = {'cold': [], 'cached': []}
+        self.metrics = {'hits': 0, 'misses': 0, 'invalidations': 0, 'database_changes': 0}
+
+    def is_cached(self, mac_address):
+        return mac_address in self.handles
+
+    def lookup(self, mac_address):
+        cached = self.is_cached(mac_address)
+        self.metrics['hits' if cached else 'misses'] += 1
+        return cached
+
+    def store(self, mac_address, client, uuids):
+        """Records the handles of the given characteristics as resolved on a working connection."""
+        services = getattr(client, 'services', None)
+        handles = {}
+        for uuid in uuids:
+            characteristic = services.get_characteristic(uuid) if services is not None else None
+            handles[uuid] = characteristic.handle if characteristic is not None else None
+        previous = self.handles.get(mac_address)
+        if previous is not None and previous != handles:
+            self.metrics['database_changes'] += 1
+        self.handles[mac_address] = handles
+
+    def invalidate(self, mac_address):
+        if self.handles.pop(mac_address, None) is not None:
+            self.metrics['invalidations'] += 1
+
+    def record_latency(self, cached, seconds):
+        """Records connect-to-first-byte latency, keeping the most recent 100 samples of each kind."""
+        samples = self.latencies['cached' if cached else 'cold']
+        samples.append(seconds)
+        del samples[:-100]
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        for kind, samples in self.latencies.items():
+            metrics[f'{kind}_first_byte_ms'] = 1000 * sum(samples) / len(samples) if samples else None
+        metrics['devices_cached'] = len(self.handles)
+        return metrics
+
+class BleakAdapterBackend:
+    """Discovers and connects through BlueZ adapters via bleak."""
+
+    def create_scanner(self, adapter):
+        return BleakScanner(adapter=adapter.name)
+
+    async def discover(self, adapter, timeout):
+        """Returns {address: (name, rssi)} for devices heard on the adapter."""
+        if adapter.scanner is None:
+            adapter.scanner = self.create_scanner(adapter)
+        await adapter.scanner.start()
+        try:
+            await asyncio.sleep(timeout)
+        finally:
+            await adapter.scanner.stop()
+        return {
+            address: (device.name, advertisement.rssi)
+            for address, (device, advertisement) in adapter.scanner.discovered_devices_and_advertisement_data.items()
+        }
+
+    async def connect(self, adapter, mac_address, services, use_cache):
+        """Connects with service discovery limited to the given services.
+
+        With use_cache, bleak reuses the services it resolved on a previous
+        connection instead of waiting for BlueZ to resolve them again.
+        """
+        client = BleakClient(mac_address, adapter=adapter.name, services=services)
+        await client.connect(dangerous_use_bleak_cache=use_cache)
+        return client
+
+class FakeClient:
+    """Stands in for BleakClient: connects instantly and reports an empty file listing."""
+
+    def __init__(self, backend, adapter, mac_address):
+        self.backend = backend
+        self.adapter = adapter
+        self.address = mac_address
+        self.is_connected = False
+        self.mtu_size = 23
+        self.handlers = {}
+        self.services = None
+
+    async def connect(self, **kwargs):
+        self.is_connected = True
+        self.backend.connections.append((self.adapter.name, self.address))
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def start_notify(self, characteristic, callback):
+        self.handlers[characteristic] = callback
+        # Subscribing to the filename characteristic triggers the listing; the fake device has no files
+        if len(self.handlers) == 2:
+            await callback(characteristic, b"EOF")
+
+    async def stop_notify(self, characteristic):
+        self.handlers.pop(characteristic, None)
+
+    async def write_gatt_char(self, characteristic, data):
+        self.backend.writes.append((self.adapter.name, self.address, bytes(data)))
+
+class FakeAdapterBackend:
+    """Backend without radios for exercising discovery and assignment.
+
+    sightings maps adapter name to {address: (name, rssi)}; connections and
+    control writes made through fake clients are recorded for inspection.
+    """
+
+    def __init__(self, sightings):
+        self.sightings = sightings
+        self.connections = []
+        self.writes = []
+
+    async def discover(self, adapter, timeout):
+        return dict(self.sightings.get(adapter.name, {}))
+
+    async def connect(self, adapter, mac_address, services, use_cache):
+        client = FakeClient(self, adapter, mac_address)
+        await client.connect(dangerous_use_bleak_cache=use_cache)
+        return client
+
+class AdapterPool:
+    """Shards discovery and connections across every configured adapter."""
+
+    def __init__(self, adapter_names=None, backend=None):
+        self.adapters = [Adapter(name) for name in (adapter_names or BLE_ADAPTERS)]
+        self.backend = backend or BleakAdapterBackend()
+        self.service_cache = ServiceCache()
+
+    async def discover(self, timeout=5):
+        """Discovers on all adapters concurrently.
+
+        Returns {address: {'name': name, 'rssi': {adapter_name: rssi}}} merging what each adapter heard.
+        """
+        results = await asyncio.gather(
+            *(self.backend.discover(adapter, timeout) for adapter in self.adapters),
+            return_exceptions=True
+        )
+        sightings = {}
+        for adapter, result in zip(self.adapters, results):
+            if isinstance(result, Exception):
+                event_log.error('ble.scan', f"Discovery failed on {adapter.name}: {result}")
+                continue
+            adapter.metrics['devices_seen'] = len(result)
+            for address, (name, rssi) in result.items():
+                sighting = sightings.setdefault(address, {'name': name, 'rssi': {}})
+                sighting['name'] = sighting['name'] or name
+                sighting['rssi'][adapter.name] = rssi
+        return sightings
+
+    def assign(self, mac_addresses, sightings):
+        """Assigns devices, in priority order, to the adapter with the best load-penalized RSSI.
+
+        Returns {adapter: [mac_address, ...]} preserving the given order within each adapter.
+        """
+        assignments = {adapter: [] for adapter in self.adapters}
+        for mac_address in mac_addresses:
+            heard_by = sightings.get(mac_address, {}).get('rssi', {})
+            candidates = [adapter for adapter in self.adapters if adapter.name in heard_by]
+            if not candidates:
+                continue
+            best = max(
+                candidates,
+                key=lambda adapter: heard_by[adapter.name]
+                - ADAPTER_LOAD_PENALTY_DB * len(assignments[adapter]) / adapter.max_connections
+            )
+            assignments[best].append(mac_address)
+        for adapter, assigned in assignments.items():
+            adapter.metrics['devices_assigned'] = len(assigned)
+        return assignments
+
+    async def connect(self, adapter, mac_address, services):
+        """Connects through the adapter, skipping service discovery when the device's services are cached.
+
+        Returns (client, used_cache). If connecting with cached services fails
+        the entry is invalidated and the connection retried once with discovery,
+        so a stale cache can't fail every later attempt.
+        """
+        use_cache = self.service_cache.lookup(mac_address)
+        try:
+            client = await self.backend.connect(adapter, mac_address, services, use_cache)
+        except Exception as e:
+            if not use_cache:
+                raise
+            event_log.warning('ble.connect', f"Connecting to {mac_address} with cached services failed ({e}); retrying with discovery.",
+                              mac_address=mac_address, adapter=adapter.name)
+            self.service_cache.invalidate(mac_address)
+            use_cache = False
+            client = await self.backend.connect(adapter, mac_address, services, use_cache)
+        return client, use_cache
+
+    def get_metrics(self):
+        return {adapter.name: dict(adapter.metrics) for adapter in self.adapters}
@@ -1,14 +1,55 @@
 import os
+import json
+import hashlib
 import sqlite3
-import requests
-from config import DATABASE_FILE, DATETIME_FORMAT, HUBLINK_ENDPOINT, VALID_DT_RULES
+import threading
+import time
+from config import DATABASE_FILE, GATEWAY_ID, GATEWAY_ID_FILE, DATETIME_FORMAT, HUBLINK_ENDPOINT, VALID_DT_RULES, HISTORY_RETENTION_DAYS, UPLOAD_QUEUE_MAX_ATTEMPTS
 from datetime import datetime
-from dotenv import load_dotenv
+from EventLog import event_log
 
-# Load environment variables from the .env file if it exists
-load_dotenv()
+# Heavy or rarely needed modules (requests, dotenv) are imported where they are
+# used so one-shot runs can start scanning without loading them.
+secret_url = None
+gateway_id = None
 
-SECRET_URL = os.getenv('SECRET_URL')
+def get_secret_url():
+    """Returns SECRET_URL, loading the .env file on first use if it exists."""
+    global secret_url
+    if secret_url is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+        secret_url = os.getenv('SECRET_URL')
+    return secret_url
+
+def get_gateway_id():
+    """Returns GATEWAY_ID, or this gateway's persisted random ID, generating it on first use."""
+    global gateway_id
+    if gateway_id is None:
+        gateway_id = GATEWAY_ID
+    if gateway_id is None:
+        try:
+            with open(GATEWAY_ID_FILE) as f:
+                gateway_id = f.read().strip() or None
+        except FileNotFoundError:
+            pass
+    if gateway_id is None:
+        import uuid
+        gateway_id = str(uuid.uuid4())
+        os.makedirs(os.path.dirname(GATEWAY_ID_FILE), exist_ok=True)
+        partial_path = GATEWAY_ID_FILE + '.part'
+        with open(partial_path, 'w') as f:
+            f.write(gateway_id + '\n')
+        os.replace(partial_path, GATEWAY_ID_FILE)
+        event_log.info('api.lease', f"Generated gateway ID {gateway_id}.", gateway=gateway_id)
+    return gateway_id
+
+# In-process copy of the settings row, kept current by fetch_and_store_settings so
+# readers don't have to query SQLite, plus the validators of the last fetch
+settings_cache = None
+settings_validators = {'etag': None, 'last_modified': None, 'content_hash': None}
+settings_subscribers = []
+settings_lock = threading.Lock()
 
 def updateMAC(macAddresses):
     """Finds or creates mac_address entries, updating the updated_at column."""
@@ -49,17 +90,56 @@ def sortRecentMAC(macAddressList):
     # Combine the lists: MAC addresses not in the database first, then sorted existing MAC addresses
     return not_in_db + sorted_existing_mac_addresses
 
-def fetch_and_store_settings():
-    """Fetches JSON data and stores it in the settings table."""
-    url = f"{HUBLINK_ENDPOINT}/{SECRET_URL}.json"
+def subscribe_settings(callback):
+    """Registers callback(settings, changed_keys) to be called whenever fetched settings change."""
+    settings_subscribers.append(callback)
+
+def publish_settings(previous, settings):
+    changed_keys = {key for key in settings if previous.get(key) != settings.get(key)}
+    if not changed_keys:
+        return
+    event_log.info('settings', f"Settings changed: {', '.join(sorted(changed_keys))}", changed_keys=sorted(changed_keys))
+    for callback in settings_subscribers:
+        try:
+            callback(settings, changed_keys)
+        except Exception as e:
+            event_log.error('settings', f"Error notifying settings subscriber: {e}")
+
+def fetch_and_store_settings(force=False):
+    """Fetches JSON data and stores it in the settings table if it changed.
+
+    The request is conditional on the ETag/Last-Modified of the previous fetch,
+    and a response whose content hash matches the previous one skips the DB
+    write. Changes are published to subscribe_settings() callbacks. Returns True
+    if the stored settings changed.
+    """
+    import requests
+
+    url = f"{HUBLINK_ENDPOINT}/{get_secret_url()}.json"
+    headers = {}
+    if not force:
+        if settings_validators['etag']:
+            headers['If-None-Match'] = settings_validators['etag']
+        if settings_validators['last_modified']:
+            headers['If-Modified-Since'] = settings_validators['last_modified']
     try:
-        response = requests.get(url, timeout=5)
+        response = requests.get(url, headers=headers, timeout=5)
+        if response.status_code == 304:
+            event_log.debug('settings', "Settings unchanged.")
+            return False
         response.raise_for_status()
         data = response.json()
-        print("API fetch successful.")
-    except requests.RequestException as e:
-        print(f"Error fetching data from {url}: {e}")
-        return
+        event_log.debug('settings', "API fetch successful.")
+    except (requests.RequestException, ValueError) as e:
+        event_log.error('settings', f"Error fetching data from {url}: {e}")
+        return False
+
+    settings_validators['etag'] = response.headers.get('ETag')
+    settings_validators['last_modified'] = response.headers.get('Last-Modified')
+    content_hash = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    if content_hash == settings_validators['content_hash'] and not force:
+        event_log.debug('settings', "Settings unchanged.")
+        return False
 
     # Establish connection to the database
     conn = sqlite3.connect(DATABASE_FILE)
@@ -108,9 +188,39 @@ def fetch_and_store_settings():
     # Commit and close the connection
     conn.commit()
     conn.close()
+    settings_validators['content_hash'] = content_hash
+
+    global settings_cache
+    with settings_lock:
+        previous = settings_cache or {}
+        settings_cache = load_settings()
+        settings = dict(settings_cache)
+    publish_settings(previous, settings)
+    return True
 
 def get_settings(option_key=None):
-    """Retrieves settings from the database and returns them as a dictionary or a specific value if option_key is provided."""
+    """Retrieves settings and returns them as a dictionary or a specific value if option_key is provided.
+
+    Settings are read from the database once and then served from memory;
+    fetch_and_store_settings keeps the in-memory copy current.
+    """
+    global settings_cache
+    with settings_lock:
+        if settings_cache is None:
+            settings_cache = load_settings()
+        settings = dict(settings_cache)
+
+    if not settings:
+        return None if option_key else {}
+
+    # Return specific setting if option_key is provided
+    if option_key:
+        return settings.get(option_key)
+
+    return settings
+
+def load_settings():
+    """Reads the settings row from the database, returning {} if there is none."""
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     
@@ -144,15 +254,9 @@ def get_settings(option_key=None):
         }
 
         # Apply defaults and overrides
-        settings = apply_defaults_and_overrides(settings)
-        
-        # Return specific setting if option_key is provided
-        if option_key:
-            return settings.get(option_key)
-        
-        return settings
+        return apply_defaults_and_overrides(settings)
 
-    return None if option_key else {}
+    return {}
 
 def apply_defaults_and_overrides(settings):
     """Applies default values and overrides to the given settings dictionary."""
@@ -181,4 +285,475 @@ def apply_defaults_and_overrides(settings):
 
     # implement business/sanitation
     
-    return settings
\ No newline at end of file
+    return settings
+
+def get_link_params(macAddress):
+    """Returns the negotiated link parameters stored for a MAC address, or None if none are stored."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT mtu_size, payload_size, bytes_received, transfer_seconds
+        FROM link_parameters
+        WHERE mac_address = ?
+    ''', (macAddress,))
+    row = cursor.fetchone()
+    conn.close()
+
+    if row is None or row[0] is None or row[1] is None:
+        return None
+
+    return {
+        'mtu_size': int(row[0]),
+        'payload_size': int(row[1]),
+        'bytes_received': int(row[2]),
+        'transfer_seconds': float(row[3])
+    }
+
+def store_link_params(macAddress, mtu_size, payload_size):
+    """Stores the negotiated MTU and usable payload size for a MAC address."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    updated_at = datetime.now().strftime(DATETIME_FORMAT)
+    cursor.execute('''
+        INSERT INTO link_parameters (mac_address, mtu_size, payload_size, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(mac_address) DO UPDATE SET
+            mtu_size = excluded.mtu_size,
+            payload_size = excluded.payload_size,
+            updated_at = excluded.updated_at
+    ''', (macAddress, mtu_size, payload_size, updated_at))
+    conn.commit()
+    conn.close()
+
+def clear_link_params(macAddress):
+    """Forgets the negotiated link parameters so the next connection renegotiates them."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE link_parameters SET mtu_size = NULL, payload_size = NULL
+        WHERE mac_address = ?
+    ''', (macAddress,))
+    conn.commit()
+    conn.close()
+
+def update_link_stats(macAddress, bytes_received, transfer_seconds):
+    """Adds the bytes and time of a connection's file transfers to the per-device totals."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    updated_at = datetime.now().strftime(DATETIME_FORMAT)
+    cursor.execute('''
+        INSERT INTO link_parameters (mac_address, bytes_received, transfer_seconds, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(mac_address) DO UPDATE SET
+            bytes_received = bytes_received + excluded.bytes_received,
+            transfer_seconds = transfer_seconds + excluded.transfer_seconds,
+            updated_at = excluded.updated_at
+    ''', (macAddress, bytes_received, transfer_seconds, updated_at))
+    conn.commit()
+    conn.close()
+
+def get_link_stats():
+    """Returns payload size and average throughput (bytes/second) for every device with link parameters."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT mac_address, mtu_size, payload_size, bytes_received, transfer_seconds, updated_at
+        FROM link_parameters
+        ORDER BY mac_address
+    ''')
+    rows = cursor.fetchall()
+    conn.close()
+
+    return [
+        {
+            'mac_address': row[0],
+            'mtu_size': row[1],
+            'payload_size': row[2],
+            'bytes_received': row[3],
+            'transfer_seconds': row[4],
+            'throughput': row[3] / row[4] if row[4] else 0.0,
+            'updated_at': row[5]
+        }
+        for row in rows
+    ]
+
+def get_sync_cursor(macAddress):
+    """Returns the stored sync cursor, device ID and last full listing time (datetime or None) for a MAC address."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT cursor, device_id, full_listing_at FROM sync_cursors
+        WHERE mac_address = ?
+    ''', (macAddress,))
+    row = cursor.fetchone()
+    conn.close()
+
+    if row is None:
+        return {'cursor': None, 'device_id': None, 'full_listing_at': None}
+
+    return {
+        'cursor': row[0],
+        'device_id': row[1],
+        'full_listing_at': datetime.strptime(row[2], DATETIME_FORMAT) if row[2] else None
+    }
+
+def store_sync_cursor(macAddress, sync_cursor, device_id, full_listing=False):
+    """Stores the listing cursor and resolved device ID for a MAC address, marking a full listing if one was done."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    updated_at = datetime.now().strftime(DATETIME_FORMAT)
+    full_listing_at = updated_at if full_listing else None
+    cursor.execute('''
+        INSERT INTO sync_cursors (mac_address, cursor, device_id, full_listing_at, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(mac_address) DO UPDATE SET
+            cursor = excluded.cursor,
+            device_id = excluded.device_id,
+            full_listing_at = COALESCE(excluded.full_listing_at, full_listing_at),
+            updated_at = excluded.updated_at
+    ''', (macAddress, sync_cursor, device_id, full_listing_at, updated_at))
+    conn.commit()
+    conn.close()
+
+def record_devices_seen(devices):
+    """Records discovered devices, given as {mac_address: name}, updating when each was last seen."""
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT INTO devices (mac_address, name, first_seen_at, last_seen_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(mac_address) DO UPDATE SET
+            name = COALESCE(excluded.name, name),
+            last_seen_at = excluded.last_seen_at
+    ''', [(macAddress, name, now, now) for macAddress, name in devices.items()])
+    conn.commit()
+    conn.close()
+
+def mark_device_synced(macAddress, device_id):
+    """Records a completed sync of a device and the ID its files were stored under."""
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO devices (mac_address, device_id, first_seen_at, last_seen_at, last_synced_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(mac_address) DO UPDATE SET
+            device_id = excluded.device_id,
+            last_synced_at = excluded.last_synced_at
+    ''', (macAddress, device_id, now, now, now))
+    conn.commit()
+    conn.close()
+
+def record_connection_attempt(macAddress, adapter, started_at, duration_ms, succeeded, used_cache=None, error=None):
+    """Appends a connection attempt to the history."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO connection_attempts (mac_address, adapter, started_at, duration_ms, succeeded, used_cache, error)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (macAddress, adapter, int(started_at), int(duration_ms), bool(succeeded), used_cache, error))
+    conn.commit()
+    conn.close()
+
+def record_file_transfers(transfers):
+    """Appends a connection's file transfers to the history in one transaction.
+
+    Each transfer is a dict with mac_address, device_id, filename, size,
+    bytes_received, duration_ms, succeeded, completed_at (epoch seconds) and
+    upload_state.
+    """
+    if not transfers:
+        return
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.executemany('''
+        INSERT INTO file_transfers (mac_address, device_id, filename, size, bytes_received, duration_ms, succeeded, completed_at, upload_state)
+        VALUES (:mac_address, :device_id, :filename, :size, :bytes_received, :duration_ms, :succeeded, :completed_at, :upload_state)
+    ''', transfers)
+    conn.commit()
+    conn.close()
+
+def record_received_files(files):
+    """Stores the hash each of a connection's files was received with, keyed by its path in the scan folder."""
+    if not files:
+        return
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.executemany('''
+        INSERT INTO received_files (path, size, sha256, received_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET size = excluded.size, sha256 = excluded.sha256, received_at = excluded.received_at
+    ''', [(os.path.abspath(path), size, sha256, now) for path, size, sha256 in files])
+    conn.commit()
+    conn.close()
+
+def get_received_sha256(path, size, modified_at):
+    """Returns the hash a file was received with, or None if it is unknown or may have changed since."""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('SELECT sha256 FROM received_files WHERE path = ? AND size = ? AND received_at >= ?',
+                   (os.path.abspath(path), size, int(modified_at)))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def coexistence_report(days=7):
+    """Compares BLE throughput over the last `days` days with no uploads, throttled uploads and unthrottled uploads.
+
+    'improvement' is the throughput with throttled uploads relative to
+    unthrottled ones, or None until both have been observed.
+    """
+    since = int(time.time()) - days * 86400
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT upload_state, COUNT(*), SUM(bytes_received), SUM(duration_ms) FROM file_transfers
+        WHERE completed_at >= ? AND succeeded AND duration_ms > 0 AND upload_state IS NOT NULL
+        GROUP BY upload_state
+    ''', (since,))
+    rows = cursor.fetchall()
+    conn.close()
+
+    report = {
+        row[0]: {'files': row[1], 'bytes_received': row[2], 'throughput': 1000 * row[2] / row[3]}
+        for row in rows
+    }
+    if 'throttled' in report and 'unthrottled' in report:
+        report['improvement'] = report['throttled']['throughput'] / report['unthrottled']['throughput']
+    else:
+        report['improvement'] = None
+    return report
+
+def least_recently_synced_devices(limit=10):
+    """Returns devices ordered from least to most recently synced, never-synced devices first."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT mac_address, device_id, name, last_seen_at, last_synced_at FROM devices
+        ORDER BY last_synced_at ASC
+        LIMIT ?
+    ''', (limit,))
+    rows = cursor.fetchall()
+    conn.close()
+
+    return [
+        {'mac_address': row[0], 'device_id': row[1], 'name': row[2], 'last_seen_at': row[3], 'last_synced_at': row[4]}
+        for row in rows
+    ]
+
+def bytes_per_device_per_day(days=7):
+    """Returns bytes received per device per day over the last `days` days, combining daily aggregates and raw rows."""
+    since = int(time.time()) - days * 86400
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT mac_address, day, MAX(device_id), SUM(files), SUM(bytes_received) FROM (
+            SELECT mac_address, day, device_id, files, bytes_received FROM device_daily
+            WHERE day >= ?
+            UNION ALL
+            SELECT mac_address, completed_at / 86400 AS day, device_id, succeeded AS files, bytes_received FROM file_transfers
+            WHERE completed_at >= ?
+        )
+        GROUP BY mac_address, day
+        ORDER BY day, mac_address
+    ''', (since // 86400, since))
+    rows = cursor.fetchall()
+    conn.close()
+
+    return [
+        {'mac_address': row[0], 'day': row[1], 'device_id': row[2], 'files': row[3], 'bytes_received': row[4]}
+        for row in rows
+    ]
+
+def compact_history(retention_days=HISTORY_RETENTION_DAYS):
+    """Rolls connection attempts and file transfers older than retention_days into device_daily and deletes them.
+
+    Acknowledged upload confirmations and received file hashes past the cutoff
+    are deleted as well.
+
+    Only whole days are compacted so a day's aggregate is never split between
+    device_daily and the raw tables.
+    """
+    cutoff = (int(time.time()) // 86400 - retention_days) * 86400
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    # "WHERE true" keeps SQLite from parsing ON CONFLICT as part of the SELECT's join
+    cursor.execute('''
+        INSERT INTO device_daily (mac_address, day, connections, connection_failures)
+        SELECT mac_address, started_at / 86400, COUNT(*), SUM(NOT succeeded) FROM connection_attempts
+        WHERE started_at < ? AND true
+        GROUP BY mac_address, started_at / 86400
+        ON CONFLICT(mac_address, day) DO UPDATE SET
+            connections = connections + excluded.connections,
+            connection_failures = connection_failures + excluded.connection_failures
+    ''', (cutoff,))
+    cursor.execute('''
+        INSERT INTO device_daily (mac_address, day, device_id, files, file_failures, bytes_received, transfer_ms)
+        SELECT mac_address, completed_at / 86400, MAX(device_id), SUM(succeeded), SUM(NOT succeeded),
+               SUM(bytes_received), SUM(COALESCE(duration_ms, 0)) FROM file_transfers
+        WHERE completed_at < ? AND true
+        GROUP BY mac_address, completed_at / 86400
+        ON CONFLICT(mac_address, day) DO UPDATE SET
+            device_id = COALESCE(excluded.device_id, device_id),
+            files = files + excluded.files,
+            file_failures = file_failures + excluded.file_failures,
+            bytes_received = bytes_received + excluded.bytes_received,
+            transfer_ms = transfer_ms + excluded.transfer_ms
+    ''', (cutoff,))
+    cursor.execute('DELETE FROM connection_attempts WHERE started_at < ?', (cutoff,))
+    connections_deleted = cursor.rowcount
+    cursor.execute('DELETE FROM file_transfers WHERE completed_at < ?', (cutoff,))
+    transfers_deleted = cursor.rowcount
+    # Acknowledged confirmations are only kept for reference
+    cursor.execute('DELETE FROM upload_confirmations WHERE acknowledged_at < ?', (cutoff,))
+    cursor.execute('DELETE FROM received_files WHERE received_at < ?', (cutoff,))
+    conn.commit()
+    conn.close()
+    return connections_deleted, transfers_deleted
+
+def get_device_ids():
+    """Returns the distinct IDs that synced devices store their files under."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT device_id FROM devices WHERE device_id IS NOT NULL')
+    device_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return device_ids
+
+def enable_wal():
+    """Switches the database to write-ahead logging so worker processes can read while another writes."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+
+def enqueue_upload(scan_directory):
+    """Adds a scan folder to the durable upload queue, or makes it pending again if it was queued before."""
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO upload_jobs (scan_directory, state, attempts, enqueued_at, available_at, updated_at)
+        VALUES (?, 'pending', 0, ?, ?, ?)
+        ON CONFLICT(scan_directory) DO UPDATE SET
+            state = 'pending', attempts = 0, last_error = NULL, available_at = excluded.available_at, updated_at = excluded.updated_at
+    ''', (scan_directory, now, now, now))
+    conn.commit()
+    conn.close()
+
+def claim_upload():
+    """Claims the oldest pending upload whose retry time has come. Returns (job_id, scan_directory) or None."""
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        # Take the write lock up front so two uploaders can never claim the same scan
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT id, scan_directory FROM upload_jobs
+            WHERE state = 'pending' AND available_at <= ?
+            ORDER BY id LIMIT 1
+        ''', (now,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("UPDATE upload_jobs SET state = 'claimed', updated_at = ? WHERE id = ?", (now, row[0]))
+        cursor.execute('COMMIT')
+        return row
+    finally:
+        conn.close()
+
+def finish_upload(job_id):
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.execute("UPDATE upload_jobs SET state = 'done', updated_at = ? WHERE id = ?", (int(time.time()), job_id))
+    conn.commit()
+    conn.close()
+
+def upload_retry_delay(attempts):
+    """Seconds to wait before retrying an upload that has failed attempts times."""
+    return min(60 * 2 ** attempts, 3600)
+
+def fail_upload(job_id, error):
+    """Returns a failed upload to the queue with exponential backoff, or marks it failed after UPLOAD_QUEUE_MAX_ATTEMPTS."""
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('SELECT attempts FROM upload_jobs WHERE id = ?', (job_id,))
+    row = cursor.fetchone()
+    attempts = (row[0] if row else 0) + 1
+    state = 'failed' if attempts >= UPLOAD_QUEUE_MAX_ATTEMPTS else 'pending'
+    cursor.execute('''
+        UPDATE upload_jobs SET state = ?, attempts = ?, last_error = ?, available_at = ?, updated_at = ? WHERE id = ?
+    ''', (state, attempts, str(error), now + upload_retry_delay(attempts), now, job_id))
+    conn.commit()
+    conn.close()
+
+def requeue_claimed_uploads():
+    """Makes uploads claimed by an uploader that exited before finishing them pending again. Returns how many."""
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE upload_jobs SET state = 'pending', updated_at = ? WHERE state = 'claimed'", (int(time.time()),))
+    requeued = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return requeued
+
+def count_uploads(state='pending'):
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) FROM upload_jobs WHERE state = ?', (state,))
+    count = cursor.fetchone()[0]
+    conn.close()
+    return count
+
+def record_upload_confirmation(device_id, filename, size, sha256, s3_key, object_sha256=None):
+    """Records that a device's file is verified in S3, so its peripheral can be told it may delete it.
+
+    object_sha256 is the hash of the object at s3_key when that isn't the file
+    itself, such as the columnar copy replacing a CSV.
+    """
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.execute('''
+        INSERT INTO upload_confirmations (device_id, filename, size, sha256, s3_key, object_sha256, confirmed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(device_id, filename, sha256) DO UPDATE SET
+            s3_key = excluded.s3_key, object_sha256 = excluded.object_sha256, confirmed_at = excluded.confirmed_at
+    ''', (device_id, filename, size, sha256, s3_key, object_sha256 or sha256, now))
+    conn.commit()
+    conn.close()
+
+def record_changed_files(device_id, filenames):
+    """Records that an incremental listing showed these files created or modified since the sync cursor."""
+    if not filenames:
+        return
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.executemany('''
+        INSERT INTO changed_files (device_id, filename, listed_at) VALUES (?, ?, ?)
+        ON CONFLICT(device_id, filename) DO UPDATE SET listed_at = excluded.listed_at
+    ''', [(device_id, filename, now) for filename in filenames])
+    conn.commit()
+    conn.close()
+
+def get_replaced_files(device_id):
+    """Returns the set of (filename, size) of a device's files confirmed under another object's key.
+
+    These are CSVs uploaded only as their columnar copy (PROCESS_CSV 'replace'),
+    which neither the Hublink API nor the S3 inventory know by their own name.
+    """
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    cursor = conn.cursor()
+    cursor.execute('SELECT filename, size, s3_key FROM upload_confirmations WHERE device_id = ?', (device_id,))
+    replaced = {(filename, size) for filename, size, s3_key in cursor.fetchall() if s3_key.rsplit('/', 1)[-1] != filename}
+    conn.close()
+    return replaced
+
+def mark_uploads_acknowledged(device_id, filenames):
+    now = int(time.time())
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    conn.executemany('''
+        UPDATE upload_confirmations SET acknowledged_at = ? WHERE device_id = ? AND filename = ? AND acknowledged_at IS NULL
+    ''', [(now, device_id, filename) for filename in filenames])
+    # The peripheral deletes or archives acknowledged files, so a file listed under the same name later is a new one
+    conn.executemany('DELETE FROM changed_files WHERE device_id = ? AND filename = ?', [(device_id, filename) for filename in filenames])
+    conn.commit()
+    conn.close()
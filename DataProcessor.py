@@ -0,0 +1,139 @@
+import json
+import os
+from config import PROCESS_CSV, PROCESS_WORKERS
+from EventLog import event_log
+
+def columnar_backend():
+    """Returns 'parquet' or 'npz' depending on which optional library is installed, or None."""
+    try:
+        import pyarrow  # noqa: F401
+        return 'parquet'
+    except ImportError:
+        pass
+    try:
+        import numpy  # noqa: F401
+        return 'npz'
+    except ImportError:
+        return None
+
+def process_scan(base_directory, mode=PROCESS_CSV):
+    """Converts every CSV in a scan directory to a columnar file plus a summary, in a process pool.
+
+    Outputs are written next to each CSV in its {id} folder so they upload with
+    the scan. In 'replace' mode the summary marks the CSV as replaced: the
+    uploader skips it and deletes it only once the columnar copy is verified in
+    S3, recording it as uploaded under that copy's key so it isn't requested
+    again and can be acknowledged to the peripheral. Returns the list of summaries.
+    """
+    if mode == 'off':
+        return []
+    backend = columnar_backend()
+    if backend is None:
+        event_log.warning('processor', "CSV processing is enabled but neither pyarrow nor numpy is installed.")
+        return []
+
+    csv_paths = []
+    for id in os.listdir(base_directory):
+        id_path = os.path.join(base_directory, id)
+        if not os.path.isdir(id_path):
+            continue
+        csv_paths.extend(os.path.join(id_path, filename) for filename in os.listdir(id_path)
+                         if filename.lower().endswith('.csv'))
+    if not csv_paths:
+        return []
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    summaries = []
+    # Forking this multithreaded process (bleak's D-Bus connection, the event log
+    # writer, boto3 transfer threads) can deadlock the children, so start them fresh
+    with ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {path: executor.submit(convert_csv, path, backend, mode == 'replace') for path in csv_paths}
+        for path, future in futures.items():
+            try:
+                summary = future.result()
+            except Exception as e:
+                event_log.error('processor', f"Failed to convert {path}: {e}")
+                continue
+            summaries.append(summary)
+
+    raw_bytes = sum(summary['raw_bytes'] for summary in summaries)
+    output_bytes = sum(summary['output_bytes'] for summary in summaries)
+    event_log.info('processor', f"Converted {len(summaries)} CSV files: {raw_bytes} bytes to {output_bytes} bytes.",
+                   files=len(summaries), raw_bytes=raw_bytes, output_bytes=output_bytes, backend=backend)
+    return summaries
+
+def replaced_csvs(id_path):
+    """Returns {csv filename: columnar filename} for CSVs in an {id} folder that their converted copy replaces."""
+    replaced = {}
+    for filename in os.listdir(id_path):
+        if not filename.endswith('.summary.json'):
+            continue
+        try:
+            with open(os.path.join(id_path, filename)) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if summary.get('replaced') and os.path.isfile(os.path.join(id_path, summary['source'])):
+            replaced[summary['source']] = summary['output']
+    return replaced
+
+def convert_csv(path, backend, replace=False):
+    """Writes <stem>.parquet or <stem>.npz and <stem>.summary.json next to the CSV at path and returns the summary."""
+    stem = os.path.splitext(path)[0]
+    if backend == 'parquet':
+        output_path = f"{stem}.parquet"
+        columns, rows = convert_with_pyarrow(path, output_path)
+    else:
+        output_path = f"{stem}.npz"
+        columns, rows = convert_with_numpy(path, output_path)
+
+    summary = {
+        'source': os.path.basename(path),
+        'output': os.path.basename(output_path),
+        'rows': rows,
+        'columns': columns,
+        'raw_bytes': os.path.getsize(path),
+        'output_bytes': os.path.getsize(output_path),
+        'replaced': replace,
+    }
+    with open(f"{stem}.summary.json", 'w') as f:
+        json.dump(summary, f)
+    return summary
+
+def convert_with_pyarrow(path, output_path):
+    import pyarrow.compute as pc
+    import pyarrow.csv as pv
+    import pyarrow.parquet as pq
+
+    table = pv.read_csv(path)
+    pq.write_table(table, output_path, compression='zstd')
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        stats = {'type': str(column.type), 'nulls': column.null_count}
+        if pa_is_numeric(column.type) and len(column) > column.null_count:
+            min_max = pc.min_max(column)
+            stats.update(min=min_max['min'].as_py(), max=min_max['max'].as_py(), mean=pc.mean(column).as_py())
+        columns[name] = stats
+    return columns, table.num_rows
+
+def pa_is_numeric(data_type):
+    import pyarrow.types as pt
+    return pt.is_integer(data_type) or pt.is_floating(data_type)
+
+def convert_with_numpy(path, output_path):
+    import numpy as np
+
+    data = np.genfromtxt(path, delimiter=',', names=True, dtype=None, encoding='utf-8')
+    data = np.atleast_1d(data)
+    arrays = {name: data[name] for name in data.dtype.names}
+    np.savez_compressed(output_path, **arrays)
+    columns = {}
+    for name, values in arrays.items():
+        stats = {'type': str(values.dtype)}
+        if np.issubdtype(values.dtype, np.number) and values.size:
+            stats.update(nulls=int(np.isnan(values).sum()) if np.issubdtype(values.dtype, np.floating) else 0,
+                         min=float(np.nanmin(values)), max=float(np.nanmax(values)), mean=float(np.nanmean(values)))
+        columns[name] = stats
+    return columns, int(data.size)
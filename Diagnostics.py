@@ -0,0 +1,168 @@
+import asyncio
+import collections
+import functools
+import sys
+import threading
+import time
+from config import LOOP_LAG_INTERVAL_SECONDS, PROFILER_INTERVAL_SECONDS
+from EventLog import event_log
+
+# Histogram bucket upper bounds in seconds, from 50 us to 10 s
+BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+class Histogram:
+    """Fixed-bucket latency histogram; recording is a bisect and two additions."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        low, high = 0, len(BUCKETS) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if seconds <= BUCKETS[middle]:
+                high = middle
+            else:
+                low = middle + 1
+        self.counts[low] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples."""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound if bound != float('inf') else self.max
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / self.count if self.count else None,
+            'p50_ms': scale(self.percentile(0.5)),
+            'p95_ms': scale(self.percentile(0.95)),
+            'p99_ms': scale(self.percentile(0.99)),
+            'max_ms': 1000 * self.max,
+            'buckets_ms': {str(1000 * bound): count for bound, count in zip(BUCKETS, self.counts) if count},
+        }
+
+def scale(seconds):
+    return 1000 * seconds if seconds is not None else None
+
+callback_histograms = collections.defaultdict(Histogram)
+
+def timed(name):
+    """Decorator recording how long each call of an async callback takes in callback_histograms[name]."""
+    def decorator(function):
+        histogram = callback_histograms[name]
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a task that sleeps for a fixed interval."""
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self.histogram = Histogram()
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.histogram.record(max(lag, 0.0))
+            if lag > 1.0:
+                event_log.warning('diagnostics.lag', f"Event loop lagged {lag:.2f} seconds.", lag=lag)
+
+class SamplingProfiler:
+    """Samples the stacks of every thread at a fixed interval during one armed scan cycle.
+
+    Results are kept as collapsed stacks ("thread;file:function;... count"),
+    the input format of flamegraph tools.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL_SECONDS):
+        self.interval = interval
+        self.armed = False
+        self.running = False
+        self.thread = None
+        self.samples = None
+        self.result = None
+        self.captured_at = None
+        self.duration = None
+
+    def arm(self):
+        """Requests a capture of the next scan cycle."""
+        self.armed = True
+
+    def start(self):
+        self.armed = False
+        self.running = True
+        self.samples = collections.Counter()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.sample_loop, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.duration = time.perf_counter() - self.started
+        self.captured_at = time.time()
+        self.result = '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common())
+        event_log.info('diagnostics.profile', f"Profiled scan cycle: {sum(self.samples.values())} samples in {self.duration:.1f} seconds.")
+
+    def sample_loop(self):
+        own_id = threading.get_ident()
+        names = {}
+        while self.running:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def get_status(self):
+        return {
+            'armed': self.armed,
+            'running': self.running,
+            'captured_at': self.captured_at,
+            'duration_seconds': self.duration,
+            'samples': sum(self.samples.values()) if self.samples is not None and not self.running else None,
+        }
+
+loop_lag_monitor = LoopLagMonitor()
+profiler = SamplingProfiler()
+
+def get_diagnostics():
+    return {
+        'loop_lag': loop_lag_monitor.histogram.snapshot(),
+        'callbacks': {name: histogram.snapshot() for name, histogram in callback_histograms.items()},
+        'profiler': profiler.get_status(),
+    }
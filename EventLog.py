@@ -0,0 +1,125 @@
+import atexit
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from config import (EVENT_LOG_LEVEL, EVENT_CONSOLE_LEVEL, EVENT_LOG_FILE, EVENT_LOG_MAX_BYTES,
+                    EVENT_LOG_BACKUPS, EVENT_BUFFER_SIZE, EVENT_LOG_FLUSH_SECONDS)
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+# kind is a dotted category such as 'ble.transfer' or 's3.upload'; fields hold
+# structured data and are only serialized by the writer thread.
+Event = collections.namedtuple('Event', ['seq', 'time', 'level', 'kind', 'message', 'fields'])
+
+class EventLog:
+    """Typed events kept in a ring buffer and written to a rotating file in batches.
+
+    Emitting never takes a lock or touches the disk: deque appends and the
+    sequence counter are atomic under the GIL, and a daemon thread drains
+    pending events to the file every EVENT_LOG_FLUSH_SECONDS. Events below
+    the configured level are dropped by a single comparison.
+    """
+
+    def __init__(self, level=EVENT_LOG_LEVEL, console_level=EVENT_CONSOLE_LEVEL, path=EVENT_LOG_FILE,
+                 buffer_size=EVENT_BUFFER_SIZE):
+        self.level = LEVELS.get(level, INFO)
+        self.console_level = LEVELS.get(console_level, WARNING)
+        self.path = path
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.pending = collections.deque()
+        self.sequence = itertools.count()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.handler = None
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def emit(self, level, kind, message, **fields):
+        if level < self.level:
+            return
+        event = Event(next(self.sequence), time.time(), level, kind, message, fields)
+        self.buffer.append(event)
+        if self.path:
+            self.pending.append(event)
+            if self.writer is None:
+                self.start_writer()
+        if level >= self.console_level:
+            print(f"{LEVEL_NAMES.get(level, level)} {kind}: {message}", file=sys.stderr)
+
+    def debug(self, kind, message, **fields):
+        if DEBUG >= self.level:
+            self.emit(DEBUG, kind, message, **fields)
+
+    def info(self, kind, message, **fields):
+        if INFO >= self.level:
+            self.emit(INFO, kind, message, **fields)
+
+    def warning(self, kind, message, **fields):
+        if WARNING >= self.level:
+            self.emit(WARNING, kind, message, **fields)
+
+    def error(self, kind, message, **fields):
+        if ERROR >= self.level:
+            self.emit(ERROR, kind, message, **fields)
+
+    def recent(self, n=100, level=None, kind=None):
+        """Returns the most recent n events as dicts, oldest first, optionally filtered by minimum level and kind prefix."""
+        events = list(self.buffer)
+        if level is not None:
+            events = [event for event in events if event.level >= level]
+        if kind:
+            events = [event for event in events if event.kind.startswith(kind)]
+        return [to_dict(event) for event in events[-n:]]
+
+    def start_writer(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, name='event-log-writer', daemon=True)
+                self.writer.start()
+
+    def write_loop(self):
+        while True:
+            time.sleep(EVENT_LOG_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing event log: {e}", file=sys.stderr)
+
+    def flush(self):
+        """Writes all pending events to the log file as one batch of JSON lines."""
+        lines = []
+        while self.pending:
+            lines.append(json.dumps(to_dict(self.pending.popleft()), default=str))
+        if not lines:
+            return
+        # logging is only needed once there is something to write
+        import logging
+        from logging.handlers import RotatingFileHandler
+        if self.handler is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.handler = RotatingFileHandler(self.path, maxBytes=EVENT_LOG_MAX_BYTES, backupCount=EVENT_LOG_BACKUPS)
+        self.handler.handle(logging.makeLogRecord({'msg': '\n'.join(lines), 'levelno': INFO}))
+
+def to_dict(event):
+    return {
+        'seq': event.seq,
+        'time': event.time,
+        'level': LEVEL_NAMES.get(event.level, event.level),
+        'kind': event.kind,
+        'message': event.message,
+        'fields': event.fields,
+    }
+
+event_log = EventLog()
+# Short-lived processes exit before the writer thread's next flush
+atexit.register(event_log.flush)
@@ -1,17 +1,341 @@
+import hashlib
 import os
 import shutil
-import psutil
+import threading
 from datetime import datetime, timedelta
-from config import DATA_DIRECTORY, DELETE_SCANS, DELETE_SCANS_DAYS_OLD, DELETE_SCANS_PERCENT_REMAINING
+from config import DATA_DIRECTORY, DISK_HEADROOM_BYTES
+from DBManager import get_settings
+from EventLog import event_log
+
+# Files being received live here until complete. It must be on the same drive as
+# the scan folders so completed files can be renamed into place atomically.
+PARTIAL_DIRECTORY = os.path.join(DATA_DIRECTORY, '.partial')
+# Received content is stored once here, named by SHA-256, and hardlinked into each
+# scan folder that received it.
+OBJECT_DIRECTORY = os.path.join(DATA_DIRECTORY, '.objects')
+# Where hardlinks aren't supported, lists the scan paths holding copies of an object
+COPIES_SUFFIX = '.copies'
+
+def preallocate(fd, size):
+    """Reserves size bytes for the file so it is allocated up front rather than grown chunk by chunk."""
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not available on this platform or filesystem; extending the file still reserves its length
+        os.ftruncate(fd, size)
+
+class ReceiveFile:
+    """A file being received over BLE, preallocated to the size announced in the listing.
+
+    Chunks are written at their offsets into a partial file outside the scan
+    folders, and the file is only renamed to its final path once exactly the
+    announced number of bytes has been written, so uploaders and purgers never
+    see half-written files.
+
+    Content is hashed as it streams in; on commit the file goes into the
+    content store, and a file whose content is already stored is dropped and
+    linked to the existing copy instead.
+    """
+
+    def __init__(self, final_path, size):
+        self.final_path = final_path
+        self.size = size
+        self.offset = 0  # Offset of the next in-order chunk
+        self.received = 0
+        self.digest = hashlib.sha256()
+        self.hashed = 0  # Bytes hashed so far; chunks are hashed while they arrive in order
+        self.sha256 = None  # Set on commit, and persisted so the uploader doesn't hash the file again
+        os.makedirs(PARTIAL_DIRECTORY, exist_ok=True)
+        partial_name = final_path.replace(os.sep, '_') + '.part'
+        self.partial_path = os.path.join(PARTIAL_DIRECTORY, partial_name)
+        self.fd = os.open(self.partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            preallocate(self.fd, size)
+        except OSError:
+            self.discard()
+            raise
+
+    def write(self, data, offset=None):
+        """Writes a chunk at offset, or directly after the previous chunk if no offset is given."""
+        if offset is None:
+            offset = self.offset
+        if offset + len(data) > self.size:
+            raise ValueError(f"chunk at offset {offset} exceeds announced size of {self.size} bytes")
+        os.pwrite(self.fd, data, offset)
+        if offset == self.hashed:
+            self.digest.update(data)
+            self.hashed += len(data)
+        self.offset = offset + len(data)
+        self.received += len(data)
+
+    def is_complete(self):
+        return self.received == self.size
+
+    def commit(self):
+        """Moves the file into place if it is complete, otherwise discards it. Returns True if committed."""
+        if not self.is_complete():
+            event_log.warning('ble.transfer', f"Size mismatch for {self.final_path}: received {self.received} of {self.size} bytes.")
+            self.discard()
+            return False
+        if self.hashed != self.size:
+            # Chunks arrived out of order; hash what was written instead
+            self.digest = hashlib.sha256()
+            for offset in range(0, self.size, 1024 * 1024):
+                self.digest.update(os.pread(self.fd, 1024 * 1024, offset))
+        self.sha256 = self.digest.hexdigest()
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        content_store.store(self.partial_path, self.final_path, self.sha256, self.size)
+        return True
+
+    def discard(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+class SpaceReservations:
+    """Admission control for incoming files on the drive at DATA_DIRECTORY.
+
+    A file's announced size is reserved before it is requested and released
+    once the file has been preallocated (from then on it shows up in the
+    drive's free space) or abandoned, so concurrent transfers can't together
+    promise more space than the drive has.
+    """
+
+    def __init__(self, headroom_bytes=DISK_HEADROOM_BYTES):
+        self.headroom_bytes = headroom_bytes
+        self.reserved_bytes = 0
+        self.lock = threading.Lock()
+        self.metrics = {
+            'reservations_granted': 0,
+            'reservations_denied': 0,
+            'files_deferred': 0,
+            'bytes_deferred': 0,
+            'folders_reclaimed': 0,
+            'bytes_reclaimed': 0,
+        }
+
+    def free_bytes(self):
+        return shutil.disk_usage(DATA_DIRECTORY).free
+
+    def available(self):
+        """Bytes that can still be reserved."""
+        with self.lock:
+            return self.free_bytes() - self.reserved_bytes - self.headroom_bytes
+
+    def reserve(self, size):
+        """Reserves size bytes if they fit. Returns True if the reservation was granted."""
+        with self.lock:
+            if self.free_bytes() - self.reserved_bytes - self.headroom_bytes < size:
+                self.metrics['reservations_denied'] += 1
+                return False
+            self.reserved_bytes += size
+            self.metrics['reservations_granted'] += 1
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.reserved_bytes = max(self.reserved_bytes - size, 0)
+
+    def record_deferred(self, files):
+        with self.lock:
+            self.metrics['files_deferred'] += len(files)
+            self.metrics['bytes_deferred'] += sum(size for _, size in files)
+
+    def record_reclaimed(self, folders, size):
+        with self.lock:
+            self.metrics['folders_reclaimed'] += folders
+            self.metrics['bytes_reclaimed'] += size
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics['reserved_bytes'] = self.reserved_bytes
+        usage = shutil.disk_usage(DATA_DIRECTORY)
+        metrics['free_bytes'] = usage.free
+        metrics['total_bytes'] = usage.total
+        metrics['headroom_bytes'] = self.headroom_bytes
+        metrics['content_store'] = content_store.get_metrics()
+        return metrics
+
+space_reservations = SpaceReservations()
+
+class ContentStore:
+    """Stores received files once by content hash under OBJECT_DIRECTORY.
+
+    Scan folders keep their {id}/{filename} layout as hardlinks to the stored
+    objects, so consumers see ordinary files. On filesystems without hardlinks
+    (e.g. FAT) scan folders get plain copies instead, and the paths copied to
+    are listed in a .copies file beside the object so prune() keeps it while
+    any of them is left.
+    """
+
+    def __init__(self, directory=OBJECT_DIRECTORY):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.metrics = {'objects_stored': 0, 'duplicates': 0, 'bytes_deduplicated': 0, 'objects_pruned': 0}
+
+    def object_path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def copies_path(self, target):
+        return target + COPIES_SUFFIX
+
+    def read_copies(self, target):
+        """Returns the scan paths holding copies of the object at target."""
+        try:
+            with open(self.copies_path(target)) as f:
+                return [line for line in f.read().splitlines() if line]
+        except FileNotFoundError:
+            return []
+
+    def store(self, path, final_path, sha256, size):
+        """Moves the file at path into the store and links it in at final_path. Returns True if the content was already stored."""
+        target = self.object_path(sha256)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        if os.path.lexists(final_path):
+            os.remove(final_path)
+        with self.lock:
+            duplicate = os.path.exists(target)
+            if duplicate:
+                os.remove(path)
+            else:
+                os.replace(path, target)
+            try:
+                os.link(target, final_path)
+            except OSError:
+                # No hardlinks on this filesystem: copy it out and record the copy so the object is kept
+                shutil.copyfile(target, final_path)
+                with open(self.copies_path(target), 'a') as f:
+                    f.write(final_path + '\n')
+            if duplicate:
+                self.metrics['duplicates'] += 1
+                self.metrics['bytes_deduplicated'] += size
+            else:
+                self.metrics['objects_stored'] += 1
+        if duplicate:
+            event_log.info('storage.dedup', f"{final_path} duplicates stored content {sha256[:12]}.", path=final_path, sha256=sha256, bytes=size)
+        return duplicate
+
+    def prune(self):
+        """Deletes objects no scan folder links to or holds a copy of any more. Returns the number of bytes freed.
+
+        Walks the whole store, so callers deleting several scan folders prune
+        once afterwards. The lock is only held to re-check and delete each
+        unlinked object, so store() isn't held up by the walk.
+        """
+        freed = 0
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.endswith(COPIES_SUFFIX) or os.stat(path).st_nlink != 1:
+                    continue
+                with self.lock:
+                    # store() may have linked it again, or another prune removed it, since the walk saw it
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if stat.st_nlink != 1:
+                        continue
+                    copies = self.read_copies(path)
+                    if copies:
+                        remaining = [copy for copy in copies if os.path.exists(copy)]
+                        if remaining:
+                            if remaining != copies:
+                                with open(self.copies_path(path), 'w') as f:
+                                    f.write(''.join(copy + '\n' for copy in remaining))
+                            continue
+                        os.remove(self.copies_path(path))
+                    os.remove(path)
+                    freed += stat.st_size
+                    self.metrics['objects_pruned'] += 1
+        return freed
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics)
+
+content_store = ContentStore()
+
+def delete_scan_folder(folder):
+    """Deletes a scan folder.
+
+    Returns (bytes freed now, bytes freed by the next content_store.prune()).
+    Files also linked from other scan folders free nothing; a file linked only
+    here and from the content store frees its object once pruned.
+    """
+    freed = unlinked = 0
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            stat = os.lstat(os.path.join(root, filename))
+            if stat.st_nlink == 1:
+                freed += stat.st_size
+            elif stat.st_nlink == 2:
+                unlinked += stat.st_size
+    shutil.rmtree(folder)
+    return freed, unlinked
+
+def reclaim_space(size, exclude=()):
+    """Deletes the oldest scan folders already fully uploaded to S3 until size bytes can be reserved.
+
+    Only runs when cloud uploads and scan deletion are both enabled; folders in
+    exclude (the scans currently being received) are never touched. Returns the
+    number of bytes freed.
+    """
+    from S3Manager import scan_in_inventory
+
+    settings = get_settings()
+    if not settings['use_cloud'] or not settings['delete_scans']:
+        return 0
+    excluded = {os.path.normpath(folder) for folder in exclude}
+    folders = sorted((folder for folder in list_scan_folders() if os.path.normpath(folder) not in excluded),
+                     key=os.path.getmtime)
+    freed = 0
+    unpruned = 0  # Bytes of deleted files whose objects are only freed by the prune below
+    reclaimed = 0
+    for folder in folders:
+        if space_reservations.available() + unpruned >= size:
+            break
+        if not scan_in_inventory(folder):
+            continue
+        folder_freed, folder_unlinked = delete_scan_folder(folder)
+        freed += folder_freed
+        unpruned += folder_unlinked
+        reclaimed += 1
+        event_log.info('storage.reclaim', f"Deleted uploaded scan {folder} to free {folder_freed + folder_unlinked} bytes.",
+                       folder=folder, bytes=folder_freed + folder_unlinked)
+    if reclaimed:
+        # Files linked from other scans stay stored; drop only objects nothing links to now
+        freed += content_store.prune()
+    space_reservations.record_reclaimed(reclaimed, freed)
+    return freed
+
+def list_scan_folders():
+    """Returns the scan folders in DATA_DIRECTORY, skipping hidden working directories like PARTIAL_DIRECTORY."""
+    return [os.path.join(DATA_DIRECTORY, folder) for folder in os.listdir(DATA_DIRECTORY)
+            if not folder.startswith('.') and os.path.isdir(os.path.join(DATA_DIRECTORY, folder))]
 
 def purgeScans():
     """Purges old scan folders from DATA_DIRECTORY based on defined rules."""
+    import psutil
+
+    settings = get_settings()
+    DELETE_SCANS = settings['delete_scans']
+    DELETE_SCANS_DAYS_OLD = settings['delete_scans_days_old']
+    DELETE_SCANS_PERCENT_REMAINING = settings['delete_scans_percent_remaining']
     if not DELETE_SCANS:
         print("Scan deletion is disabled.")
         return
     
     # Get list of all folders in DATA_DIRECTORY
-    scan_folders = [os.path.join(DATA_DIRECTORY, folder) for folder in os.listdir(DATA_DIRECTORY) if os.path.isdir(os.path.join(DATA_DIRECTORY, folder))]
+    scan_folders = list_scan_folders()
     print(f"Found {len(scan_folders)} scan folders.")
     
     # Delete folders older than DELETE_SCANS_DAYS_OLD
@@ -22,9 +346,10 @@ def purgeScans():
             folder_mod_time = datetime.fromtimestamp(os.path.getmtime(folder))
             if folder_mod_time <= cutoff_date:
                 print(f"Deleting folder {folder} - older than {DELETE_SCANS_DAYS_OLD} days.")
-                shutil.rmtree(folder)
+                delete_scan_folder(folder)
+        content_store.prune()
         # Refresh the list of scan folders after deletion
-        scan_folders = [os.path.join(DATA_DIRECTORY, folder) for folder in os.listdir(DATA_DIRECTORY) if os.path.isdir(os.path.join(DATA_DIRECTORY, folder))]
+        scan_folders = list_scan_folders()
         print(f"Refreshed list of scan folders. {len(scan_folders)} folders remaining.")
     else:
         print("DELETE_SCANS_DAYS_OLD is set to 0 or less, skipping age-based deletion.")
@@ -38,16 +363,18 @@ def purgeScans():
             print(f"Disk space remaining ({percent_remaining}%) is below the threshold ({DELETE_SCANS_PERCENT_REMAINING}%). Deleting older folders.")
             # Sort folders by modification time, oldest first
             scan_folders.sort(key=lambda folder: os.path.getmtime(folder))
+            unpruned = 0  # Bytes of deleted files whose objects are only freed by the prune below
             for folder in scan_folders:
                 if percent_remaining >= DELETE_SCANS_PERCENT_REMAINING:
                     print(f"Disk space is now above threshold ({percent_remaining}%). Stopping deletion.")
                     break
                 print(f"Deleting folder {folder} to free up space.")
-                shutil.rmtree(folder)
+                unpruned += delete_scan_folder(folder)[1]
                 # Update disk usage after each deletion
                 disk_usage = psutil.disk_usage(DATA_DIRECTORY)
-                percent_remaining = 100 - (disk_usage.percent)
+                percent_remaining = 100 - (disk_usage.percent) + 100 * unpruned / disk_usage.total
                 print(f"Folder {folder} deleted. Updated disk space: {percent_remaining}% remaining.")
+            content_store.prune()
     else:
         print("DELETE_SCANS_PERCENT_REMAINING is set to 0 or less, skipping disk space-based deletion.")
 
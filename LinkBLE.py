@@ -1,22 +1,104 @@
 import asyncio
-from bleak import BleakScanner, BleakClient, BleakError
-from S3Manager import upload_files
-from config import DATA_DIRECTORY
+from importlib.metadata import version, PackageNotFoundError
+from bleak import BleakError
+from AdapterManager import AdapterPool
+from S3Manager import ScanPlan, upload_files, upload_scheduler, acknowledgeable_files
+from config import DATA_DIRECTORY, SCAN_PLAN_FILE, PREFERRED_MTU, ATT_HEADER_SIZE, MAX_ATTRIBUTE_SIZE, FULL_LISTING_INTERVAL_HOURS, BATCH_MAX_FILES, LEASE_ENABLED, LEASE_SECONDS, LEASE_HOLD_AFTER_SYNC_SECONDS
 import os
-from datetime import datetime
-from DBManager import sortRecentMAC, updateMAC, get_settings
+import shutil
+from datetime import datetime, timedelta
+from DBManager import sortRecentMAC, updateMAC, get_settings, get_link_params, store_link_params, clear_link_params, update_link_stats, get_sync_cursor, store_sync_cursor, record_devices_seen, mark_device_synced, record_connection_attempt, record_file_transfers, record_received_files, record_changed_files, mark_uploads_acknowledged
 import time
-from APIManager import filter_needed_files
+from APIManager import filter_needed_files, claim_lease, release_lease
+from FileManager import ReceiveFile, space_reservations, reclaim_space
+from EventLog import event_log
+from Diagnostics import timed
+from DataProcessor import process_scan
 
 SERVICE_UUID = "57617368-5501-0001-8000-00805f9b34fb"
 CHARACTERISTIC_UUID_FILENAME = "57617368-5502-0001-8000-00805f9b34fb"
 CHARACTERISTIC_UUID_FILETRANSFER = "57617368-5503-0001-8000-00805f9b34fb"
 
+# Control messages are written to the filename characteristic as "COMMAND:value".
+# ':' is not a valid character in FAT filenames, so they can't collide with file requests.
+CONTROL_MTU = "MTU"
+CONTROL_SINCE = "SINCE"
+# "BATCH:name1|name2|..." requests several files at once. '|' already separates
+# name and size in the listing, so it can't appear in a filename either.
+CONTROL_BATCH = "BATCH"
+# "DONE:name1|name2|..." tells the peripheral these files are verified in S3 and
+# may be deleted or archived.
+CONTROL_DONE = "DONE"
+# Listing entries of the form "KEY:value" (sent like filenames, ended by EON) carry
+# listing metadata rather than files.
+LISTING_CURSOR = "CURSOR"
+# "MTU:n" announces that the peripheral accepts the MTU control write and can send
+# up to n bytes per notification. Older firmware would take the write for a file request.
+LISTING_MTU = "MTU"
+# "BATCH:n" announces that the peripheral accepts batched requests of up to n files.
+LISTING_BATCH = "BATCH"
+# "ACK:<action>" announces that the peripheral accepts DONE acknowledgements and
+# what it does with acknowledged files (e.g. "delete" or "archive").
+LISTING_ACK = "ACK"
+# In a batch each file is sent as a "HDR:name|size\n" header, exactly size bytes
+# of data and an "EOF" notification. The header may span several notifications
+# and data may follow its newline in the same one. A file the peripheral can't
+# read is announced with size -1.
+TRANSFER_HEADER = b"HDR:"
+TRANSFER_HEADER_END = b"\n"
+DEFAULT_MTU = 23
+
+def control_message(command, value):
+    return f"{command}:{value}".encode('utf-8')
+
+def pack_filenames(command, files, max_files=None):
+    """Groups (filename, size) entries into lists whose "COMMAND:name1|name2|..." message fits one attribute write."""
+    window, length = [], len(command) + 1
+    for filename, filesize in files:
+        entry_length = len(filename.encode('utf-8')) + 1
+        if window and ((max_files and len(window) >= max_files) or length + entry_length > MAX_ATTRIBUTE_SIZE):
+            yield window
+            window, length = [], len(command) + 1
+        window.append((filename, filesize))
+        length += entry_length
+    if window:
+        yield window
+
+def bleak_needs_mtu_acquire():
+    """True for bleak versions before 0.21, which on BlueZ only report the negotiated MTU after the private _acquire_mtu()."""
+    try:
+        return tuple(int(part) for part in version('bleak').split('.')[:2]) < (0, 21)
+    except (PackageNotFoundError, ValueError):
+        return False
+
+BLEAK_NEEDS_MTU_ACQUIRE = bleak_needs_mtu_acquire()
+
+async def acquire_mtu(client):
+    """Returns the ATT MTU negotiated for the connection.
+
+    BlueZ exchanges the MTU on its own. bleak 0.20, which requirements.txt pins,
+    only exposes it through an acquired write/notify socket and reports the
+    default of 23 until _acquire_mtu() is called; that private call is limited to
+    those versions so an upgrade falls back to mtu_size instead of breaking.
+    """
+    backend = getattr(client, '_backend', None)
+    if BLEAK_NEEDS_MTU_ACQUIRE and hasattr(backend, '_acquire_mtu'):
+        try:
+            await backend._acquire_mtu()
+        except Exception as e:
+            event_log.warning('ble.mtu', f"Unable to acquire MTU: {e}")
+    try:
+        return client.mtu_size
+    except Exception:
+        return DEFAULT_MTU
+
 class BLEFileTransferClient:
-    def __init__(self, mac_address, base_directory):
+    def __init__(self, mac_address, base_directory, plan=None):
         self.file_list = []
+        self.address = mac_address
         self.mac_address = mac_address.replace(':', '')
         self.base_directory = base_directory
+        self.plan = plan or ScanPlan.for_directory(base_directory)
         self.eof_received = False
         self.file_transfer_event = asyncio.Event()  # Event to track file transfer activity
         self.all_filenames_received = asyncio.Event()  # Event to track completion of filename reception
@@ -24,13 +106,109 @@ class BLEFileTransferClient:
         self.current_file_path = None
         self.current_filename_buffer = ""  # Buffer to piece together filename chunks
         self.file_transfer_timeout_task = None  # Task to manage dynamic timeout during file transfer
+        self.mtu_size = DEFAULT_MTU
+        self.payload_size = DEFAULT_MTU - ATT_HEADER_SIZE
+        self.bytes_received = 0  # Bytes written across all files on this connection
+        self.transfer_seconds = 0.0  # Time spent waiting on file transfers on this connection
+        self.transfer_failed = False
+        self.subscribed = False  # True once both characteristics are subscribed
+        self.device_id = None  # ID the device's files are stored under, resolved from the listing
+        self.transfers = []  # History rows for this connection's file transfers
+        self.received_files = []  # (path, size, sha256) of files committed on this connection
+        self.connect_started = None
+        self.first_byte_latency = None  # Seconds from starting the connection to the first notification
+        self.listing_cursor = None  # Cursor announced by the peripheral for this listing
+        self.sync_state = {'cursor': None, 'device_id': None, 'full_listing_at': None}
+        self.full_listing = True
+        self.batch_size = None  # Files per batched request, if the peripheral supports batching
+        self.batch_pending = {}  # filename -> size for files of the current batch not yet finished
+        self.batch_current = None  # File of the current batch being received
+        self.batch_header = None  # Start of a batch header whose newline hasn't arrived yet
+        self.batch_discarded = 0  # Bytes of the current batch that belonged to no announced file
+        self.batch_upload_state = None
+        self.reservations = {}  # filename -> bytes reserved on disk and not yet allocated
+        self.transfer_deferred = False  # Files were left for a later connection for lack of disk space
+        self.abandoned = False  # Another gateway took over the device's lease mid-transfer
+        self.ack_action = None  # What the peripheral does with acknowledged files, if it supports acknowledgements
+        self.peripheral_payload = None  # Largest payload the peripheral can send, if it accepts the MTU control write
+
+    async def request_listing(self, client):
+        """Asks the peripheral to list only files changed since the stored sync cursor.
 
+        Without a cursor, or once FULL_LISTING_INTERVAL_HOURS have passed since the
+        last full listing, no cursor is sent and the peripheral lists every file.
+        """
+        self.sync_state = await asyncio.to_thread(get_sync_cursor, self.address)
+        last_full = self.sync_state['full_listing_at']
+        full_due = last_full is None or datetime.now() - last_full >= timedelta(hours=FULL_LISTING_INTERVAL_HOURS)
+        self.full_listing = self.sync_state['cursor'] is None or full_due
+        if self.full_listing:
+            event_log.info('ble.listing', "Requesting full file listing.")
+            return
+        event_log.info('ble.listing', f"Requesting files changed since cursor {self.sync_state['cursor']}")
+        await client.write_gatt_char(CHARACTERISTIC_UUID_FILENAME, control_message(CONTROL_SINCE, self.sync_state['cursor']))
+
+    def handle_listing_entry(self, entry):
+        key, value = entry.split(':', 1)
+        if key == LISTING_CURSOR:
+            self.listing_cursor = value
+        elif key == LISTING_ACK:
+            self.ack_action = value
+        elif key == LISTING_MTU:
+            try:
+                self.peripheral_payload = int(value)
+            except ValueError:
+                event_log.warning('ble.listing', f"Ignoring malformed MTU capability: {entry}")
+        elif key == LISTING_BATCH:
+            try:
+                self.batch_size = int(value)
+            except ValueError:
+                event_log.warning('ble.listing', f"Ignoring malformed batch capability: {entry}")
+        else:
+            event_log.warning('ble.listing', f"Ignoring unknown listing entry: {entry}")
+
+    async def negotiate_link(self, client):
+        """Determines the usable payload size for this device.
+
+        Negotiated values are persisted per MAC address so reconnections reuse them
+        instead of acquiring the MTU again.
+        """
+        stored = await asyncio.to_thread(get_link_params, self.address)
+        if stored:
+            self.mtu_size = stored['mtu_size']
+            self.payload_size = stored['payload_size']
+            event_log.info('ble.mtu', f"Using stored link parameters: MTU {self.mtu_size}, payload {self.payload_size} bytes")
+        else:
+            self.mtu_size = min(await acquire_mtu(client), PREFERRED_MTU)
+            self.payload_size = min(self.mtu_size - ATT_HEADER_SIZE, MAX_ATTRIBUTE_SIZE)
+            event_log.info('ble.mtu', f"Negotiated link parameters: MTU {self.mtu_size}, payload {self.payload_size} bytes")
+            if self.mtu_size > DEFAULT_MTU:
+                await asyncio.to_thread(store_link_params, self.address, self.mtu_size, self.payload_size)
+
+    async def advertise_payload(self, client):
+        """Tells the peripheral how many bytes each notification may carry, if its listing announced MTU support."""
+        if self.peripheral_payload is None:
+            return
+        self.payload_size = max(min(self.payload_size, self.peripheral_payload), DEFAULT_MTU - ATT_HEADER_SIZE)
+        await client.write_gatt_char(CHARACTERISTIC_UUID_FILENAME, control_message(CONTROL_MTU, self.payload_size))
+
+    def mark_first_byte(self):
+        if self.first_byte_latency is None and self.connect_started is not None:
+            self.first_byte_latency = time.monotonic() - self.connect_started
+
+    @timed('handle_file_transfer')
     async def handle_file_transfer(self, sender, data):
+        self.mark_first_byte()
+        if self.batch_pending:
+            self.handle_batch_data(data)
+            self.restart_transfer_timeout()
+            return
         if data == b"EOF":
             self.eof_received = True
             if self.current_file is not None:
-                self.current_file.close()
-                self.current_file = None
+                # Only a file matching its announced size is moved into the scan directory
+                if not self.commit_current_file():
+                    self.transfer_failed = True
                 #print("File transfer complete.")
             self.file_transfer_event.set()  # Signal that the file transfer is complete
 
@@ -41,57 +219,189 @@ class BLEFileTransferClient:
             return
 
         if self.current_file is None:
-            print("Error: No file currently open for writing.")
+            event_log.error('ble.transfer', "Error: No file currently open for writing.")
             return
 
         # Write data to the current file
         try:
             self.current_file.write(data)
+            self.bytes_received += len(data)
         except Exception as e:
-            print(f"Failed to write data to file: {e}")
+            event_log.error('ble.transfer', f"Failed to write data to file: {e}")
 
         # Reset the timeout timer each time data is received
+        self.restart_transfer_timeout()
+
+    def restart_transfer_timeout(self):
         if self.file_transfer_timeout_task:
             self.file_transfer_timeout_task.cancel()
         self.file_transfer_timeout_task = asyncio.create_task(self.start_dynamic_filetransfer_timeout())
 
+    def handle_batch_data(self, data):
+        """Demultiplexes one notification of a batched transfer into the file it belongs to.
+
+        Files are framed by their header's byte count, so data chunks are never
+        mistaken for markers, and by filename, so the order the peripheral sends
+        them in doesn't matter. Outside a file everything up to the next header
+        is discarded, such as the tail of a window that timed out.
+        """
+        entry = self.batch_current
+        if entry is not None and entry['remaining'] > 0:
+            if len(data) > entry['remaining']:
+                event_log.warning('ble.transfer', f"{entry['filename']} sent more than its announced {entry['size']} bytes.")
+                data = data[:entry['remaining']]
+            entry['remaining'] -= len(data)
+            self.bytes_received += len(data)
+            entry['bytes_received'] += len(data)
+            if self.current_file is not None:
+                try:
+                    self.current_file.write(data)
+                except Exception as e:
+                    event_log.error('ble.transfer', f"Failed to write data to file: {e}")
+            return
+
+        if self.batch_header is not None:
+            data = self.batch_header + data
+        elif data == b"EOF":
+            if entry is None:
+                event_log.warning('ble.transfer', "Unexpected EOF between batched files.")
+                return
+            self.finish_batch_file(entry)
+            return
+        elif not data.startswith(TRANSFER_HEADER):
+            self.batch_discarded += len(data)
+            return
+
+        header, end, rest = data.partition(TRANSFER_HEADER_END)
+        if not end:
+            # Wait for the rest of the header, unless this can't be one
+            self.batch_header = data if len(data) <= MAX_ATTRIBUTE_SIZE else None
+            if self.batch_header is None:
+                event_log.warning('ble.transfer', f"Discarding {len(data)} bytes of unterminated batch header.")
+                self.batch_discarded += len(data)
+            return
+        self.batch_header = None
+        if entry is not None:
+            # The previous file never sent EOF
+            self.finish_batch_file(entry)
+        self.start_batch_file(header[len(TRANSFER_HEADER):].decode('utf-8', errors='replace'))
+        if rest:
+            self.handle_batch_data(rest)
+
+    def start_batch_file(self, header):
+        try:
+            filename, size = header.rsplit('|', 1)
+            size = int(size)
+        except ValueError:
+            event_log.warning('ble.transfer', f"Malformed batch header received: {header}")
+            return
+        entry = {'filename': filename, 'size': size, 'remaining': max(size, 0), 'bytes_received': 0, 'started': time.time()}
+        self.batch_current = entry
+        if filename not in self.batch_pending:
+            event_log.warning('ble.transfer', f"Peripheral sent {filename}, which was not requested. Skipping.")
+            return
+        if size < 0:
+            event_log.warning('ble.transfer', f"Peripheral could not read {filename}.")
+            return
+        if size != self.batch_pending[filename]:
+            event_log.warning('ble.transfer', f"{filename} is {size} bytes, but the listing announced {self.batch_pending[filename]}.")
+        self.current_file_path = os.path.join(self.base_directory, self.device_id, filename)
+        try:
+            self.current_file = ReceiveFile(self.current_file_path, size)
+        except OSError as e:
+            event_log.error('ble.transfer', f"Failed to open file {filename} for writing: {e}")
+        finally:
+            self.release_reservation(filename)
+
+    def finish_batch_file(self, entry):
+        self.batch_current = None
+        filename = entry['filename']
+        if filename not in self.batch_pending:
+            return
+        if self.current_file is not None and entry['remaining'] == 0:
+            # Only a file matching its announced size is moved into the scan directory
+            succeeded = self.commit_current_file()
+        else:
+            succeeded = False
+            self.discard_current_file()
+        if not succeeded:
+            self.transfer_failed = True
+        elapsed_time = time.time() - entry['started']
+        self.record_transfer(filename, self.batch_pending.pop(filename), entry['bytes_received'], elapsed_time, succeeded, self.batch_upload_state)
+        if not self.batch_pending:
+            self.eof_received = True
+            self.file_transfer_event.set()
+
+    def record_transfer(self, filename, filesize, bytes_received, elapsed_time, succeeded, upload_state):
+        event_log.info('ble.transfer', f"{filename} ({filesize} bytes) took {elapsed_time:.2f} seconds.", filename=filename, size=filesize, seconds=elapsed_time, throughput=filesize / max(elapsed_time, 1e-6))
+        self.transfers.append({
+            'mac_address': self.address,
+            'device_id': self.device_id,
+            'filename': filename,
+            'size': filesize,
+            'bytes_received': bytes_received,
+            'duration_ms': int(elapsed_time * 1000),
+            'succeeded': succeeded,
+            'completed_at': int(time.time()),
+            'upload_state': upload_state
+        })
+
     async def start_dynamic_filetransfer_timeout(self):
         try:
             await asyncio.sleep(10)  # Timeout period for no data received
             if not self.eof_received:
-                print("Timeout during file transfer. Deleting partial file.")
-                if self.current_file is not None:
-                    self.current_file.close()
-                    self.current_file = None
-                if self.current_file_path and os.path.exists(self.current_file_path):
-                    os.remove(self.current_file_path)
-                    self.current_file_path = None
+                event_log.warning('ble.transfer', "Timeout during file transfer. Deleting partial file.")
+                self.discard_current_file()
                 self.file_transfer_event.set()  # Signal that file transfer should be considered complete
         except asyncio.CancelledError:
             # Task was canceled because new data was received
             pass
 
+    def abandon(self):
+        """Stops waiting on the peripheral so the transfer unwinds, e.g. after losing the device's lease."""
+        self.abandoned = True
+        self.all_filenames_received.set()
+        self.file_transfer_event.set()
+
+    def commit_current_file(self):
+        """Commits the current file, remembering the hash computed while it streamed in. Returns True if committed."""
+        received = self.current_file
+        self.current_file = None
+        if not received.commit():
+            return False
+        self.received_files.append((received.final_path, received.size, received.sha256))
+        return True
+
+    def discard_current_file(self):
+        if self.current_file is not None:
+            self.current_file.discard()
+            self.current_file = None
+
+    @timed('handle_filename')
     async def handle_filename(self, sender, data):
+        self.mark_first_byte()
         file_info = data.decode('utf-8').strip()
         if file_info == "EOF":
-            print("Received all filenames.")
+            event_log.info('ble.listing', "Received all filenames.", files=len(self.file_list))
             self.all_filenames_received.set()  # Signal that all filenames have been received
             return
         elif file_info == "EON":
             # End of current filename notification, process the complete filename
-            if '|' in self.current_filename_buffer:
+            if ':' in self.current_filename_buffer:
+                self.handle_listing_entry(self.current_filename_buffer)
+            elif '|' in self.current_filename_buffer:
                 try:
                     filename, filesize = self.current_filename_buffer.split('|')
                     filesize = int(filesize)
                 except ValueError:
-                    print(f"Malformed file_info received: {self.current_filename_buffer}")
+                    event_log.warning('ble.listing', f"Malformed file_info received: {self.current_filename_buffer}")
                     self.current_filename_buffer = ""
                     return
                 
-                print(f"Received filename: {filename}, size: {filesize}")
+                event_log.debug('ble.listing', "Received filename", filename=filename, size=filesize)
                 self.file_list.append((filename, filesize))
             else:
-                print(f"Malformed file_info received: {self.current_filename_buffer}")
+                event_log.warning('ble.listing', f"Malformed file_info received: {self.current_filename_buffer}")
             
             # Clear the buffer after processing
             self.current_filename_buffer = ""
@@ -104,163 +414,439 @@ class BLEFileTransferClient:
         self.file_list = []
         self.eof_received = False
         self.current_filename_buffer = ""
+        self.listing_cursor = None
+        self.peripheral_payload = None
         self.all_filenames_received.clear()
 
         try:
             # Ensure the client is connected
             if not client.is_connected:
-                print("Client is not connected. Retrying...")
+                event_log.warning('ble.connect', "Client is not connected. Retrying...")
                 await self.disconnect_client(client)
                 return
 
             # Start notifications for both FILENAME and FILETRANSFER characteristics
-            print("Requesting file list from ESP32...")
+            event_log.info('ble.listing', "Requesting file list from ESP32...")
             await client.start_notify(CHARACTERISTIC_UUID_FILETRANSFER, self.handle_file_transfer)
+            await self.negotiate_link(client)
+            await self.request_listing(client)
             await client.start_notify(CHARACTERISTIC_UUID_FILENAME, self.handle_filename)
+            self.subscribed = True
 
             # Wait for all filenames to be received
             await self.all_filenames_received.wait()  # Wait until all filenames have been received
+            if self.abandoned:
+                return
 
-            # Determine the ID to use (either from ID file or MAC address)
-            id = self.mac_address
+            # Determine the ID to use (either from ID file, the ID stored from an earlier listing, or MAC address)
+            id = self.sync_state['device_id'] or self.mac_address
             settings = get_settings()
             if settings['id_file_starts_with']:
                 for filename, filesize in self.file_list:
                     if filename.startswith(settings['id_file_starts_with']):
                         id = filename[len(settings['id_file_starts_with']):].split('.')[0]
                         break
-            filtered_list = filter_needed_files(id, self.file_list, settings['max_file_size'])
-            # Filter the list of files that are needed using the Hublink API endpoint
-            # if self.file_list:
-            #     try:
-            #         filtered_list = filter_needed_files(id, self.file_list, settings['max_file_size'])
-            #         if filtered_list is None:
-            #             raise TypeError("filter_needed_files returned None")
-            #         self.file_list = filtered_list
-            #     except TypeError as e:
-            #         print(f"Error filtering needed files: {e}")
-            #         self.file_list = []
-            # else:
-            #     print("No files received for processing.")
+            self.device_id = id
+            # File data is only sized to the negotiated payload once the listing shows the peripheral accepts it
+            await self.advertise_payload(client)
+            if self.ack_action is not None:
+                await self.acknowledge_uploads(client)
+            filtered_list = await asyncio.to_thread(filter_needed_files, id, self.file_list, settings['max_file_size'], self.plan)
 
             # After receiving filenames, request only those that are needed
-            for filename, filesize in self.file_list:
-                print(f"Requesting {filename}")
-                id_directory = os.path.join(self.base_directory, id)
-                os.makedirs(id_directory, exist_ok=True)
-                self.current_file_path = os.path.join(id_directory, filename)
-                try:
-                    self.current_file = open(self.current_file_path, 'wb')
-                except IOError as e:
-                    print(f"Failed to open file {filename} for writing: {e}")
-                    continue
-
-                try:
-                    await client.write_gatt_char(CHARACTERISTIC_UUID_FILENAME, filename.encode('utf-8'))  # Send filename without MAC address
-                except BleakError as e:
-                    print(f"Error during GATT write operation: {e}")
-                    await self.disconnect_client(client)
+            if self.batch_size and BATCH_MAX_FILES:
+                if not await self.transfer_batched(client, filtered_list):
                     return
+            elif not await self.transfer_sequential(client, filtered_list):
+                return
 
-                # Start measuring time for the file transfer
-                start_time = time.time()
-
-                # Start the dynamic timeout for file transfer
-                self.file_transfer_timeout_task = asyncio.create_task(self.start_dynamic_filetransfer_timeout())
-
-                # Wait for the file transfer to complete
-                await self.file_transfer_event.wait()
-                self.file_transfer_event.clear()  # Clear event for next transfer
-
-                # Calculate and print the elapsed time for the file transfer
-                elapsed_time = time.time() - start_time
-                print(f"{filename} ({filesize} bytes) took {elapsed_time:.2f} seconds.")
-
-                # Cancel any ongoing timeout task as EOF has been received
-                if self.file_transfer_timeout_task:
-                    self.file_transfer_timeout_task.cancel()
+            if self.abandoned:
+                return
 
-                # Reset EOF flag for the next file
-                self.eof_received = False
+            # Only advance the cursor once every listed file has been received, otherwise
+            # files that failed or were deferred would be left out of the next incremental listing
+            if self.listing_cursor is not None and not self.transfer_failed and not self.transfer_deferred:
+                await asyncio.to_thread(store_sync_cursor, self.address, self.listing_cursor, id, self.full_listing)
 
         except BleakError as e:
-            print(f"Error during BLE interaction: {e}")
+            event_log.error('ble.connect', f"Error during BLE interaction: {e}")
             await self.disconnect_client(client)
         except asyncio.TimeoutError:
-            print("File transfer timed out.")
+            event_log.warning('ble.transfer', "File transfer timed out.")
         except Exception as e:
-            print(f"Unexpected error: {e}")
+            event_log.error('ble.connect', f"Unexpected error: {e}")
             await self.disconnect_client(client)
         finally:
+            # A file still open here was interrupted; never leave it behind as a partial
+            self.discard_current_file()
+            self.release_reservations()
             # Stop notifications and clean up if necessary
             try:
                 await client.stop_notify(CHARACTERISTIC_UUID_FILENAME)
                 await client.stop_notify(CHARACTERISTIC_UUID_FILETRANSFER)
             except BleakError as e:
-                print(f"Error stopping notifications: {e}")
-            print("Notifications stopped and cleanup complete.")
+                event_log.warning('ble.connect', f"Error stopping notifications: {e}")
+            # History is written off the event loop so other connections' notifications aren't held up
+            await asyncio.to_thread(self.record_link_stats)
+            await asyncio.to_thread(record_file_transfers, self.transfers)
+            await asyncio.to_thread(record_received_files, self.received_files)
+            event_log.debug('ble.connect', "Notifications stopped and cleanup complete.")
+
+    async def transfer_sequential(self, client, files):
+        """Requests files one at a time, waiting for each EOF. Returns False if the connection was lost."""
+        for i, (filename, filesize) in enumerate(files):
+            if self.abandoned:
+                return False
+            if not await self.admit_files([(filename, filesize)]):
+                self.defer_files(files[i:])
+                break
+            event_log.debug('ble.transfer', "Requesting file", filename=filename)
+            id_directory = os.path.join(self.base_directory, self.device_id)
+            self.current_file_path = os.path.join(id_directory, filename)
+            try:
+                self.current_file = ReceiveFile(self.current_file_path, filesize)
+            except OSError as e:
+                event_log.error('ble.transfer', f"Failed to open file {filename} for writing: {e}")
+                continue
+            finally:
+                self.release_reservation(filename)
+
+            try:
+                await client.write_gatt_char(CHARACTERISTIC_UUID_FILENAME, filename.encode('utf-8'))  # Send filename without MAC address
+            except BleakError as e:
+                event_log.error('ble.transfer', f"Error during GATT write operation: {e}")
+                self.discard_current_file()
+                await self.disconnect_client(client)
+                return False
+
+            # Start measuring time for the file transfer
+            start_time = time.time()
+            bytes_before = self.bytes_received
+            upload_state = upload_scheduler.upload_state()
+            failed_before = self.transfer_failed
+
+            # Start the dynamic timeout for file transfer
+            self.file_transfer_timeout_task = asyncio.create_task(self.start_dynamic_filetransfer_timeout())
+
+            # Wait for the file transfer to complete
+            await self.file_transfer_event.wait()
+            self.file_transfer_event.clear()  # Clear event for next transfer
+
+            # Calculate and print the elapsed time for the file transfer
+            elapsed_time = time.time() - start_time
+            self.transfer_seconds += elapsed_time
+            if not self.eof_received:
+                self.transfer_failed = True
+            file_failed = self.transfer_failed and not failed_before
+            self.record_transfer(filename, filesize, self.bytes_received - bytes_before, elapsed_time,
+                                 self.eof_received and not file_failed, upload_state)
+
+            # Cancel any ongoing timeout task as EOF has been received
+            if self.file_transfer_timeout_task:
+                self.file_transfer_timeout_task.cancel()
+
+            # Reset EOF flag for the next file
+            self.eof_received = False
+        return True
+
+    async def transfer_batched(self, client, files):
+        """Requests files a window at a time and lets the peripheral stream each window back to back.
+
+        Removes the request/EOF round trip between files; per-file durations run
+        from header to EOF, and the connection's throughput counts the whole window.
+        Returns False if the connection was lost.
+        """
+        windows = list(self.batch_windows(files))
+        for i, window in enumerate(windows):
+            if self.abandoned:
+                return False
+            admitted = await self.admit_files(window)
+            if len(admitted) < len(window):
+                self.defer_files(window[len(admitted):] + [file for later in windows[i + 1:] for file in later])
+                window = admitted
+            if not window:
+                break
+            self.batch_pending = dict(window)
+            self.batch_current = None
+            self.batch_header = None
+            self.batch_discarded = 0
+            self.batch_upload_state = upload_scheduler.upload_state()
+            self.eof_received = False
+            self.file_transfer_event.clear()
+            request = control_message(CONTROL_BATCH, '|'.join(filename for filename, _ in window))
+            event_log.debug('ble.transfer', "Requesting batch", files=[filename for filename, _ in window])
+
+            start_time = time.time()
+            bytes_before = self.bytes_received
+            try:
+                await client.write_gatt_char(CHARACTERISTIC_UUID_FILENAME, request)
+            except BleakError as e:
+                event_log.error('ble.transfer', f"Error during GATT write operation: {e}")
+                self.batch_pending = {}
+                await self.disconnect_client(client)
+                return False
+
+            self.restart_transfer_timeout()
+            await self.file_transfer_event.wait()
+            self.file_transfer_event.clear()
+            if self.file_transfer_timeout_task:
+                self.file_transfer_timeout_task.cancel()
+
+            elapsed_time = time.time() - start_time
+            self.transfer_seconds += elapsed_time
+            # Whatever is still pending timed out before the peripheral sent it
+            for filename, filesize in self.batch_pending.items():
+                self.transfer_failed = True
+                self.record_transfer(filename, filesize, 0, 0.0, False, self.batch_upload_state)
+            self.batch_pending = {}
+            self.batch_current = None
+            self.release_reservations()
+            if self.batch_discarded:
+                event_log.warning('ble.transfer', f"Discarded {self.batch_discarded} bytes outside any announced file.",
+                                  mac_address=self.address, bytes=self.batch_discarded)
+            window_bytes = self.bytes_received - bytes_before
+            event_log.info('ble.transfer', f"Batch of {len(window)} files ({window_bytes} bytes) took {elapsed_time:.2f} seconds.",
+                           files=len(window), bytes=window_bytes, seconds=elapsed_time, throughput=window_bytes / max(elapsed_time, 1e-6))
+            if len(window) < len(windows[i]):
+                break
+        self.eof_received = False
+        return True
+
+    async def admit_files(self, files):
+        """Reserves disk space for files in order, reclaiming uploaded scans if needed.
+
+        Returns the files that were admitted, stopping at the first that doesn't fit.
+        """
+        admitted = []
+        for filename, filesize in files:
+            if not space_reservations.reserve(filesize):
+                await asyncio.to_thread(reclaim_space, filesize, (self.base_directory,))
+                if not space_reservations.reserve(filesize):
+                    break
+            self.reservations[filename] = filesize
+            admitted.append((filename, filesize))
+        return admitted
+
+    def release_reservation(self, filename):
+        size = self.reservations.pop(filename, None)
+        if size is not None:
+            space_reservations.release(size)
+
+    def release_reservations(self):
+        for filename in list(self.reservations):
+            self.release_reservation(filename)
+
+    def defer_files(self, files):
+        """Leaves files for a later connection because there isn't disk space to receive them."""
+        if not files:
+            return
+        self.transfer_deferred = True
+        space_reservations.record_deferred(files)
+        event_log.warning('storage.admission', f"Not enough disk space; deferring {len(files)} files ({sum(size for _, size in files)} bytes).",
+                          mac_address=self.address, files=len(files), bytes=sum(size for _, size in files))
+
+    def batch_windows(self, files):
+        """Splits files into batches that fit the peripheral's limit and a single attribute write."""
+        return pack_filenames(CONTROL_BATCH, files, min(self.batch_size, BATCH_MAX_FILES))
+
+    async def acknowledge_uploads(self, client):
+        """Tells the peripheral which of its listed files are safely in S3, so it can delete or archive them.
+
+        Only full listings are acknowledged from. An incremental listing names
+        files created or modified since the cursor, which are recorded instead
+        so that a file rewritten after its upload is never acknowledged. See
+        S3Manager.acknowledgeable_files for which files qualify. Acknowledged
+        files are dropped from this connection's file list.
+        """
+        if not self.full_listing:
+            await asyncio.to_thread(record_changed_files, self.device_id, [filename for filename, _ in self.file_list])
+            return
+        acknowledged = await asyncio.to_thread(acknowledgeable_files, self.device_id, self.file_list)
+        if not acknowledged:
+            return
+        for window in pack_filenames(CONTROL_DONE, acknowledged):
+            await client.write_gatt_char(CHARACTERISTIC_UUID_FILENAME,
+                                         control_message(CONTROL_DONE, '|'.join(filename for filename, _ in window)))
+            await asyncio.to_thread(mark_uploads_acknowledged, self.device_id, [filename for filename, _ in window])
+        acknowledged = set(acknowledged)
+        self.file_list = [file for file in self.file_list if file not in acknowledged]
+        event_log.info('ble.ack', f"Acknowledged {len(acknowledged)} uploaded files ({self.ack_action}).",
+                       mac_address=self.address, files=len(acknowledged), action=self.ack_action)
+
+    def record_link_stats(self):
+        """Persists this connection's throughput and drops stored link parameters if transfers failed with them."""
+        if self.transfer_seconds > 0:
+            update_link_stats(self.address, self.bytes_received, self.transfer_seconds)
+            event_log.info('ble.throughput', f"Link throughput: {self.bytes_received} bytes in {self.transfer_seconds:.2f} seconds",
+                           mac_address=self.address, bytes=self.bytes_received, seconds=self.transfer_seconds,
+                           throughput=self.bytes_received / self.transfer_seconds, payload_size=self.payload_size)
+        if self.transfer_failed:
+            clear_link_params(self.address)
 
     async def disconnect_client(self, client):
         try:
             await client.disconnect()
-            print("Disconnected gracefully.")
+            event_log.info('ble.connect', "Disconnected gracefully.")
+        except BleakError as e:
+            event_log.warning('ble.connect', f"Error during disconnection: {e}")
+
+async def keep_lease(mac_address, on_lost):
+    """Renews this gateway's lease on a device until cancelled, calling on_lost if another gateway has taken it."""
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        if not await asyncio.to_thread(claim_lease, mac_address):
+            event_log.warning('ble.lease', f"Lost lease on {mac_address}; abandoning transfer.", mac_address=mac_address)
+            await on_lost()
+            return
+
+async def transfer_device(adapter_pool, adapter, mac_address, base_directory, plan=None):
+    """Connects to one device through the given adapter and transfers its files.
+
+    With LEASE_ENABLED the device is only connected to if this gateway can
+    claim its lease, so overlapping gateways split devices between them.
+    Returns True if the device was connected and its files were processed.
+    """
+    async with adapter.get_slots():
+        if LEASE_ENABLED and not await asyncio.to_thread(claim_lease, mac_address):
+            event_log.info('ble.lease', f"Skipping {mac_address}: leased by another gateway.", mac_address=mac_address)
+            adapter.metrics['leases_denied'] += 1
+            return False
+        event_log.info('ble.connect', f"Attempting to connect to ESP32: {mac_address}", mac_address=mac_address, adapter=adapter.name)
+        adapter.metrics['connections_attempted'] += 1
+        adapter.metrics['active_connections'] += 1
+        upload_scheduler.ble_transfer_started()
+        ble_client = BLEFileTransferClient(mac_address, base_directory, plan)
+        service_cache = adapter_pool.service_cache
+        client = None
+        started_at = time.time()
+        succeeded = False
+        used_cache = None
+        error = None
+
+        async def on_lease_lost():
+            ble_client.abandon()
+            if client is not None:
+                await ble_client.disconnect_client(client)
+
+        lease_keeper = asyncio.create_task(keep_lease(mac_address, on_lease_lost)) if LEASE_ENABLED else None
+        try:
+            ble_client.connect_started = time.monotonic()
+            client, used_cache = await adapter_pool.connect(adapter, mac_address, [SERVICE_UUID])
+            event_log.info('ble.connect', f"Connected to {mac_address}", mac_address=mac_address, used_cache=used_cache)
+            # Ensure the client is connected
+            if not client.is_connected:
+                event_log.warning('ble.connect', "Client is not connected after connection attempt. Skipping...")
+                adapter.metrics['connections_failed'] += 1
+                return False
+            await ble_client.notification_manager(client)
+            if ble_client.abandoned:
+                error = 'lease lost'
+                adapter.metrics['connections_failed'] += 1
+                return False
+
+            # Cached services are only trusted while subscribing with them keeps working
+            if ble_client.subscribed:
+                service_cache.store(mac_address, client, [CHARACTERISTIC_UUID_FILENAME, CHARACTERISTIC_UUID_FILETRANSFER])
+            else:
+                service_cache.invalidate(mac_address)
+            if ble_client.first_byte_latency is not None:
+                service_cache.record_latency(used_cache, ble_client.first_byte_latency)
+                event_log.info('ble.latency', f"Connect-to-first-byte: {1000 * ble_client.first_byte_latency:.0f} ms",
+                               mac_address=mac_address, used_cache=used_cache, seconds=ble_client.first_byte_latency)
+
+            await asyncio.to_thread(updateMAC, mac_address)  # Update MAC address after successful connection
+            if ble_client.device_id is not None:
+                await asyncio.to_thread(mark_device_synced, mac_address, ble_client.device_id)
+            adapter.metrics['connections_succeeded'] += 1
+            succeeded = True
+            return True
         except BleakError as e:
-            print(f"Error during disconnection: {e}")
+            event_log.error('ble.connect', f"Error during connection or BLE interaction: {e}")
+            error = str(e)
+        except Exception as e:
+            event_log.error('ble.connect', f"Unexpected error during connection: {e}")
+            error = str(e)
+        finally:
+            if lease_keeper is not None:
+                lease_keeper.cancel()
+                if not ble_client.abandoned:
+                    # Hold the lease a while after a sync so other gateways don't re-list the device right away
+                    await asyncio.to_thread(release_lease, mac_address, LEASE_HOLD_AFTER_SYNC_SECONDS if succeeded else 0)
+            await asyncio.to_thread(record_connection_attempt, mac_address, adapter.name, started_at,
+                                    (time.time() - started_at) * 1000, succeeded, used_cache, error)
+            if client is not None and client.is_connected:
+                await ble_client.disconnect_client(client)
+            upload_scheduler.ble_transfer_finished()
+            adapter.metrics['active_connections'] -= 1
+            adapter.metrics['bytes_received'] += ble_client.bytes_received
+            adapter.metrics['transfer_seconds'] += ble_client.transfer_seconds
+        adapter.metrics['connections_failed'] += 1
+        return False
+
+async def searchForLinks(adapter_pool=None, upload_queue=None):
+    """Runs one scan cycle: discovers devices, transfers their files and hands the scan directory to the uploader.
 
-async def searchForLinks():
+    Discovery runs on every adapter in the pool and each device is transferred on
+    the adapter it was assigned to, using that adapter's connection slots. When an
+    upload_queue is given the scan directory is queued for the runtime's upload
+    task instead of being uploaded before returning.
+    """
     settings = get_settings()
-    mac_address = None
-    ble_client = None
+    if adapter_pool is None:
+        adapter_pool = AdapterPool()
     base_directory = os.path.join(DATA_DIRECTORY, datetime.now().strftime('%Y%m%d%H%M%S'))
     os.makedirs(base_directory, exist_ok=True)
+    # Every device in this scan is keyed into the same DT_RULE time bucket, including when uploaded later
+    plan = ScanPlan.for_directory(base_directory)
+    plan.save(base_directory)
     devices_found = False
     try:
-        devices = await BleakScanner.discover(timeout=5)
-        if not devices:
-            print("No devices found.")
+        sightings = await adapter_pool.discover(timeout=5)
+        if not sightings:
+            event_log.info('ble.scan', "No devices found.")
             return
         
         # Extract MAC addresses of ESP32 devices
-        mac_addresses = [device.address for device in devices if device.name and settings['device_name_includes'] in device.name]
+        mac_addresses = [address for address, sighting in sightings.items() if sighting['name'] and settings['device_name_includes'] in sighting['name']]
         if not mac_addresses:
-            print("No devices found after name filter.")
+            event_log.info('ble.scan', "No devices found after name filter.")
             return
         
-        # Sort MAC addresses by least recently updated
-        sorted_mac_addresses = sortRecentMAC(mac_addresses)
-        
-        for mac_address in sorted_mac_addresses:
-            print(f"Attempting to connect to ESP32: {mac_address}")
-            ble_client = BLEFileTransferClient(mac_address, base_directory)
-            try:
-                async with BleakClient(mac_address) as client:
-                    print(f"Connected to {mac_address}")
-                    # Ensure the client is connected
-                    if not client.is_connected:
-                        print("Client is not connected after connection attempt. Skipping...")
-                        continue
-                    await ble_client.notification_manager(client)
-                    updateMAC(mac_address)  # Update MAC address after successful connection
-                    devices_found = True
-            except BleakError as e:
-                print(f"Error during connection or BLE interaction: {e}")
-            except Exception as e:
-                print(f"Unexpected error during connection: {e}")
+        await asyncio.to_thread(record_devices_seen, {address: sightings[address]['name'] for address in mac_addresses})
+
+        # Sort MAC addresses by least recently updated, then shard them across adapters
+        sorted_mac_addresses = await asyncio.to_thread(sortRecentMAC, mac_addresses)
+        assignments = adapter_pool.assign(sorted_mac_addresses, sightings)
+
+        results = await asyncio.gather(*(
+            transfer_device(adapter_pool, adapter, mac_address, base_directory, plan)
+            for adapter, assigned in assignments.items()
+            for mac_address in assigned
+        ))
+        devices_found = any(results)
     except BleakError as e:
-        print(f"Failed to connect or interact with device: {e}")
+        event_log.error('ble.scan', f"Failed to connect or interact with device: {e}")
     except Exception as e:
-        print(f"Unexpected error during device discovery: {e}")
+        event_log.error('ble.scan', f"Unexpected error during device discovery: {e}")
     finally:
         # Cleanup base directory if no files were transferred and no devices connected
         if os.path.exists(base_directory) and not devices_found:
-            if not os.listdir(base_directory):
-                os.rmdir(base_directory)
+            if set(os.listdir(base_directory)) <= {SCAN_PLAN_FILE}:
+                shutil.rmtree(base_directory)
         # Call upload_files if devices connected and files were transferred
         if devices_found and os.path.exists(base_directory):
             if settings['use_cloud']:
-                upload_files(base_directory)
+                if upload_queue is not None:
+                    await upload_queue.put(base_directory)
+                else:
+                    try:
+                        await asyncio.to_thread(process_scan, base_directory)
+                        await asyncio.to_thread(upload_files, base_directory)
+                    except Exception as e:
+                        # Unverified files aren't acknowledged, so the peripheral keeps them for a later scan
+                        event_log.error('s3.upload', f"Upload of {base_directory} failed: {e}", folder=base_directory)
             else:
-                print("Cloud storage is turned off.")
+                event_log.info('s3.upload', "Cloud storage is turned off.")
 
 if __name__ == "__main__":
     asyncio.run(searchForLinks())
@@ -0,0 +1,205 @@
+"""Runs the gateway as cooperating processes under a supervisor.
+
+collector  BLE discovery and transfers, settings sync and history compaction
+uploader   post-processing, S3 uploads and inventory sync, fed scan folders
+           through the durable upload queue in SQLite
+web        the Flask status server, serving snapshots the other workers publish
+
+Each worker is a separate interpreter, so upload checksumming, JSON work and
+Flask requests never hold the GIL against BLE notification callbacks. The
+supervisor restarts any worker that exits, with backoff.
+
+Usage: python ProcessManager.py
+"""
+import json
+import multiprocessing
+import os
+import signal
+import time
+from config import (WORKERS, WORKER_DIRECTORY, WORKER_RESTART_BACKOFF_SECONDS, WORKER_RESTART_BACKOFF_MAX_SECONDS,
+                    WORKER_STABLE_SECONDS, UPLOADER_NICE, EVENT_LOG_FILE)
+
+def write_snapshot(name, snapshot):
+    """Atomically replaces the worker's snapshot file so readers never see a partial write."""
+    os.makedirs(WORKER_DIRECTORY, exist_ok=True)
+    path = os.path.join(WORKER_DIRECTORY, f'{name}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f, default=str)
+    os.replace(path + '.tmp', path)
+
+def read_snapshot(name):
+    """Returns the last snapshot published by a worker, or {} if there is none yet."""
+    try:
+        with open(os.path.join(WORKER_DIRECTORY, f'{name}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+class WorkerSnapshots:
+    """Status and metrics for app.py when it runs as the web worker, read from the other workers' snapshots."""
+
+    def __init__(self, profile_request):
+        self.profile_request = profile_request
+
+    def status(self):
+        status = {'supervisor': read_snapshot('supervisor')}
+        for name in ('collector', 'uploader'):
+            snapshot = read_snapshot(name)
+            status[name] = dict(snapshot.get('status', {}), pid=snapshot.get('pid'), published_at=snapshot.get('published_at'))
+        return status
+
+    def adapters(self):
+        return read_snapshot('collector').get('adapters', {})
+
+    def service_cache(self):
+        return read_snapshot('collector').get('service_cache', {})
+
+    def scheduler(self):
+        return read_snapshot('uploader').get('scheduler', {})
+
+    def storage(self):
+        return read_snapshot('collector').get('storage', {})
+
+    def events(self, n=100, level=None, kind=None):
+        from EventLog import LEVELS
+
+        events = []
+        for name in ('collector', 'uploader'):
+            events += [dict(event, worker=name) for event in read_snapshot(name).get('events', [])]
+        if level is not None:
+            events = [event for event in events if LEVELS.get(event['level'], 0) >= level]
+        if kind:
+            events = [event for event in events if event['kind'].startswith(kind)]
+        events.sort(key=lambda event: event['time'])
+        return events[-n:]
+
+    def diagnostics(self):
+        return read_snapshot('collector').get('diagnostics', {})
+
+    def arm_profiler(self):
+        self.profile_request.set()
+
+    def profiler_status(self):
+        status = dict(self.diagnostics().get('profiler', {}))
+        status['armed'] = status.get('armed', False) or self.profile_request.is_set()
+        return status
+
+    def profile_result(self):
+        return read_snapshot('collector').get('profile')
+
+def run_worker(name, ble_transfers, profile_request, uploads):
+    """Entry point of a worker process."""
+    from EventLog import event_log
+
+    # Each worker writes its own event log; rotating one file from several processes is unsafe
+    root, extension = os.path.splitext(EVENT_LOG_FILE)
+    event_log.path = f'{root}-{name}{extension}'
+
+    if name == 'web':
+        import app
+        app.gateway = WorkerSnapshots(profile_request)
+        app.app.run(debug=False)
+        return
+
+    if name == 'uploader':
+        os.nice(UPLOADER_NICE)
+    from RuntimeManager import GatewayRuntime
+    GatewayRuntime(name, ble_transfers, profile_request, uploads).run()
+
+class Supervisor:
+    """Starts the gateway's workers and restarts any that exit until it is stopped."""
+
+    def __init__(self, names=WORKERS):
+        # spawn gives each worker a fresh interpreter rather than a copy of the supervisor's threads and connections
+        self.context = multiprocessing.get_context('spawn')
+        self.ble_transfers = self.context.Value('i', 0)
+        self.uploads = self.context.Value('i', 0)
+        self.profile_request = self.context.Event()
+        self.workers = {name: {'process': None, 'started_at': None, 'restarts': 0, 'exitcode': None,
+                               'backoff': WORKER_RESTART_BACKOFF_SECONDS, 'restart_at': 0.0}
+                        for name in names}
+        self.stopping = False
+
+    def start_worker(self, name):
+        from EventLog import event_log
+
+        worker = self.workers[name]
+        process = self.context.Process(target=run_worker, name=f'gateway-{name}',
+                                       args=(name, self.ble_transfers, self.profile_request, self.uploads))
+        process.start()
+        worker['process'] = process
+        worker['started_at'] = time.monotonic()
+        event_log.info('supervisor', f"Started {name} worker (pid {process.pid}).", worker=name, pid=process.pid)
+
+    def check_workers(self):
+        from EventLog import event_log
+
+        now = time.monotonic()
+        for name, worker in self.workers.items():
+            process = worker['process']
+            if process is not None and process.is_alive():
+                if now - worker['started_at'] >= WORKER_STABLE_SECONDS:
+                    worker['backoff'] = WORKER_RESTART_BACKOFF_SECONDS
+                continue
+            if process is not None:
+                # Just exited: schedule a restart, backing off if it keeps crashing
+                worker['exitcode'] = process.exitcode
+                worker['process'] = None
+                worker['restart_at'] = now + worker['backoff']
+                event_log.error('supervisor', f"{name} worker exited with code {process.exitcode}; restarting in {worker['backoff']} s.",
+                                worker=name, exitcode=process.exitcode)
+                worker['backoff'] = min(worker['backoff'] * 2, WORKER_RESTART_BACKOFF_MAX_SECONDS)
+                # A crashed worker can't mark its BLE transfers or uploads finished
+                counter = {'collector': self.ble_transfers, 'uploader': self.uploads}.get(name)
+                if counter is not None:
+                    with counter.get_lock():
+                        counter.value = 0
+            elif now >= worker['restart_at']:
+                worker['restarts'] += 1
+                self.start_worker(name)
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'workers': {
+                name: {
+                    'pid': worker['process'].pid if worker['process'] is not None else None,
+                    'alive': worker['process'] is not None and worker['process'].is_alive(),
+                    'restarts': worker['restarts'],
+                    'last_exitcode': worker['exitcode'],
+                }
+                for name, worker in self.workers.items()
+            },
+        }
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        from DBManager import enable_wal
+
+        # Workers read and write the database concurrently
+        enable_wal()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for name in self.workers:
+            self.start_worker(name)
+        try:
+            while not self.stopping:
+                self.check_workers()
+                write_snapshot('supervisor', self.snapshot())
+                time.sleep(1)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        processes = [worker['process'] for worker in self.workers.values() if worker['process'] is not None]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+
+if __name__ == "__main__":
+    Supervisor().run()
@@ -0,0 +1,304 @@
+import asyncio
+import os
+import threading
+from datetime import datetime
+from config import (DATETIME_FORMAT, SCAN_INTERVAL_SECONDS, SETTINGS_INTERVAL_SECONDS, HISTORY_COMPACT_INTERVAL_SECONDS,
+                    S3_INVENTORY_INTERVAL_SECONDS, WORKER_DIRECTORY, WORKER_SNAPSHOT_SECONDS, WORKER_SNAPSHOT_EVENTS,
+                    UPLOAD_QUEUE_POLL_SECONDS, UPLOAD_QUEUE_MAX_ATTEMPTS)
+from AdapterManager import AdapterPool
+from DBManager import (fetch_and_store_settings, subscribe_settings, compact_history, enqueue_upload, claim_upload,
+                       finish_upload, fail_upload, requeue_claimed_uploads, count_uploads, upload_retry_delay)
+from LinkBLE import searchForLinks
+from S3Manager import upload_files, sync_s3_inventory, upload_scheduler
+from FileManager import space_reservations
+from EventLog import event_log
+from Diagnostics import loop_lag_monitor, profiler, get_diagnostics
+from DataProcessor import process_scan
+from ProcessManager import write_snapshot
+
+# Roles a runtime can take: 'all' runs everything on one loop in this process;
+# 'collector' and 'uploader' are the two halves run by ProcessManager's workers.
+COLLECTOR_ROLES = ('all', 'collector')
+UPLOADER_ROLES = ('all', 'uploader')
+
+class UploadQueue(asyncio.Queue):
+    """In-process queue of scan folders waiting for upload.
+
+    Failed uploads are put back with the same backoff and attempt limit as
+    DurableUploadQueue, but retries waiting out their backoff are lost if the
+    process exits. There is one consumer per queue instance.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.scan_directory = None  # Scan handed out by the last get()
+        self.attempts = {}  # Scan directory -> failed attempts so far
+
+    async def get(self):
+        self.scan_directory = await super().get()
+        return self.scan_directory
+
+    async def task_finished(self):
+        self.attempts.pop(self.scan_directory, None)
+        self.scan_directory = None
+        self.task_done()
+
+    async def task_failed(self, error):
+        scan_directory = self.scan_directory
+        attempts = self.attempts.get(scan_directory, 0) + 1
+        if attempts >= UPLOAD_QUEUE_MAX_ATTEMPTS:
+            self.attempts.pop(scan_directory, None)
+            event_log.error('runtime', f"Giving up on uploading {scan_directory} after {attempts} attempts: {error}",
+                            folder=scan_directory, attempts=attempts)
+        else:
+            self.attempts[scan_directory] = attempts
+            delay = upload_retry_delay(attempts)
+            asyncio.get_running_loop().call_later(delay, self.put_nowait, scan_directory)
+            event_log.warning('runtime', f"Retrying upload of {scan_directory} in {delay} seconds.",
+                              folder=scan_directory, attempts=attempts)
+        self.scan_directory = None
+        self.task_done()
+
+class DurableUploadQueue:
+    """Queue of scan folders waiting for upload, kept in SQLite so it survives worker restarts.
+
+    Offers put(), get() and qsize() like asyncio.Queue, and reports the outcome
+    of the scan claimed by the last get() with task_finished() or task_failed(),
+    doing its SQLite writes off the event loop. There is one consumer per queue
+    instance; failed uploads are retried with backoff.
+    """
+
+    def __init__(self, poll_interval=UPLOAD_QUEUE_POLL_SECONDS):
+        self.poll_interval = poll_interval
+        self.job_id = None  # Job claimed by the last get()
+
+    async def put(self, scan_directory):
+        await asyncio.to_thread(enqueue_upload, scan_directory)
+
+    async def get(self):
+        while True:
+            job = await asyncio.to_thread(claim_upload)
+            if job is not None:
+                self.job_id, scan_directory = job
+                return scan_directory
+            await asyncio.sleep(self.poll_interval)
+
+    async def task_finished(self):
+        await asyncio.to_thread(finish_upload, self.job_id)
+        self.job_id = None
+
+    async def task_failed(self, error):
+        await asyncio.to_thread(fail_upload, self.job_id, error)
+        self.job_id = None
+
+    def qsize(self):
+        return count_uploads()
+
+class GatewayRuntime:
+    """Owns one long-lived event loop that runs settings sync, scanning and uploads as cooperating tasks.
+
+    Keeping the loop alive between cycles lets bleak reuse its BlueZ D-Bus
+    connection and per-adapter scanners, and lets uploads of one scan overlap the next scan.
+
+    With role 'collector' or 'uploader' only that half of the tasks runs, scans
+    are handed over through the durable upload queue, and the runtime publishes
+    status snapshots for the web worker. ble_transfers and uploads are the
+    supervisor's shared radio and upload counters, profile_request its
+    profiler trigger.
+    """
+
+    def __init__(self, role='all', ble_transfers=None, profile_request=None, uploads=None):
+        self.role = role
+        self.profile_request = profile_request
+        if ble_transfers is not None:
+            upload_scheduler.share_radio_state(ble_transfers, uploads)
+        self.loop = None
+        self.thread = None
+        self.adapter_pool = AdapterPool()
+        self.upload_queue = None
+        self.status = {
+            'started_at': None,
+            'settings_fetched_at': None,
+            'settings_changed_at': None,
+            'settings_changed_keys': [],
+            'scan_started_at': None,
+            'scan_finished_at': None,
+            'scans_completed': 0,
+            'uploads_completed': 0,
+            'upload_in_progress': None,
+            'history_compacted_at': None,
+            'inventory_synced_at': None,
+        }
+
+        subscribe_settings(self.on_settings_changed)
+
+    def on_settings_changed(self, settings, changed_keys):
+        # Scanning, uploads and purging read settings from memory on every use, so
+        # there is nothing to reload here beyond recording the change
+        self.status['settings_changed_at'] = now()
+        self.status['settings_changed_keys'] = sorted(changed_keys)
+
+    def start(self):
+        """Starts the runtime in a daemon thread so Flask can serve status from the main thread."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def get_status(self):
+        status = dict(self.status)
+        status['uploads_queued'] = self.upload_queue.qsize() if self.upload_queue is not None else 0
+        return status
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.status['started_at'] = now()
+        if self.role == 'all':
+            self.upload_queue = UploadQueue()
+        else:
+            self.upload_queue = DurableUploadQueue()
+        if self.role == 'uploader':
+            # Scans claimed by an uploader that crashed mid-upload are picked up again
+            requeued = await asyncio.to_thread(requeue_claimed_uploads)
+            if requeued:
+                event_log.warning('runtime', f"Requeued {requeued} interrupted uploads.")
+
+        # Settings are needed before the first scan; after that they refresh independently
+        await self.sync_settings()
+        tasks = [self.settings_task()]
+        if self.role in COLLECTOR_ROLES:
+            tasks += [self.scan_task(), self.history_task(), loop_lag_monitor.run()]
+        if self.role in UPLOADER_ROLES:
+            tasks += [self.upload_task(), self.inventory_task()]
+        if self.role != 'all':
+            tasks.append(self.snapshot_task())
+        await asyncio.gather(*tasks)
+
+    async def sync_settings(self):
+        await asyncio.to_thread(fetch_and_store_settings)
+        self.status['settings_fetched_at'] = now()
+
+    async def settings_task(self):
+        while True:
+            await asyncio.sleep(SETTINGS_INTERVAL_SECONDS)
+            try:
+                await self.sync_settings()
+            except Exception as e:
+                event_log.error('runtime', f"Unexpected error during settings sync: {e}")
+
+    async def scan_task(self):
+        while True:
+            self.status['scan_started_at'] = now()
+            if self.profile_request is not None and self.profile_request.is_set():
+                self.profile_request.clear()
+                profiler.arm()
+            if profiler.armed:
+                profiler.start()
+            try:
+                await searchForLinks(self.adapter_pool, self.upload_queue)
+            except Exception as e:
+                event_log.error('runtime', f"Unexpected error during scan: {e}")
+            if profiler.running:
+                profiler.stop()
+            self.status['scan_finished_at'] = now()
+            self.status['scans_completed'] += 1
+            await asyncio.sleep(SCAN_INTERVAL_SECONDS)
+
+    async def upload_task(self):
+        while True:
+            base_directory = await self.upload_queue.get()
+            self.status['upload_in_progress'] = base_directory
+            try:
+                await asyncio.to_thread(process_scan, base_directory)
+                await asyncio.to_thread(upload_files, base_directory)
+                self.status['uploads_completed'] += 1
+                await self.upload_queue.task_finished()
+            except Exception as e:
+                event_log.error('runtime', f"Unexpected error during upload of {base_directory}: {e}")
+                await self.upload_queue.task_failed(e)
+            finally:
+                self.status['upload_in_progress'] = None
+
+    async def history_task(self):
+        while True:
+            try:
+                connections, transfers = await asyncio.to_thread(compact_history)
+                if connections or transfers:
+                    event_log.info('db.history', f"Compacted {connections} connection attempts and {transfers} file transfers into daily history.")
+                self.status['history_compacted_at'] = now()
+            except Exception as e:
+                event_log.error('runtime', f"Unexpected error during history compaction: {e}")
+            await asyncio.sleep(HISTORY_COMPACT_INTERVAL_SECONDS)
+
+    async def inventory_task(self):
+        while True:
+            try:
+                await asyncio.to_thread(sync_s3_inventory)
+                self.status['inventory_synced_at'] = now()
+            except Exception as e:
+                event_log.error('runtime', f"Unexpected error during S3 inventory sync: {e}")
+            await asyncio.sleep(S3_INVENTORY_INTERVAL_SECONDS)
+
+    async def snapshot_task(self):
+        metrics = RuntimeMetrics(self)
+        while True:
+            try:
+                snapshot = await asyncio.to_thread(metrics.snapshot)
+                await asyncio.to_thread(write_snapshot, self.role, snapshot)
+            except Exception as e:
+                event_log.error('runtime', f"Unexpected error publishing status snapshot: {e}")
+            await asyncio.sleep(WORKER_SNAPSHOT_SECONDS)
+
+class RuntimeMetrics:
+    """Status and metrics of the gateway runtime in this process, as served by app.py."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def status(self):
+        return self.runtime.get_status()
+
+    def adapters(self):
+        return self.runtime.adapter_pool.get_metrics()
+
+    def service_cache(self):
+        return self.runtime.adapter_pool.service_cache.get_metrics()
+
+    def scheduler(self):
+        return upload_scheduler.get_metrics()
+
+    def storage(self):
+        return space_reservations.get_metrics()
+
+    def events(self, n=100, level=None, kind=None):
+        return event_log.recent(n, level, kind)
+
+    def diagnostics(self):
+        return get_diagnostics()
+
+    def arm_profiler(self):
+        profiler.arm()
+
+    def profiler_status(self):
+        return profiler.get_status()
+
+    def profile_result(self):
+        return profiler.result
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'published_at': now(),
+            'status': self.status(),
+            'adapters': self.adapters(),
+            'service_cache': self.service_cache(),
+            'scheduler': self.scheduler(),
+            'storage': self.storage(),
+            'events': self.events(WORKER_SNAPSHOT_EVENTS),
+            'diagnostics': self.diagnostics(),
+            'profile': self.profile_result(),
+        }
+
+def now():
+    return datetime.now().strftime(DATETIME_FORMAT)
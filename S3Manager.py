@@ -1,111 +1,511 @@
+import base64
+import hashlib
+import json
 import os
-import boto3
 import sqlite3
+import threading
+import time
 from datetime import datetime
-from config import DATABASE_FILE, DATETIME_FORMAT
-from DBManager import get_settings
+from config import DATABASE_FILE, DATETIME_FORMAT, SCAN_PLAN_FILE, S3_INVENTORY_FULL_SYNC_HOURS, UPLOAD_RATE_LIMIT_BPS, UPLOAD_COEXISTENCE, UPLOAD_COEXISTENCE_RATE_BPS, UPLOAD_MAX_CONCURRENCY
+from DBManager import get_settings, subscribe_settings, fetch_and_store_settings, get_device_ids, record_upload_confirmation, get_received_sha256
+from EventLog import event_log
+from DataProcessor import replaced_csvs
+
+# Error codes meaning the stored AWS keys are stale rather than the upload being bad
+CREDENTIAL_ERROR_CODES = {'InvalidAccessKeyId', 'SignatureDoesNotMatch', 'ExpiredToken', 'InvalidToken'}
+
+# boto3/botocore are imported on first use; they dominate import time and a
+# one-shot run should be scanning before they load.
+# The S3 client is created once per set of credentials and dropped as soon as they change
+s3_client = None
+transfer_config = None
+s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Returns the S3 client for the current AWS keys, creating it if needed."""
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            import boto3
+
+            settings = get_settings()
+            # Create a session using the provided access and secret keys
+            session = boto3.Session(
+                aws_access_key_id=settings['aws_access_key_id'],
+                aws_secret_access_key=settings['aws_secret_access_key']
+            )
+            s3_client = session.client('s3')
+        return s3_client
+
+def reset_s3_client(settings=None, changed_keys=None):
+    """Drops the cached S3 client when the AWS keys change so the next upload uses the new ones."""
+    global s3_client
+    if changed_keys is None or changed_keys & {'aws_access_key_id', 'aws_secret_access_key'}:
+        with s3_client_lock:
+            s3_client = None
+
+subscribe_settings(reset_s3_client)
+
+class UploadScheduler:
+    """Rate-limits uploads and keeps them out of the way of BLE transfers.
+
+    LinkBLE brackets each BLE connection with ble_transfer_started/finished.
+    While any are running, uploads are limited to the coexistence rate
+    ('throttle') or held before starting the next file ('pause'); otherwise
+    they run at rate_limit, or unthrottled if it is 0.
+
+    When BLE transfers and uploads run in different processes, both share
+    counters of running BLE transfers and uploads through share_radio_state, so
+    uploads see the radio and BLE transfer history sees the uploads.
+    """
+
+    def __init__(self, rate_limit=UPLOAD_RATE_LIMIT_BPS, coexistence=UPLOAD_COEXISTENCE, coexistence_rate=UPLOAD_COEXISTENCE_RATE_BPS):
+        self.rate_limit = rate_limit
+        self.coexistence = coexistence
+        self.coexistence_rate = coexistence_rate
+        self.condition = threading.Condition()
+        self.ble_transfers = 0
+        self.shared_ble_transfers = None  # multiprocessing.Value counting BLE transfers in every process
+        self.uploads = 0
+        self.shared_uploads = None  # multiprocessing.Value counting uploads in every process
+        self.next_send = 0.0  # Monotonic time at which the bytes consumed so far are paid for
+        self.metrics = {'bytes_uploaded': 0, 'throttled_seconds': 0.0, 'paused_seconds': 0.0}
+
+    def share_radio_state(self, shared_ble_transfers, shared_uploads=None):
+        self.shared_ble_transfers = shared_ble_transfers
+        self.shared_uploads = shared_uploads
+
+    def ble_transfer_started(self):
+        with self.condition:
+            self.ble_transfers += 1
+        if self.shared_ble_transfers is not None:
+            with self.shared_ble_transfers.get_lock():
+                self.shared_ble_transfers.value += 1
+
+    def ble_transfer_finished(self):
+        with self.condition:
+            self.ble_transfers -= 1
+            self.condition.notify_all()
+        if self.shared_ble_transfers is not None:
+            with self.shared_ble_transfers.get_lock():
+                self.shared_ble_transfers.value -= 1
+
+    def radio_transfers(self):
+        """BLE transfers running now, in this process or, if shared, any process."""
+        if self.shared_ble_transfers is not None:
+            return self.shared_ble_transfers.value
+        return self.ble_transfers
+
+    def running_uploads(self):
+        """Uploads running now, in this process or, if shared, any process."""
+        if self.shared_uploads is not None:
+            return self.shared_uploads.value
+        return self.uploads
+
+    def upload_state(self):
+        """Describes what uploads are doing right now, for tagging BLE transfer history."""
+        if not self.running_uploads():
+            return 'idle'
+        return 'unthrottled' if self.coexistence == 'off' else 'throttled'
+
+    def current_rate(self):
+        if self.radio_transfers() and self.coexistence != 'off':
+            return self.coexistence_rate
+        return self.rate_limit
+
+    def wait_for_radio(self):
+        """In 'pause' mode, blocks before an upload starts until no BLE transfer is running."""
+        if self.coexistence != 'pause':
+            return
+        with self.condition:
+            started = time.monotonic()
+            while self.radio_transfers():
+                # Transfers finishing in another process can't notify, so poll as well
+                self.condition.wait(0.5)
+            self.metrics['paused_seconds'] += time.monotonic() - started
+
+    def consume(self, bytes_amount):
+        """boto3 progress callback: sleeps as needed to keep uploads at the current rate, allowing 1 s of burst."""
+        with self.condition:
+            self.metrics['bytes_uploaded'] += bytes_amount
+            rate = self.current_rate()
+            if not rate:
+                return
+            now = time.monotonic()
+            self.next_send = max(self.next_send, now - 1.0) + bytes_amount / rate
+            delay = self.next_send - now
+        if delay > 0:
+            time.sleep(delay)
+            with self.condition:
+                self.metrics['throttled_seconds'] += delay
+
+    def upload_started(self):
+        with self.condition:
+            self.uploads += 1
+        if self.shared_uploads is not None:
+            with self.shared_uploads.get_lock():
+                self.shared_uploads.value += 1
+
+    def upload_finished(self):
+        with self.condition:
+            self.uploads -= 1
+        if self.shared_uploads is not None:
+            with self.shared_uploads.get_lock():
+                self.shared_uploads.value -= 1
+
+    def get_metrics(self):
+        with self.condition:
+            metrics = dict(self.metrics)
+            metrics.update({
+                'coexistence': self.coexistence,
+                'ble_transfers': self.radio_transfers(),
+                'uploads': self.running_uploads(),
+                'current_rate': self.current_rate(),
+            })
+        return metrics
+
+upload_scheduler = UploadScheduler()
+
+def get_transfer_config():
+    global transfer_config
+    if transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        transfer_config = TransferConfig(max_concurrency=UPLOAD_MAX_CONCURRENCY)
+    return transfer_config
 
 # Helper function to format datetime based on DT_RULE
-def format_datetime():
-    settings = get_settings()
-    now = datetime.now()
-    if settings['dt_rule'] == 'seconds':
+def format_datetime(now=None, dt_rule=None):
+    if now is None:
+        now = datetime.now()
+    if dt_rule is None:
+        dt_rule = get_settings()['dt_rule']
+    if dt_rule == 'seconds':
         return now.strftime('%Y%m%d%H%M%S')
-    elif settings['dt_rule'] == 'hours':
+    elif dt_rule == 'hours':
         return now.strftime('%Y%m%d%H')
-    elif settings['dt_rule'] == 'days':
+    elif dt_rule == 'days':
         return now.strftime('%Y%m%d')
-    elif settings['dt_rule'] == 'weeks':
+    elif dt_rule == 'weeks':
         return now.strftime('%Y%U')
-    elif settings['dt_rule'] == 'months':
+    elif dt_rule == 'months':
         return now.strftime('%Y%m')
-    elif settings['dt_rule'] == 'years':
+    elif dt_rule == 'years':
         return now.strftime('%Y')
-    elif settings['dt_rule'] == 'never':
+    elif dt_rule == 'never':
         return ''
     else:
         raise ValueError("Invalid DT_RULE value")
 
-def build_s3_filename(id, filename):
-    """Builds the S3 filename string based on DT_RULE."""
-    datetime_str = format_datetime()
+def build_s3_filename(id, filename, datetime_str=None):
+    """Builds the S3 filename string based on DT_RULE, or on a time bucket already fixed by a ScanPlan."""
+    if datetime_str is None:
+        datetime_str = format_datetime()
     if datetime_str:
         return f"{id}/{datetime_str}/{filename}"
     else:
         return f"{id}/{filename}"
 
-# def update_local_database():
-#     """Updates the local database to reflect what is in the S3 bucket."""
-#     ensure_database_exists()
-#     conn = sqlite3.connect(DATABASE_FILE)
-#     cursor = conn.cursor()
-
-#     # Get the list of files from S3
-#     try:
-#         s3_files = s3.list_objects_v2(Bucket=settings['bucket_name']).get('Contents', [])
-#     except s3.exceptions.ClientError as e:
-#         if e.response['Error']['Code'] == 'AllAccessDisabled':
-#             print("Access to the S3 bucket is disabled. Please check permissions.")
-#             return
-#         else:
-#             raise
-    
-#     # Update the s3_files table to reflect the current state of the S3 bucket
-#     existing_files = {row[0]: row[1] for row in cursor.execute('SELECT filename, size FROM s3_files').fetchall()}
-#     current_files = {file['Key']: file['Size'] for file in s3_files}
-
-#     # Insert or update entries from S3
-#     for filename, size in current_files.items():
-#         updated_at = datetime.now().strftime(DATETIME_FORMAT)
-#         if filename in existing_files:
-#             if existing_files[filename] != size:
-#                 cursor.execute('''
-#                     UPDATE s3_files SET size = ?, updated_at = ? WHERE filename = ?
-#                 ''', (size, updated_at, filename))
-#                 print(f"Updated file in database: {filename}")
-#         else:
-#             cursor.execute('''
-#                 INSERT INTO s3_files (filename, size, updated_at)
-#                 VALUES (?, ?, ?)
-#             ''', (filename, size, updated_at))
-#             print(f"Added to database: {filename}")
-
-#     # Delete entries that are no longer in S3
-#     for filename in existing_files:
-#         if filename not in current_files:
-#             cursor.execute('DELETE FROM s3_files WHERE filename = ?', (filename,))
-#             print(f"Deleted from database: {filename}")
-    
-#     conn.commit()
-#     conn.close()
-
-# def needFile(id, filename, size):
-#     """Checks if a file with the given filename and size is needed in the local cache."""
-#     conn = sqlite3.connect(DATABASE_FILE)
-#     cursor = conn.cursor()
-
-#     # Build the filename string
-#     s3_filename = build_s3_filename(id, filename)
-
-#     # Check if the file exists with the same size
-#     cursor.execute('SELECT filename, size FROM s3_files WHERE filename = ? AND size = ?', (s3_filename, size))
-#     result = cursor.fetchone()
-#     conn.close()
-
-    # If no exact match is found, return True
-    return result is None
+class ScanPlan:
+    """Fixes the S3 key layout for every file of one scan.
+
+    The DT_RULE time bucket is computed once, from the scan directory's
+    timestamp, and saved in the scan directory's SCAN_PLAN_FILE, so the keys
+    checked against the Hublink API while listing and the keys used at upload
+    time agree even if the upload runs hours later, in another process, or
+    after DT_RULE has changed.
+    """
+
+    def __init__(self, scan_id, scan_time=None, dt_rule=None, datetime_str=None):
+        self.scan_id = scan_id
+        self.scan_time = scan_time or datetime.now()
+        self.dt_rule = dt_rule or get_settings()['dt_rule']
+        self.datetime_str = format_datetime(self.scan_time, self.dt_rule) if datetime_str is None else datetime_str
+
+    @classmethod
+    def for_directory(cls, scan_directory):
+        """Returns the plan saved in a scan directory, or plans one from its name (%Y%m%d%H%M%S)."""
+        scan_id = os.path.basename(os.path.normpath(scan_directory))
+        try:
+            with open(os.path.join(scan_directory, SCAN_PLAN_FILE)) as f:
+                saved = json.load(f)
+            return cls(scan_id, dt_rule=saved['dt_rule'], datetime_str=saved['datetime_bucket'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            event_log.warning('s3.plan', f"Ignoring unreadable scan plan in {scan_directory}: {e}")
+        try:
+            scan_time = datetime.strptime(scan_id, '%Y%m%d%H%M%S')
+        except ValueError:
+            scan_time = None
+        return cls(scan_id, scan_time)
+
+    def save(self, scan_directory):
+        """Records the plan in the scan directory so uploads of the scan reuse it."""
+        path = os.path.join(scan_directory, SCAN_PLAN_FILE)
+        with open(path + '.part', 'w') as f:
+            json.dump({'scan_id': self.scan_id, 'dt_rule': self.dt_rule, 'datetime_bucket': self.datetime_str}, f)
+        os.replace(path + '.part', path)
+
+    def key(self, id, filename):
+        return build_s3_filename(id, filename, self.datetime_str)
+
+    def keys(self, id, filenames):
+        """Returns the S3 keys for a batch of filenames from one device."""
+        return [self.key(id, filename) for filename in filenames]
+
+    def manifest_key(self, id):
+        return f"{id}/manifests/{self.scan_id}.json"
+
+    def latest_manifest_key(self, id):
+        return f"{id}/manifests/latest.json"
+
+def sync_s3_inventory(device_ids=None):
+    """Mirrors the bucket's objects for the given device IDs (default: every synced device) into s3_files.
+
+    Each device prefix is listed page by page starting after the last key seen
+    on the previous sync, so only new objects are fetched; S3 lists keys in
+    order and new uploads sort after older time buckets. Every
+    S3_INVENTORY_FULL_SYNC_HOURS the prefix is listed in full instead and rows
+    for objects no longer in S3 are removed.
+    """
+    from botocore.exceptions import ClientError
+
+    settings = get_settings()
+    if not settings.get('use_cloud') or not settings.get('bucket_name'):
+        return
+    if device_ids is None:
+        device_ids = get_device_ids()
+
+    s3 = get_s3_client()
+    conn = sqlite3.connect(DATABASE_FILE)
+    try:
+        for device_id in device_ids:
+            sync_s3_prefix(s3, conn, settings['bucket_name'], device_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'AllAccessDisabled':
+            event_log.error('s3.inventory', "Access to the S3 bucket is disabled. Please check permissions.")
+        else:
+            raise
+    finally:
+        conn.close()
+
+def sync_s3_prefix(s3, conn, bucket_name, device_id):
+    """Mirrors one device prefix, committing after every page so the SQLite write lock is never held across a network fetch."""
+    prefix = f"{device_id}/"
+    cursor = conn.cursor()
+    now = int(time.time())
+    cursor.execute('SELECT last_key, full_synced_at FROM s3_sync_markers WHERE prefix = ?', (prefix,))
+    row = cursor.fetchone()
+    last_key, full_synced_at = row if row else (None, None)
+    full_sync = full_synced_at is None or now - full_synced_at >= S3_INVENTORY_FULL_SYNC_HOURS * 3600
+
+    list_kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if last_key and not full_sync:
+        list_kwargs['StartAfter'] = last_key
+
+    updated_at = datetime.now().strftime(DATETIME_FORMAT)
+    seen = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(**list_kwargs):
+        objects = page.get('Contents', [])
+        cursor.executemany('''
+            INSERT INTO s3_files (filename, size, updated_at, device_id, basename)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(filename) DO UPDATE SET size = excluded.size, updated_at = excluded.updated_at,
+                -- An object that changed size was overwritten, so the hash this gateway verified no longer holds
+                sha256 = CASE WHEN s3_files.size = excluded.size THEN s3_files.sha256 END
+        ''', [(obj['Key'], obj['Size'], updated_at, device_id, obj['Key'].rsplit('/', 1)[-1]) for obj in objects])
+        conn.commit()
+        if objects:
+            last_key = max(last_key or '', objects[-1]['Key'])
+        seen += len(objects)
+
+    if full_sync:
+        # Objects not touched by a full listing have been deleted from S3
+        cursor.execute('DELETE FROM s3_files WHERE device_id = ? AND updated_at < ?', (device_id, updated_at))
+        full_synced_at = now
+    cursor.execute('''
+        INSERT INTO s3_sync_markers (prefix, last_key, synced_at, full_synced_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(prefix) DO UPDATE SET
+            last_key = excluded.last_key,
+            synced_at = excluded.synced_at,
+            full_synced_at = excluded.full_synced_at
+    ''', (prefix, last_key, now, full_synced_at))
+    conn.commit()
+    event_log.info('s3.inventory', f"S3 inventory {'full' if full_sync else 'incremental'} sync of {prefix}: {seen} objects.", prefix=prefix, objects=seen, full_sync=full_sync)
+
+def files_in_inventory(id, file_list):
+    """Returns the set of indexes in file_list, a list of (filename, size), that the local S3 mirror already holds.
+
+    A file counts as uploaded if an object with the same name and size exists
+    under the device's prefix in any time bucket.
+    """
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT basename, size FROM s3_files WHERE device_id = ?', (id,))
+    uploaded = set(cursor.fetchall())
+    conn.close()
+    return {i for i, (filename, size) in enumerate(file_list) if (filename, size) in uploaded}
+
+def acknowledgeable_files(id, file_list):
+    """Returns the files in file_list, a list of (filename, size), that the peripheral may be told are safely in S3.
+
+    A file qualifies only if this gateway verified its upload and the local
+    S3 mirror still holds the object it was confirmed under, such as the
+    columnar copy replacing a CSV, with the SHA-256 it was verified with. A
+    same-named object of the same size uploaded elsewhere isn't enough, since
+    the peripheral deletes what it is told is safe.
+
+    A file an incremental listing showed created or modified after its last
+    confirmed upload is held back, since the peripheral may have rewritten it
+    at the same size and S3 then holds different content.
+    """
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT c.filename, c.size, MAX(c.confirmed_at) FROM upload_confirmations c
+        JOIN s3_files s ON s.filename = c.s3_key AND s.sha256 = c.object_sha256
+        WHERE c.device_id = ?
+        GROUP BY c.filename, c.size
+    ''', (id,))
+    confirmed = {(filename, size): confirmed_at for filename, size, confirmed_at in cursor.fetchall()}
+    cursor.execute('SELECT filename, listed_at FROM changed_files WHERE device_id = ?', (id,))
+    changed = dict(cursor.fetchall())
+    conn.close()
+
+    acknowledgeable = []
+    for file in file_list:
+        if file not in confirmed:
+            continue
+        changed_at = changed.get(file[0])
+        if changed_at is not None and confirmed[file] < changed_at:
+            continue
+        acknowledgeable.append(file)
+    return acknowledgeable
+
+def scan_in_inventory(scan_directory):
+    """Returns True if every file in the scan folder is in the local S3 mirror.
+
+    As in files_in_inventory, a file counts as uploaded if an object with the
+    same name and size exists under the device's prefix in any time bucket.
+    """
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    try:
+        for id in os.listdir(scan_directory):
+            id_path = os.path.join(scan_directory, id)
+            if not os.path.isdir(id_path):
+                continue
+            for filename in os.listdir(id_path):
+                file_path = os.path.join(id_path, filename)
+                if not os.path.isfile(file_path):
+                    continue
+                cursor.execute('SELECT 1 FROM s3_files WHERE device_id = ? AND basename = ? AND size = ?',
+                               (id, filename, os.path.getsize(file_path)))
+                if cursor.fetchone() is None:
+                    return False
+        return True
+    finally:
+        conn.close()
+
+def credential_error_code(error):
+    """Returns the AWS error code if error means the stored keys are stale, otherwise None.
+
+    S3Transfer wraps the ClientError of a failed upload in S3UploadFailedError,
+    keeping it only as the exception context and in the message.
+    """
+    from botocore.exceptions import ClientError
+
+    cause = error if isinstance(error, ClientError) else (error.__cause__ or error.__context__)
+    if isinstance(cause, ClientError):
+        code = cause.response.get('Error', {}).get('Code')
+        return code if code in CREDENTIAL_ERROR_CODES else None
+    message = str(error)
+    return next((code for code in CREDENTIAL_ERROR_CODES if f'({code})' in message), None)
+
+def upload_file(file_path, s3_key):
+    """Uploads one file through the upload scheduler, refreshing settings and retrying once if S3 rejects the stored AWS keys."""
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import ClientError
+
+    upload_scheduler.wait_for_radio()
+    # S3 verifies the SHA-256 checksum on receipt and stores it for verify_upload
+    extra_args = {'ChecksumAlgorithm': 'SHA256'}
+    try:
+        get_s3_client().upload_file(file_path, get_settings('bucket_name'), s3_key, ExtraArgs=extra_args,
+                                    Callback=upload_scheduler.consume, Config=get_transfer_config())
+    except (S3UploadFailedError, ClientError) as e:
+        code = credential_error_code(e)
+        if code is None:
+            raise
+        event_log.warning('s3.upload', f"AWS credentials rejected ({code}). Refreshing settings.")
+        fetch_and_store_settings(force=True)
+        reset_s3_client()
+        get_s3_client().upload_file(file_path, get_settings('bucket_name'), s3_key, ExtraArgs=extra_args,
+                                    Callback=upload_scheduler.consume, Config=get_transfer_config())
+
+def verify_upload(s3_key, size, sha256):
+    """Returns True if the object in S3 has the expected size and SHA-256.
+
+    Multipart uploads only expose a checksum of their part checksums, which S3
+    has already verified part by part, so for those the size is compared alone.
+    """
+    from botocore.exceptions import ClientError
+
+    try:
+        head = get_s3_client().head_object(Bucket=get_settings('bucket_name'), Key=s3_key, ChecksumMode='ENABLED')
+    except ClientError as e:
+        event_log.error('s3.verify', f"Unable to verify {s3_key}: {e}")
+        return False
+    if head.get('ContentLength') != size:
+        event_log.error('s3.verify', f"{s3_key} is {head.get('ContentLength')} bytes in S3, expected {size}.", key=s3_key)
+        return False
+    checksum = head.get('ChecksumSHA256')
+    if checksum and '-' not in checksum and checksum != base64.b64encode(bytes.fromhex(sha256)).decode():
+        event_log.error('s3.verify', f"{s3_key} checksum in S3 does not match the local file.", key=s3_key)
+        return False
+    return True
+
+def record_in_inventory(s3_key, size, sha256=None):
+    """Adds a just-uploaded object to the local S3 mirror without waiting for the next inventory sync."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO s3_files (filename, size, updated_at, device_id, basename, sha256)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(filename) DO UPDATE SET size = excluded.size, updated_at = excluded.updated_at, sha256 = excluded.sha256
+    ''', (s3_key, size, datetime.now().strftime(DATETIME_FORMAT), s3_key.split('/', 1)[0], s3_key.rsplit('/', 1)[-1], sha256))
+    conn.commit()
+    conn.close()
+
+def find_uploaded_content(id, filename, size, sha256):
+    """Returns the key of an object this gateway already uploaded with the same device, name and content, or None."""
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT filename FROM s3_files WHERE device_id = ? AND basename = ? AND size = ? AND sha256 = ? LIMIT 1
+    ''', (id, filename, size, sha256))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
 
 def upload_files(data_directory):
     """Uploads files from the local directory if they are not already in S3 and updates the database."""
-    settings = get_settings()
-    # Create a session using the provided access and secret keys
-    session = boto3.Session(
-        aws_access_key_id=settings['aws_access_key_id'],
-        aws_secret_access_key=settings['aws_secret_access_key']
-    )
+    upload_scheduler.upload_started()
+    try:
+        upload_directory(data_directory)
+    finally:
+        upload_scheduler.upload_finished()
+
+def upload_directory(data_directory):
+    """Uploads and verifies every device's files in a scan folder.
 
-    # Create an S3 client using the session
-    s3 = session.client('s3')
+    Raises RuntimeError if any upload failed verification, after the rest were
+    uploaded, so the upload queue retries the scan with backoff; files already
+    verified are then skipped as identical content.
+    """
+    plan = ScanPlan.for_directory(data_directory)
+    unverified = []
 
     # Iterate through each MAC address folder
     for id in os.listdir(data_directory):
@@ -113,14 +513,141 @@ def upload_files(data_directory):
         if not os.path.isdir(id_path):
             continue
 
+        # CSVs replaced by their columnar copy aren't uploaded themselves
+        replaced = replaced_csvs(id_path)
+        filenames = sorted(filename for filename in os.listdir(id_path)
+                           if os.path.isfile(os.path.join(id_path, filename)) and filename not in replaced)
+        if not filenames:
+            continue
+
         # Iterate through each file in the MAC address folder
-        for filename in os.listdir(id_path):
+        entries = []
+        for filename, s3_key in zip(filenames, plan.keys(id, filenames)):
             file_path = os.path.join(id_path, filename)
-            if not os.path.isfile(file_path):
-                continue
+            stat = os.stat(file_path)
+            size = stat.st_size
+            # Files received over BLE were hashed as they streamed in
+            sha256 = get_received_sha256(file_path, size, stat.st_mtime) or file_sha256(file_path)
 
-            s3_key = build_s3_filename(id, filename)
+            # Content already uploaded from an earlier scan is listed in the manifest under its existing key
+            uploaded_key = find_uploaded_content(id, filename, size, sha256)
+            if uploaded_key is not None:
+                entries.append({'filename': filename, 'key': uploaded_key, 'size': size, 'sha256': sha256, 'deduplicated': True})
+                record_upload_confirmation(id, filename, size, sha256, uploaded_key)
+                event_log.info('s3.upload', f'Skipped {s3_key}: identical to {uploaded_key}', key=s3_key, existing_key=uploaded_key)
+                continue
 
             # Upload file to S3
-            s3.upload_file(file_path, settings['bucket_name'], s3_key)
-            print(f'Uploaded: {s3_key}')
\ No newline at end of file
+            upload_file(file_path, s3_key)
+            if not verify_upload(s3_key, size, sha256):
+                # Neither recorded nor acknowledged, so the peripheral keeps its copy
+                unverified.append(s3_key)
+                continue
+            record_in_inventory(s3_key, size, sha256)
+            # Only verified uploads are acknowledged to the peripheral, which may then delete them
+            record_upload_confirmation(id, filename, size, sha256, s3_key)
+            entries.append({'filename': filename, 'key': s3_key, 'size': size, 'sha256': sha256})
+            event_log.info('s3.upload', f'Uploaded: {s3_key}', key=s3_key)
+
+        replacements = []
+        uploaded = {entry['filename']: entry for entry in entries}
+        for filename, output in sorted(replaced.items()):
+            if output not in uploaded:
+                continue
+            file_path = os.path.join(id_path, filename)
+            stat = os.stat(file_path)
+            size = stat.st_size
+            # Files received over BLE were hashed as they streamed in
+            sha256 = get_received_sha256(file_path, size, stat.st_mtime) or file_sha256(file_path)
+            # Confirmed under the columnar copy's key, so the CSV isn't requested again and can be acknowledged
+            record_upload_confirmation(id, filename, size, sha256, uploaded[output]['key'], uploaded[output]['sha256'])
+            replacements.append({'filename': filename, 'size': size, 'sha256': sha256, 'replaced_by': uploaded[output]['key']})
+            os.remove(file_path)
+
+        upload_manifest(plan, id, entries, replacements)
+
+    if unverified:
+        raise RuntimeError(f"{len(unverified)} uploads failed verification: {', '.join(unverified)}")
+
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def upload_manifest(plan, id, entries, replaced=()):
+    """Writes the scan's manifest for one device and points the device's latest.json at it.
+
+    Consumers can read latest.json and then fetch exactly the listed keys
+    instead of listing the device prefix. Manifests form a chain ordered by
+    scan: each names the manifest of the device's previous scan under
+    'previous', so a consumer can walk back to the last one it saw.
+    latest.json only moves forward; a late upload of an older scan, such as a
+    queue retry, is linked into the chain in its place instead. CSVs uploaded
+    only as their columnar copy are listed under 'replaced' with the key that
+    holds them.
+    """
+    s3 = get_s3_client()
+    bucket_name = get_settings('bucket_name')
+    manifest_key = plan.manifest_key(id)
+    current = read_json_object(s3, bucket_name, plan.latest_manifest_key(id))
+
+    # Walk back from the latest manifest to where this scan belongs in the chain
+    previous = current['manifest'] if current else None
+    successor = None  # (key, manifest) of the newer scan to link to this one
+    while previous is not None:
+        if previous == manifest_key:
+            # Uploaded before; keep its place in the chain
+            existing = read_json_object(s3, bucket_name, manifest_key) or {}
+            previous = existing.get('previous')
+            successor = None
+            break
+        candidate = read_json_object(s3, bucket_name, previous)
+        if candidate is None or candidate['scan_id'] < plan.scan_id:
+            break
+        successor = (previous, candidate)
+        previous = candidate.get('previous')
+
+    manifest = {
+        'scan_id': plan.scan_id,
+        'device_id': id,
+        'datetime_bucket': plan.datetime_str,
+        'created_at': datetime.now().strftime(DATETIME_FORMAT),
+        'previous': previous,
+        'files': entries,
+        'replaced': list(replaced),
+    }
+    s3.put_object(Bucket=bucket_name, Key=manifest_key, Body=json.dumps(manifest, indent=2).encode(),
+                  ContentType='application/json')
+    event_log.info('s3.manifest', f'Uploaded manifest: {manifest_key}', key=manifest_key, files=len(entries))
+
+    # Links are only pointed at manifests that already exist
+    if successor is not None:
+        successor_key, successor_manifest = successor
+        successor_manifest['previous'] = manifest_key
+        s3.put_object(Bucket=bucket_name, Key=successor_key, Body=json.dumps(successor_manifest, indent=2).encode(),
+                      ContentType='application/json')
+        event_log.info('s3.manifest', f"Linked late manifest {manifest_key} before {successor_key}.", key=manifest_key)
+    if current and current['scan_id'] > plan.scan_id:
+        return
+    latest = {
+        'manifest': manifest_key,
+        'scan_id': plan.scan_id,
+        'created_at': manifest['created_at'],
+        'files': len(entries),
+        'bytes': sum(entry['size'] for entry in entries),
+    }
+    s3.put_object(Bucket=bucket_name, Key=plan.latest_manifest_key(id), Body=json.dumps(latest).encode(),
+                  ContentType='application/json')
+
+def read_json_object(s3, bucket_name, key):
+    """Returns a JSON object stored in the bucket, or None if it doesn't exist."""
+    from botocore.exceptions import ClientError
+
+    try:
+        return json.loads(s3.get_object(Bucket=bucket_name, Key=key)['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
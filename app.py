@@ -1,12 +1,9 @@
-import threading
-import time
-import asyncio
-from flask import Flask
+from flask import Flask, Response, jsonify, request
 from flask_migrate import Migrate
 from models import db  # import the db instance from models.py
 from config import DATABASE_FILE
-from DBManager import fetch_and_store_settings
-from LinkBLE import searchForLinks
+from DBManager import get_link_stats, least_recently_synced_devices, bytes_per_device_per_day, coexistence_report
+from EventLog import LEVELS
 
 app = Flask(__name__)
 
@@ -18,16 +15,92 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
 migrate = Migrate(app, db)
 
-# Define the periodic tasks
-def periodic_tasks():
-    while True:
-        fetch_and_store_settings()     # Run the sync task
-        asyncio.run(searchForLinks())  # Run the async task
-        time.sleep(60)                 # Wait
+# Where status and metrics come from: the runtime started below when app.py is
+# run directly, or the other workers' snapshots when ProcessManager runs it as
+# the web worker
+gateway = None
+
+@app.route('/status')
+def status():
+    """State of the gateway runtime's tasks."""
+    return jsonify(gateway.status())
+
+@app.route('/adapters')
+def adapters():
+    """Per-adapter discovery, connection and throughput metrics."""
+    return jsonify(gateway.adapters())
+
+@app.route('/service_cache')
+def service_cache():
+    """GATT service cache hit rates and connect-to-first-byte latency with and without the cache."""
+    return jsonify(gateway.service_cache())
+
+@app.route('/link_stats')
+def link_stats():
+    """Per-device negotiated payload size and average transfer throughput."""
+    return jsonify(get_link_stats())
+
+@app.route('/history/devices')
+def history_devices():
+    """Devices ordered from least to most recently synced."""
+    return jsonify(least_recently_synced_devices(request.args.get('limit', 50, type=int)))
+
+@app.route('/history/daily')
+def history_daily():
+    """Bytes received per device per day."""
+    return jsonify(bytes_per_device_per_day(request.args.get('days', 7, type=int)))
+
+@app.route('/coexistence')
+def coexistence():
+    """Upload scheduler state and BLE throughput with and without concurrent uploads."""
+    return jsonify({
+        'scheduler': gateway.scheduler(),
+        'ble_throughput': coexistence_report(request.args.get('days', 7, type=int)),
+    })
+
+@app.route('/storage')
+def storage():
+    """Free space on the data drive, bytes reserved for in-flight transfers, and deferred or reclaimed data."""
+    return jsonify(gateway.storage())
+
+@app.route('/events')
+def events():
+    """The most recent events from the in-memory ring buffer, optionally filtered by minimum level and kind prefix."""
+    level = request.args.get('level', '').upper()
+    return jsonify(gateway.events(
+        request.args.get('n', 100, type=int),
+        LEVELS.get(level),
+        request.args.get('kind')
+    ))
+
+@app.route('/diagnostics')
+def diagnostics():
+    """Event-loop lag, notification callback timing histograms and profiler state."""
+    return jsonify(gateway.diagnostics())
+
+@app.route('/profile', methods=['GET', 'POST'])
+def profile():
+    """POST arms the sampling profiler for the next scan cycle; GET reports its state."""
+    if request.method == 'POST':
+        gateway.arm_profiler()
+    return jsonify(gateway.profiler_status())
+
+@app.route('/profile/download')
+def profile_download():
+    """Collapsed stacks of the last captured scan cycle, for flamegraph tools."""
+    result = gateway.profile_result()
+    if result is None:
+        return jsonify({'error': 'No profile captured yet.'}), 404
+    return Response(result, mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=scan-profile.folded'})
 
 if __name__ == "__main__":
-    # Start the Flask server in a background thread
-    threading.Thread(target=periodic_tasks, daemon=True).start()
+    from RuntimeManager import GatewayRuntime, RuntimeMetrics
+
+    # Settings sync, scanning and uploads run on a single long-lived event loop in a background thread
+    runtime = GatewayRuntime()
+    gateway = RuntimeMetrics(runtime)
+    runtime.start()
 
     # Start the Flask application
     app.run(debug=False)
@@ -0,0 +1,82 @@
+"""Local stand-in for the Hublink lease API, for testing several gateways without the cloud.
+
+Implements the two endpoints used by APIManager.claim_lease and release_lease,
+keeping leases in memory:
+
+  POST /<secret>/leases          {"device", "gateway", "ttl"}  -> {"granted", "holder", "expires_in"}
+  POST /<secret>/leases/release  {"device", "gateway", "hold"} -> {"released"}
+
+A lease is granted if the device is unleased, its lease has expired, or the
+caller already holds it (a renewal). GET /leases lists current leases.
+
+Usage: python benchmarks/lease_server.py [--port N]
+then start each gateway with HUBLINK_LEASE_ENDPOINT=http://<host>:<port>
+and a distinct GATEWAY_ID.
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+leases = {}  # device -> (gateway, expires_at monotonic)
+leases_lock = threading.Lock()
+
+def claim(device, gateway, ttl):
+    now = time.monotonic()
+    with leases_lock:
+        holder, expires_at = leases.get(device, (None, 0.0))
+        if holder is None or holder == gateway or expires_at <= now:
+            leases[device] = (gateway, now + ttl)
+            return {'granted': True, 'holder': gateway, 'expires_in': ttl}
+        return {'granted': False, 'holder': holder, 'expires_in': expires_at - now}
+
+def release(device, gateway, hold):
+    now = time.monotonic()
+    with leases_lock:
+        holder, _ = leases.get(device, (None, 0.0))
+        if holder != gateway:
+            return {'released': False}
+        if hold > 0:
+            leases[device] = (gateway, now + hold)
+        else:
+            del leases[device]
+        return {'released': True}
+
+class LeaseHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            return self.respond(400, {'error': 'invalid JSON'})
+        if self.path.endswith('/leases'):
+            return self.respond(200, claim(body['device'], body['gateway'], float(body.get('ttl', 120))))
+        if self.path.endswith('/leases/release'):
+            return self.respond(200, release(body['device'], body['gateway'], float(body.get('hold', 0))))
+        self.respond(404, {'error': 'not found'})
+
+    def do_GET(self):
+        if not self.path.endswith('/leases'):
+            return self.respond(404, {'error': 'not found'})
+        now = time.monotonic()
+        with leases_lock:
+            current = {device: {'holder': holder, 'expires_in': expires_at - now}
+                       for device, (holder, expires_at) in leases.items() if expires_at > now}
+        self.respond(200, current)
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    port = int(sys.argv[sys.argv.index('--port') + 1]) if '--port' in sys.argv else 8085
+    server = ThreadingHTTPServer(('', port), LeaseHandler)
+    print(f"Lease server listening on port {port}")
+    server.serve_forever()
@@ -0,0 +1,105 @@
+"""Cold-start benchmarks for the one-shot entry point.
+
+Measures, in fresh interpreters:
+  - import time of each top-level gateway module
+  - time from launch to the start of scanning (oneshot.py --benchmark)
+
+Usage: python benchmarks/startup.py [--runs N] [--record]
+
+Results are compared with the last row of benchmarks/startup_history.csv,
+the committed baseline. --record appends the medians, with the current commit,
+so regressions show up in the repo history. Each row names the machine it was
+measured on, and results are only compared with rows from the same machine.
+Baselines are measured with settings already stored, the normal one-shot path.
+"""
+import csv
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_FILE = os.path.join(REPO_DIRECTORY, 'benchmarks', 'startup_history.csv')
+MODULES = ['config', 'EventLog', 'DBManager', 'S3Manager', 'APIManager', 'LinkBLE', 'RuntimeManager', 'app']
+
+def import_time_ms(module):
+    """Import time of module in a fresh interpreter, in milliseconds."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(1000 * (time.perf_counter() - t))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIRECTORY, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+def time_to_scan():
+    result = subprocess.run([sys.executable, 'oneshot.py', '--benchmark'], cwd=REPO_DIRECTORY, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"oneshot.py --benchmark failed: {result.stderr.strip().splitlines()[-1]}", file=sys.stderr)
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def machine():
+    """Describes the hardware and interpreter the benchmarks run on."""
+    model = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                # x86 reports "model name", Raspberry Pis report "Model"
+                key, _, value = line.partition(':')
+                if key.strip() in ('model name', 'Model'):
+                    model = value.strip()
+    except OSError:
+        pass
+    return f"{model} x{os.cpu_count()}, Python {platform.python_version()}"
+
+def baseline(current_machine):
+    """Returns the last results recorded on current_machine, or {} if there are none."""
+    if not os.path.exists(HISTORY_FILE):
+        return {}
+    with open(HISTORY_FILE, newline='') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('machine') == current_machine]
+    return rows[-1] if rows else {}
+
+def median(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+def main():
+    runs = int(sys.argv[sys.argv.index('--runs') + 1]) if '--runs' in sys.argv else 5
+
+    results = {}
+    for module in MODULES:
+        results[f'import_{module}_ms'] = median([import_time_ms(module) for _ in range(runs)])
+    oneshot = [run for run in (time_to_scan() for _ in range(runs)) if run is not None]
+    results['oneshot_imports_ms'] = median([run['imports_ms'] for run in oneshot])
+    results['oneshot_time_to_scan_ms'] = median([run['time_to_scan_ms'] for run in oneshot])
+
+    current_machine = machine()
+    recorded = baseline(current_machine)
+    if recorded:
+        print(f"Comparing with {recorded['commit']} ({recorded['recorded_at']}) on {current_machine}")
+    else:
+        print(f"No baseline recorded on {current_machine}")
+    for name, value in results.items():
+        line = f"{name:32} {'failed' if value is None else f'{value:8.1f}'}"
+        if value is not None and recorded.get(name):
+            previous = float(recorded[name])
+            line += f"  baseline {previous:8.1f}  {100 * (value - previous) / previous:+6.1f}%"
+        print(line)
+
+    if '--record' in sys.argv:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIRECTORY,
+                                capture_output=True, text=True).stdout.strip()
+        row = {'recorded_at': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'machine': current_machine, 'runs': runs}
+        row.update({name: '' if value is None else f'{value:.1f}' for name, value in results.items()})
+        new_file = not os.path.exists(HISTORY_FILE)
+        with open(HISTORY_FILE, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(row), lineterminator='\n')
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
+
+if __name__ == "__main__":
+    main()
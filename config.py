@@ -24,4 +24,128 @@ DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 # 'years'   - Uses format 'YYYY'
 # 'never'   - No datetime component, returns an empty string
 # Any other value will raise a ValueError.
-VALID_DT_RULES = ['seconds', 'hours', 'days', 'weeks', 'months', 'years', 'never']
\ No newline at end of file
+VALID_DT_RULES = ['seconds', 'hours', 'days', 'weeks', 'months', 'years', 'never']
+# Each scan folder records the DT_RULE and time bucket its keys were planned
+# with in this file, so later uploads and retries use the same S3 keys.
+SCAN_PLAN_FILE = '.scan_plan.json'
+
+# BLE link negotiation
+# Upper bound on the ATT MTU used to size notification payloads. The MTU itself
+# is exchanged by BlueZ when connecting; the gateway reads the result, caps it
+# here (517 is the maximum allowed by the spec) and only reports the payload to
+# peripherals with the MTU: control write.
+PREFERRED_MTU = 517
+# Each notification carries MTU - 3 bytes (ATT opcode + handle), capped at the
+# maximum attribute value length of 512 bytes.
+ATT_HEADER_SIZE = 3
+MAX_ATTRIBUTE_SIZE = 512
+
+# Incremental file listing
+# Peripherals list only files changed since the stored sync cursor; a full
+# listing is still requested after this many hours for reconciliation.
+FULL_LISTING_INTERVAL_HOURS = 24
+
+# Batched file requests
+# Peripherals that announce BATCH in their listing are sent up to this many
+# filenames per request and stream them back to back; 0 disables batching.
+BATCH_MAX_FILES = 32
+
+# Disk-space admission control
+# Files are only requested once their announced size can be reserved on the
+# drive at DATA_DIRECTORY while keeping this much free.
+DISK_HEADROOM_BYTES = 64 * 1024 * 1024
+
+# Gateway runtime schedule
+SCAN_INTERVAL_SECONDS = 60
+SETTINGS_INTERVAL_SECONDS = 60
+
+# BLE adapters (HCI controllers) to discover and connect on. Devices are assigned
+# to the adapter that hears them best, penalized by how loaded that adapter is.
+BLE_ADAPTERS = ['hci0']
+MAX_CONNECTIONS_PER_ADAPTER = 1
+# RSSI (dB) subtracted from an adapter's score for each device already assigned to it,
+# scaled by its connection slots
+ADAPTER_LOAD_PENALTY_DB = 10
+
+# Device and transfer history
+# Raw connection/file-transfer rows older than this are rolled up into daily
+# per-device aggregates and deleted, keeping the database small on the SD card.
+HISTORY_RETENTION_DAYS = 14
+HISTORY_COMPACT_INTERVAL_SECONDS = 3600
+
+# Local mirror of the S3 bucket, used to filter already-uploaded files when the
+# Hublink API is unreachable. Syncs are incremental per device prefix, with a
+# full resync (which also drops deleted objects) every S3_INVENTORY_FULL_SYNC_HOURS.
+S3_INVENTORY_INTERVAL_SECONDS = 600
+S3_INVENTORY_FULL_SYNC_HOURS = 24
+
+# Upload scheduling. Wi-Fi and Bluetooth share an antenna on the Raspberry Pi, so
+# uploads are slowed ('throttle') or held between files ('pause') while BLE
+# transfers are running, and burst up to UPLOAD_RATE_LIMIT_BPS (0 = unlimited)
+# when the radio is idle. 'off' disables coexistence scheduling.
+UPLOAD_RATE_LIMIT_BPS = 0
+UPLOAD_COEXISTENCE = 'throttle'
+UPLOAD_COEXISTENCE_RATE_BPS = 32768
+UPLOAD_MAX_CONCURRENCY = 2
+
+# Structured event log. Events at EVENT_LOG_LEVEL or above are kept in an
+# in-memory ring buffer (served by /events) and written in batches to a rotating
+# file; those at EVENT_CONSOLE_LEVEL or above are also printed.
+EVENT_LOG_LEVEL = 'INFO'
+EVENT_CONSOLE_LEVEL = 'WARNING'
+EVENT_LOG_FILE = os.path.join(base_directory, 'instance', 'events.log')
+EVENT_LOG_MAX_BYTES = 1048576
+EVENT_LOG_BACKUPS = 3
+EVENT_BUFFER_SIZE = 2000
+EVENT_LOG_FLUSH_SECONDS = 2
+
+# Diagnostics: event-loop lag sampling interval and the sampling profiler's
+# interval for single-scan captures requested through /profile.
+LOOP_LAG_INTERVAL_SECONDS = 0.25
+PROFILER_INTERVAL_SECONDS = 0.005
+
+# Optional post-receive processing of logger CSV files before upload.
+# 'off' uploads raw files only, 'alongside' uploads a columnar copy and a
+# summary next to each CSV, 'replace' uploads the columnar copy and summary
+# instead of the CSV, which is kept until the copy is verified in S3. Parquet is
+# written when pyarrow is installed, otherwise a compressed NumPy .npz; with
+# neither installed processing is skipped.
+PROCESS_CSV = 'off'
+PROCESS_WORKERS = 2
+
+# Multi-process gateway (ProcessManager.py). The supervisor runs these workers
+# as separate processes and restarts any that exit, waiting
+# WORKER_RESTART_BACKOFF_SECONDS, doubled for each consecutive crash up to
+# WORKER_RESTART_BACKOFF_MAX_SECONDS; a worker that stays up for
+# WORKER_STABLE_SECONDS is considered healthy again. Workers publish their
+# status to WORKER_DIRECTORY every WORKER_SNAPSHOT_SECONDS for the web worker.
+WORKERS = ['collector', 'uploader', 'web']
+WORKER_DIRECTORY = os.path.join(base_directory, 'instance', 'workers')
+WORKER_SNAPSHOT_SECONDS = 5
+WORKER_SNAPSHOT_EVENTS = 200
+WORKER_RESTART_BACKOFF_SECONDS = 1
+WORKER_RESTART_BACKOFF_MAX_SECONDS = 60
+WORKER_STABLE_SECONDS = 300
+# Niceness of the uploader so checksumming and processing never compete with BLE callbacks
+UPLOADER_NICE = 10
+# Durable upload queue: scans are polled for every UPLOAD_QUEUE_POLL_SECONDS and
+# retried with backoff up to UPLOAD_QUEUE_MAX_ATTEMPTS times.
+UPLOAD_QUEUE_POLL_SECONDS = 2
+UPLOAD_QUEUE_MAX_ATTEMPTS = 5
+
+# Device leases. Gateways covering the same devices claim a lease on each MAC
+# address through the Hublink API before connecting and renew it every
+# LEASE_SECONDS / 3 while transferring; a gateway that dies simply lets it
+# expire. After a successful sync the lease is held for
+# LEASE_HOLD_AFTER_SYNC_SECONDS so other gateways don't connect to list the same
+# files again. Set HUBLINK_LEASE_ENDPOINT to use benchmarks/lease_server.py instead.
+# Leasing is off until the Hublink API serves the lease endpoints.
+LEASE_ENABLED = False
+LEASE_ENDPOINT = os.getenv('HUBLINK_LEASE_ENDPOINT', HUBLINK_ENDPOINT)
+LEASE_SECONDS = 120
+LEASE_HOLD_AFTER_SYNC_SECONDS = 300
+# Gateways identify themselves by GATEWAY_ID, or else by a random ID generated
+# on first use and kept in GATEWAY_ID_FILE, so cloned images sharing a hostname
+# still hold separate leases.
+GATEWAY_ID = os.getenv('GATEWAY_ID')
+GATEWAY_ID_FILE = os.path.join(base_directory, 'instance', 'gateway_id')
@@ -4,10 +4,24 @@ db = SQLAlchemy()
 
 class S3File(db.Model):
     __tablename__ = 's3_files'
+    __table_args__ = (
+        db.Index('ix_s3_files_device_id_basename', 'device_id', 'basename'),
+    )
 
     filename = db.Column(db.String, primary_key=True)
     size = db.Column(db.Integer)
     updated_at = db.Column(db.String)
+    device_id = db.Column(db.String)
+    basename = db.Column(db.String)
+    sha256 = db.Column(db.String)  # Only known for objects this gateway uploaded
+
+class S3SyncMarker(db.Model):
+    __tablename__ = 's3_sync_markers'
+
+    prefix = db.Column(db.String, primary_key=True)
+    last_key = db.Column(db.String)
+    synced_at = db.Column(db.Integer)
+    full_synced_at = db.Column(db.Integer)
 
 class MacAddress(db.Model):
     __tablename__ = 'mac_addresses'
@@ -32,3 +46,129 @@ class Setting(db.Model):
     id_file_starts_with = db.Column(db.String)
     alert_email = db.Column(db.String)
     updated_at = db.Column(db.String)
+
+class LinkParameter(db.Model):
+    __tablename__ = 'link_parameters'
+
+    mac_address = db.Column(db.String, primary_key=True)
+    mtu_size = db.Column(db.Integer)
+    payload_size = db.Column(db.Integer)
+    bytes_received = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    transfer_seconds = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.String)
+
+class SyncCursor(db.Model):
+    __tablename__ = 'sync_cursors'
+
+    mac_address = db.Column(db.String, primary_key=True)
+    cursor = db.Column(db.String)
+    device_id = db.Column(db.String)
+    full_listing_at = db.Column(db.String)
+    updated_at = db.Column(db.String)
+
+# History tables use integer epoch-second timestamps so range queries and
+# daily roll-ups stay cheap; 'day' is the epoch day (epoch seconds // 86400).
+class Device(db.Model):
+    __tablename__ = 'devices'
+
+    mac_address = db.Column(db.String, primary_key=True)
+    device_id = db.Column(db.String, index=True)
+    name = db.Column(db.String)
+    first_seen_at = db.Column(db.Integer)
+    last_seen_at = db.Column(db.Integer)
+    last_synced_at = db.Column(db.Integer, index=True)
+
+class ConnectionAttempt(db.Model):
+    __tablename__ = 'connection_attempts'
+    __table_args__ = (
+        db.Index('ix_connection_attempts_mac_address_started_at', 'mac_address', 'started_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    mac_address = db.Column(db.String, nullable=False)
+    adapter = db.Column(db.String)
+    started_at = db.Column(db.Integer, nullable=False, index=True)
+    duration_ms = db.Column(db.Integer)
+    succeeded = db.Column(db.Boolean, nullable=False)
+    used_cache = db.Column(db.Boolean)
+    error = db.Column(db.String)
+
+class FileTransfer(db.Model):
+    __tablename__ = 'file_transfers'
+    __table_args__ = (
+        db.Index('ix_file_transfers_mac_address_completed_at', 'mac_address', 'completed_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    mac_address = db.Column(db.String, nullable=False)
+    device_id = db.Column(db.String)
+    filename = db.Column(db.String, nullable=False)
+    size = db.Column(db.Integer)
+    bytes_received = db.Column(db.Integer, nullable=False)
+    duration_ms = db.Column(db.Integer)
+    succeeded = db.Column(db.Boolean, nullable=False)
+    completed_at = db.Column(db.Integer, nullable=False, index=True)
+    upload_state = db.Column(db.String)  # 'idle', 'throttled' or 'unthrottled' uploads during the transfer
+
+class DeviceDaily(db.Model):
+    __tablename__ = 'device_daily'
+
+    mac_address = db.Column(db.String, primary_key=True)
+    day = db.Column(db.Integer, primary_key=True, index=True)
+    device_id = db.Column(db.String)
+    connections = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    connection_failures = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    files = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    file_failures = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    bytes_received = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    transfer_ms = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class UploadJob(db.Model):
+    __tablename__ = 'upload_jobs'
+    __table_args__ = (
+        db.Index('ix_upload_jobs_state_available_at', 'state', 'available_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    scan_directory = db.Column(db.String, nullable=False, unique=True)
+    state = db.Column(db.String, nullable=False)  # 'pending', 'claimed', 'done' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_error = db.Column(db.String)
+    enqueued_at = db.Column(db.Integer, nullable=False)
+    available_at = db.Column(db.Integer, nullable=False)  # Epoch seconds before which a retry is not claimed
+    updated_at = db.Column(db.Integer, nullable=False)
+
+class UploadConfirmation(db.Model):
+    __tablename__ = 'upload_confirmations'
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'filename', 'sha256'),
+        db.Index('ix_upload_confirmations_device_id_acknowledged_at', 'device_id', 'acknowledged_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    device_id = db.Column(db.String, nullable=False)
+    filename = db.Column(db.String, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String, nullable=False)
+    s3_key = db.Column(db.String, nullable=False)
+    object_sha256 = db.Column(db.String)  # SHA-256 of the object at s3_key as this gateway verified it
+    confirmed_at = db.Column(db.Integer, nullable=False)  # Epoch seconds the object was verified in S3
+    acknowledged_at = db.Column(db.Integer)  # Epoch seconds the peripheral was told it may delete the file
+
+class ReceivedFile(db.Model):
+    __tablename__ = 'received_files'
+    __table_args__ = (
+        db.Index('ix_received_files_received_at', 'received_at'),
+    )
+
+    path = db.Column(db.String, primary_key=True)  # Final path of the file in its scan folder
+    size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String, nullable=False)  # Hash computed while the file streamed in
+    received_at = db.Column(db.Integer, nullable=False)
+
+class ChangedFile(db.Model):
+    __tablename__ = 'changed_files'
+
+    device_id = db.Column(db.String, primary_key=True)
+    filename = db.Column(db.String, primary_key=True)
+    listed_at = db.Column(db.Integer, nullable=False)  # Epoch seconds an incremental listing last showed the file created or modified
@@ -0,0 +1,53 @@
+"""One-shot gateway cycle for cron or wake/sync/sleep operation.
+
+Runs a single scan, transfer and upload cycle without Flask or SQLAlchemy and
+exits. Heavy modules (boto3, requests, dotenv) are only imported once a cycle
+actually needs them, so scanning starts as soon as bleak is loaded. Settings
+stored by the previous run are used for the scan while fresh settings are
+fetched in the background for the upload.
+
+Usage: python oneshot.py [--benchmark]
+
+--benchmark reports import and time-to-scan timings as JSON and exits just
+before the scan starts.
+"""
+import time
+
+LAUNCHED_AT = time.perf_counter()
+
+import asyncio
+import json
+import sys
+
+def elapsed_ms():
+    return 1000 * (time.perf_counter() - LAUNCHED_AT)
+
+async def run(benchmark=False):
+    from LinkBLE import searchForLinks
+    from DBManager import get_settings, fetch_and_store_settings
+    from EventLog import event_log
+    imported_ms = elapsed_ms()
+
+    # Scan with the settings stored by the previous run; only block on the API when there are none
+    settings_refresh = None
+    if get_settings():
+        if not benchmark:
+            settings_refresh = asyncio.create_task(asyncio.to_thread(fetch_and_store_settings))
+    else:
+        await asyncio.to_thread(fetch_and_store_settings)
+    scan_ms = elapsed_ms()
+
+    if benchmark:
+        print(json.dumps({'imports_ms': imported_ms, 'time_to_scan_ms': scan_ms, 'modules': len(sys.modules)}))
+        return
+
+    event_log.info('oneshot', f"Scanning started {scan_ms:.0f} ms after launch.", imports_ms=imported_ms, time_to_scan_ms=scan_ms)
+    try:
+        await searchForLinks()
+    finally:
+        if settings_refresh is not None:
+            await settings_refresh
+    event_log.info('oneshot', f"Cycle finished {elapsed_ms() / 1000:.1f} seconds after launch.")
+
+if __name__ == "__main__":
+    asyncio.run(run(benchmark='--benchmark' in sys.argv))
@@ -0,0 +1,55 @@
+import os
+import shutil
+import pytest
+from flask import Flask
+from flask_migrate import Migrate, upgrade
+import DBManager
+import FileManager
+import S3Manager
+from EventLog import event_log
+from models import db
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(autouse=True, scope='session')
+def quiet_event_log():
+    # Events stay in the ring buffer instead of being written to instance/events.log
+    event_log.path = None
+
+@pytest.fixture(scope='session')
+def schema(tmp_path_factory):
+    """A database file migrated to the latest schema, created once and copied for each test."""
+    path = str(tmp_path_factory.mktemp('schema') / 'hublink.db')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    db.init_app(app)
+    Migrate(app, db, directory=os.path.join(REPO_DIRECTORY, 'migrations'))
+    with app.app_context():
+        upgrade()
+    return path
+
+@pytest.fixture
+def database(schema, tmp_path, monkeypatch):
+    """Points the modules that use the database at a fresh copy of the migrated schema."""
+    path = str(tmp_path / 'hublink.db')
+    shutil.copyfile(schema, path)
+    monkeypatch.setattr(DBManager, 'DATABASE_FILE', path)
+    monkeypatch.setattr(S3Manager, 'DATABASE_FILE', path)
+    return path
+
+@pytest.fixture
+def settings(monkeypatch):
+    """Serves default settings from memory; tests update the returned dict to change them."""
+    settings = DBManager.apply_defaults_and_overrides({'bucket_name': 'bucket', 'use_cloud': True})
+    monkeypatch.setattr(DBManager, 'settings_cache', settings)
+    return settings
+
+@pytest.fixture
+def data_directory(tmp_path, monkeypatch):
+    """Points received files, partial files and the content store at a temporary DATA_DIRECTORY."""
+    path = tmp_path / 'data'
+    path.mkdir()
+    monkeypatch.setattr(FileManager, 'DATA_DIRECTORY', str(path))
+    monkeypatch.setattr(FileManager, 'PARTIAL_DIRECTORY', str(path / '.partial'))
+    monkeypatch.setattr(FileManager.content_store, 'directory', str(path / '.objects'))
+    return str(path)
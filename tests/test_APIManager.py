@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer
+import pytest
+import APIManager
+import DBManager
+import LinkBLE
+from AdapterManager import AdapterPool, FakeAdapterBackend
+from APIManager import claim_lease, release_lease
+from benchmarks import lease_server
+
+@pytest.fixture
+def leases(monkeypatch):
+    """Runs benchmarks/lease_server.py on an ephemeral port; returns a function that sets this gateway's ID."""
+    lease_server.leases.clear()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), lease_server.LeaseHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(APIManager, 'LEASE_ENDPOINT', f'http://127.0.0.1:{server.server_address[1]}')
+    monkeypatch.setattr(DBManager, 'secret_url', 'secret')
+
+    def as_gateway(gateway):
+        monkeypatch.setattr(DBManager, 'gateway_id', gateway)
+    as_gateway('gateway-a')
+    yield as_gateway
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def test_lease_is_denied_to_other_gateways_and_renewed_by_holder(leases):
+    assert claim_lease('AA')
+
+    leases('gateway-b')
+    assert not claim_lease('AA')
+    assert claim_lease('BB')
+
+    leases('gateway-a')
+    assert claim_lease('AA')
+
+def test_expired_lease_can_be_claimed(leases):
+    assert claim_lease('AA', ttl=0.05)
+    time.sleep(0.1)
+
+    leases('gateway-b')
+    assert claim_lease('AA')
+
+def test_release_hands_the_lease_over_after_hold(leases):
+    assert claim_lease('AA')
+    release_lease('AA', hold=60)
+
+    leases('gateway-b')
+    assert not claim_lease('AA')
+    # Only the holder can release
+    release_lease('AA')
+    assert not claim_lease('AA')
+
+    leases('gateway-a')
+    release_lease('AA')
+    leases('gateway-b')
+    assert claim_lease('AA')
+
+def test_unreachable_lease_api_grants_the_claim(leases, monkeypatch):
+    monkeypatch.setattr(APIManager, 'LEASE_ENDPOINT', 'http://127.0.0.1:1')
+
+    assert claim_lease('AA')
+
+def test_transfer_device_skips_device_leased_elsewhere(leases, monkeypatch, data_directory):
+    monkeypatch.setattr(LinkBLE, 'LEASE_ENABLED', True)
+    leases('gateway-b')
+    assert claim_lease('AA')
+    leases('gateway-a')
+    backend = FakeAdapterBackend({})
+    pool = AdapterPool(['hci0'], backend)
+    adapter = pool.adapters[0]
+
+    assert not asyncio.run(LinkBLE.transfer_device(pool, adapter, 'AA', data_directory))
+
+    assert adapter.metrics['leases_denied'] == 1
+    assert adapter.metrics['connections_attempted'] == 0
+    assert backend.connections == []
+
+def test_gateway_id_is_generated_once_and_persisted(tmp_path, monkeypatch):
+    path = tmp_path / 'instance' / 'gateway_id'
+    monkeypatch.setattr(DBManager, 'GATEWAY_ID', None)
+    monkeypatch.setattr(DBManager, 'GATEWAY_ID_FILE', str(path))
+    monkeypatch.setattr(DBManager, 'gateway_id', None)
+
+    gateway = DBManager.get_gateway_id()
+    monkeypatch.setattr(DBManager, 'gateway_id', None)
+
+    assert DBManager.get_gateway_id() == gateway
+    assert path.read_text().strip() == gateway
+
+def test_gateway_id_from_environment_wins(tmp_path, monkeypatch):
+    monkeypatch.setattr(DBManager, 'GATEWAY_ID', 'gateway-env')
+    monkeypatch.setattr(DBManager, 'GATEWAY_ID_FILE', str(tmp_path / 'gateway_id'))
+    monkeypatch.setattr(DBManager, 'gateway_id', None)
+
+    assert DBManager.get_gateway_id() == 'gateway-env'
+    assert not (tmp_path / 'gateway_id').exists()
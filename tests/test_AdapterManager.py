@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from AdapterManager import AdapterPool, FakeAdapterBackend
+
+def make_pool(sightings, names=('hci0', 'hci1')):
+    return AdapterPool(list(names), FakeAdapterBackend(sightings))
+
+def test_discover_merges_sightings_across_adapters():
+    pool = make_pool({
+        'hci0': {'AA': ('HUBLINK-1', -60), 'BB': (None, -80)},
+        'hci1': {'AA': ('HUBLINK-1', -50), 'BB': ('HUBLINK-2', -70)},
+    })
+
+    sightings = asyncio.run(pool.discover(timeout=0))
+
+    assert sightings == {
+        'AA': {'name': 'HUBLINK-1', 'rssi': {'hci0': -60, 'hci1': -50}},
+        'BB': {'name': 'HUBLINK-2', 'rssi': {'hci0': -80, 'hci1': -70}},
+    }
+    assert pool.get_metrics()['hci0']['devices_seen'] == 2
+
+def test_discover_skips_failing_adapter():
+    class FailingBackend(FakeAdapterBackend):
+        async def discover(self, adapter, timeout):
+            if adapter.name == 'hci1':
+                raise OSError('adapter unplugged')
+            return await super().discover(adapter, timeout)
+
+    pool = AdapterPool(['hci0', 'hci1'], FailingBackend({'hci0': {'AA': ('HUBLINK-1', -60)}}))
+
+    assert asyncio.run(pool.discover(timeout=0)) == {'AA': {'name': 'HUBLINK-1', 'rssi': {'hci0': -60}}}
+
+def test_assign_prefers_strongest_adapter():
+    pool = make_pool({})
+    sightings = {'AA': {'name': 'HUBLINK-1', 'rssi': {'hci0': -80, 'hci1': -50}}}
+
+    assignments = pool.assign(['AA'], sightings)
+
+    assert {adapter.name: assigned for adapter, assigned in assignments.items()} == {'hci0': [], 'hci1': ['AA']}
+
+def test_assign_spreads_load_and_keeps_priority_order():
+    pool = make_pool({})
+    # Both adapters hear every device equally well, so the load penalty alternates them
+    sightings = {address: {'name': 'HUBLINK', 'rssi': {'hci0': -60, 'hci1': -60}} for address in 'ABCD'}
+
+    assignments = pool.assign(['D', 'C', 'B', 'A'], sightings)
+
+    assert {adapter.name: assigned for adapter, assigned in assignments.items()} == {'hci0': ['D', 'B'], 'hci1': ['C', 'A']}
+    assert pool.get_metrics()['hci0']['devices_assigned'] == 2
+
+def test_assign_skips_devices_no_adapter_heard():
+    pool = make_pool({})
+
+    assignments = pool.assign(['AA'], {})
+
+    assert all(not assigned for assigned in assignments.values())
+
+def test_connect_uses_cache_only_for_known_devices():
+    backend = FakeAdapterBackend({})
+    pool = AdapterPool(['hci0'], backend)
+    adapter = pool.adapters[0]
+
+    client, used_cache = asyncio.run(pool.connect(adapter, 'AA', []))
+    assert not used_cache and client.is_connected
+
+    pool.service_cache.store('AA', client, [])
+    _, used_cache = asyncio.run(pool.connect(adapter, 'AA', []))
+    assert used_cache
+    assert backend.connections == [('hci0', 'AA'), ('hci0', 'AA')]
+
+def test_connect_rediscovers_when_cached_services_fail():
+    class StaleCacheBackend(FakeAdapterBackend):
+        async def connect(self, adapter, mac_address, services, use_cache):
+            if use_cache:
+                raise OSError('cached handles no longer valid')
+            return await super().connect(adapter, mac_address, services, use_cache)
+
+    pool = AdapterPool(['hci0'], StaleCacheBackend({}))
+    adapter = pool.adapters[0]
+    client, _ = asyncio.run(pool.connect(adapter, 'AA', []))
+    pool.service_cache.store('AA', client, [])
+
+    client, used_cache = asyncio.run(pool.connect(adapter, 'AA', []))
+
+    assert client.is_connected and not used_cache
+    assert not pool.service_cache.is_cached('AA')
+    assert pool.service_cache.get_metrics()['invalidations'] == 1
+
+def test_connect_failure_without_cache_propagates():
+    class UnreachableBackend(FakeAdapterBackend):
+        async def connect(self, adapter, mac_address, services, use_cache):
+            raise OSError('device out of range')
+
+    pool = AdapterPool(['hci0'], UnreachableBackend({}))
+
+    with pytest.raises(OSError):
+        asyncio.run(pool.connect(pool.adapters[0], 'AA', []))
@@ -0,0 +1,137 @@
+import sqlite3
+import time
+import pytest
+import requests
+import DBManager
+
+DAY = 86400
+
+def transfer(completed_at, bytes_received=100, succeeded=True):
+    return {'mac_address': 'AA:BB', 'device_id': 'dev1', 'filename': 'a.csv', 'size': bytes_received,
+            'bytes_received': bytes_received, 'duration_ms': 1000, 'succeeded': succeeded,
+            'completed_at': completed_at, 'upload_state': 'idle'}
+
+def rows(database, query):
+    conn = sqlite3.connect(database)
+    result = conn.execute(query).fetchall()
+    conn.close()
+    return result
+
+def test_compact_history_rolls_old_days_into_daily_aggregates(database):
+    today = int(time.time()) // DAY * DAY
+    old_day = today - 20 * DAY
+    DBManager.record_connection_attempt('AA:BB', 'hci0', old_day + 10, 500, True)
+    DBManager.record_connection_attempt('AA:BB', 'hci0', old_day + 20, 500, False)
+    DBManager.record_connection_attempt('AA:BB', 'hci0', today + 10, 500, True)
+    DBManager.record_file_transfers([transfer(old_day + 30), transfer(old_day + 40, 50, False), transfer(today + 30)])
+
+    assert DBManager.compact_history(retention_days=14) == (2, 2)
+
+    assert rows(database, 'SELECT mac_address, day, device_id, connections, connection_failures, files, file_failures, bytes_received, transfer_ms FROM device_daily') == [
+        ('AA:BB', old_day // DAY, 'dev1', 2, 1, 1, 1, 150, 2000)
+    ]
+    assert rows(database, 'SELECT COUNT(*) FROM connection_attempts') == [(1,)]
+    assert rows(database, 'SELECT COUNT(*) FROM file_transfers') == [(1,)]
+
+def test_compact_history_adds_to_existing_aggregates(database):
+    old_day = (int(time.time()) // DAY - 20) * DAY
+    DBManager.record_file_transfers([transfer(old_day + 10)])
+    DBManager.compact_history(retention_days=14)
+    DBManager.record_file_transfers([transfer(old_day + 20, 25)])
+
+    DBManager.compact_history(retention_days=14)
+
+    assert rows(database, 'SELECT files, bytes_received FROM device_daily') == [(2, 125)]
+
+def test_bytes_per_device_per_day_combines_aggregates_and_raw_rows(database):
+    yesterday = (int(time.time()) // DAY - 1) * DAY
+    DBManager.record_file_transfers([transfer(yesterday + 10), transfer(yesterday + 20, 50)])
+    DBManager.compact_history(retention_days=0)
+    DBManager.record_file_transfers([transfer(yesterday + 30, 25)])
+
+    assert DBManager.bytes_per_device_per_day() == [
+        {'mac_address': 'AA:BB', 'day': yesterday // DAY, 'device_id': 'dev1', 'files': 3, 'bytes_received': 175}
+    ]
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error")
+
+    def json(self):
+        return self.data
+
+@pytest.fixture
+def settings_api(database, monkeypatch):
+    """Serves queued responses to fetch_and_store_settings and records the headers it sent."""
+    monkeypatch.setattr(DBManager, 'secret_url', 'secret')
+    monkeypatch.setattr(DBManager, 'settings_cache', None)
+    monkeypatch.setattr(DBManager, 'settings_validators', {'etag': None, 'last_modified': None, 'content_hash': None})
+    monkeypatch.setattr(DBManager, 'settings_subscribers', [])
+    responses = []
+    requests_sent = []
+
+    def get(url, headers=None, timeout=None):
+        requests_sent.append(headers)
+        return responses.pop(0)
+    monkeypatch.setattr(requests, 'get', get)
+    return responses, requests_sent
+
+SETTINGS = {'bucket_name': 'bucket', 'dt_rule': 'days', 'use_cloud': True, 'delete_scans': False, 'max_file_size': 100}
+
+def test_settings_fetch_is_conditional_on_the_previous_validators(settings_api):
+    responses, requests_sent = settings_api
+    responses += [FakeResponse(200, SETTINGS, {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}),
+                  FakeResponse(304)]
+
+    assert DBManager.fetch_and_store_settings()
+    assert not DBManager.fetch_and_store_settings()
+
+    assert requests_sent == [{}, {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}]
+    assert DBManager.get_settings('dt_rule') == 'days'
+
+def test_unchanged_settings_content_is_not_stored_again(settings_api, monkeypatch):
+    responses, _ = settings_api
+    responses += [FakeResponse(200, SETTINGS, {'ETag': '"v1"'}), FakeResponse(200, dict(SETTINGS), {'ETag': '"v2"'})]
+    assert DBManager.fetch_and_store_settings()
+    monkeypatch.setattr(DBManager, 'load_settings', lambda: pytest.fail('settings were reloaded'))
+
+    assert not DBManager.fetch_and_store_settings()
+    assert DBManager.settings_validators['etag'] == '"v2"'
+
+def test_invalid_dt_rule_is_rejected(settings_api):
+    responses, _ = settings_api
+    responses.append(FakeResponse(200, dict(SETTINGS, dt_rule='fortnights')))
+
+    assert DBManager.fetch_and_store_settings()
+    assert DBManager.get_settings('dt_rule') == 'hours'
+
+def test_settings_changes_are_published_to_subscribers(settings_api):
+    responses, _ = settings_api
+    responses += [FakeResponse(200, SETTINGS), FakeResponse(200, dict(SETTINGS, max_file_size=200))]
+    published = []
+
+    def failing_subscriber(settings, changed_keys):
+        raise RuntimeError('subscriber failed')
+    DBManager.subscribe_settings(failing_subscriber)
+    DBManager.subscribe_settings(lambda settings, changed_keys: published.append((settings['max_file_size'], changed_keys)))
+
+    DBManager.fetch_and_store_settings()
+    DBManager.fetch_and_store_settings()
+
+    # A failing subscriber doesn't keep the others from being notified
+    assert published[-1] == (200, {'max_file_size'})
+    assert len(published) == 2
+
+def test_settings_fetch_errors_keep_the_stored_settings(settings_api):
+    responses, _ = settings_api
+    responses += [FakeResponse(200, SETTINGS), FakeResponse(500)]
+    DBManager.fetch_and_store_settings()
+
+    assert not DBManager.fetch_and_store_settings()
+    assert DBManager.get_settings('bucket_name') == 'bucket'
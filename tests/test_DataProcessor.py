@@ -0,0 +1,31 @@
+import json
+import os
+import pytest
+from DataProcessor import process_scan, replaced_csvs
+
+pytest.importorskip('numpy')
+
+def write_csv(tmp_path, id='dev1', filename='a.csv'):
+    id_path = tmp_path / 'scan' / id
+    id_path.mkdir(parents=True)
+    (id_path / filename).write_text('time,value\n1,2.5\n2,3.5\n')
+    return str(tmp_path / 'scan'), str(id_path)
+
+def test_replace_keeps_csv_until_upload(tmp_path):
+    scan, id_path = write_csv(tmp_path)
+
+    summaries = process_scan(scan, mode='replace')
+
+    assert [summary['rows'] for summary in summaries] == [2]
+    # The uploader deletes the CSV once its columnar copy is verified in S3
+    assert os.path.exists(os.path.join(id_path, 'a.csv'))
+    assert replaced_csvs(id_path) == {'a.csv': summaries[0]['output']}
+
+def test_alongside_does_not_replace(tmp_path):
+    scan, id_path = write_csv(tmp_path)
+
+    process_scan(scan, mode='alongside')
+
+    with open(os.path.join(id_path, 'a.summary.json')) as f:
+        assert json.load(f)['replaced'] is False
+    assert replaced_csvs(id_path) == {}
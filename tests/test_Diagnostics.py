@@ -0,0 +1,71 @@
+import asyncio
+import time
+from Diagnostics import Histogram, LoopLagMonitor, SamplingProfiler, callback_histograms, timed
+
+def test_histogram_records_into_the_bucket_holding_each_sample():
+    histogram = Histogram()
+    for seconds in (0.00005, 0.0003, 0.0003, 0.02):
+        histogram.record(seconds)
+
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 4
+    # Bucket bounds are inclusive; labels are in milliseconds
+    assert snapshot['buckets_ms'] == {str(1000 * 0.00005): 1, str(1000 * 0.0005): 2, str(1000 * 0.025): 1}
+    assert snapshot['max_ms'] == 20.0
+
+def test_histogram_percentiles_report_bucket_upper_bounds():
+    histogram = Histogram()
+    for _ in range(98):
+        histogram.record(0.002)
+    histogram.record(0.3)
+    histogram.record(42.0)
+
+    assert histogram.percentile(0.5) == 0.0025
+    assert histogram.percentile(0.99) == 0.5
+    # Samples past the last finite bound report the largest one seen
+    assert histogram.percentile(1.0) == 42.0
+    assert Histogram().percentile(0.5) is None
+    assert Histogram().snapshot()['mean_ms'] is None
+
+def test_loop_lag_monitor_measures_a_blocked_loop():
+    monitor = LoopLagMonitor(interval=0.01)
+
+    async def block_loop():
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0)  # Let the monitor start its sleep
+        time.sleep(0.2)  # Blocks the loop, so the monitor wakes late
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(block_loop())
+
+    assert monitor.histogram.max >= 0.15
+    assert monitor.histogram.percentile(1.0) >= 0.15
+
+def test_timed_records_each_call():
+    @timed('test.callback')
+    async def callback(delay):
+        await asyncio.sleep(delay)
+        return delay
+
+    assert asyncio.run(callback(0.01)) == 0.01
+    assert callback_histograms['test.callback'].count == 1
+    assert callback_histograms['test.callback'].max >= 0.01
+
+def test_profiler_samples_a_busy_thread_as_collapsed_stacks():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.arm()
+    assert profiler.get_status()['armed']
+
+    profiler.start()
+    deadline = time.perf_counter() + 0.1
+    while time.perf_counter() < deadline:
+        pass
+    profiler.stop()
+
+    status = profiler.get_status()
+    assert not status['armed'] and not status['running']
+    assert status['samples'] > 0
+    stacks = dict(line.rsplit(' ', 1) for line in profiler.result.splitlines())
+    assert any(stack.startswith('MainThread;') for stack in stacks)
+    assert 'test_Diagnostics.py:test_profiler_samples_a_busy_thread_as_collapsed_stacks' in profiler.result
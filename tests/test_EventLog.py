@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+import EventLog
+from EventLog import EventLog as Log, WARNING
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def manual_log(monkeypatch, path, **kwargs):
+    """An event log writing to path that is flushed by hand instead of by the writer thread."""
+    log = Log(path=path, **kwargs)
+    monkeypatch.setattr(log, 'start_writer', lambda: None)
+    return log
+
+def test_ring_buffer_keeps_the_most_recent_events():
+    log = Log(path=None, buffer_size=3)
+    for i in range(5):
+        log.info('ble.transfer', f"event {i}", index=i)
+
+    assert [event['fields']['index'] for event in log.recent()] == [2, 3, 4]
+    assert [event['seq'] for event in log.recent(n=2)] == [3, 4]
+
+def test_events_below_the_level_are_dropped_and_recent_filters():
+    log = Log(level='INFO', path=None)
+    log.debug('ble.transfer', "dropped")
+    log.info('ble.transfer', "kept")
+    log.warning('s3.upload', "slow upload")
+    log.error('ble.connect', "failed")
+
+    assert [event['message'] for event in log.recent()] == ["kept", "slow upload", "failed"]
+    assert [event['message'] for event in log.recent(level=WARNING)] == ["slow upload", "failed"]
+    assert [event['message'] for event in log.recent(kind='ble')] == ["kept", "failed"]
+
+def test_flush_writes_pending_events_as_json_lines(tmp_path, monkeypatch):
+    path = str(tmp_path / 'instance' / 'events.log')
+    log = manual_log(monkeypatch, path)
+    log.info('s3.upload', "Uploaded", key='dev1/a.csv')
+    log.info('s3.upload', "Uploaded", key='dev1/b.csv')
+
+    log.flush()
+    log.flush()  # Nothing pending, nothing written
+
+    with open(path) as f:
+        events = [json.loads(line) for line in f]
+    assert [event['fields']['key'] for event in events] == ['dev1/a.csv', 'dev1/b.csv']
+    assert events[0]['level'] == 'INFO' and events[0]['kind'] == 's3.upload'
+
+def test_log_file_rotates_at_its_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(EventLog, 'EVENT_LOG_MAX_BYTES', 1000)
+    monkeypatch.setattr(EventLog, 'EVENT_LOG_BACKUPS', 2)
+    path = str(tmp_path / 'events.log')
+    log = manual_log(monkeypatch, path)
+
+    for i in range(40):
+        log.info('ble.transfer', "x" * 100, index=i)
+        log.flush()
+
+    assert sorted(os.listdir(tmp_path)) == ['events.log', 'events.log.1', 'events.log.2']
+    for filename in os.listdir(tmp_path):
+        assert os.path.getsize(tmp_path / filename) <= 1000
+    with open(path) as f:
+        assert json.loads(f.readlines()[-1])['fields']['index'] == 39
+
+def test_pending_events_are_flushed_at_exit(tmp_path):
+    path = str(tmp_path / 'events.log')
+    # The process exits long before the writer thread's first flush
+    script = f"from EventLog import event_log; event_log.path = {path!r}; event_log.info('oneshot', 'Cycle finished')"
+    subprocess.run([sys.executable, '-c', script], cwd=REPO_DIRECTORY, check=True, timeout=60)
+
+    with open(path) as f:
+        assert [json.loads(line)['message'] for line in f] == ['Cycle finished']
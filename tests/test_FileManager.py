@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import os
+import pytest
+import FileManager
+import LinkBLE
+from FileManager import SpaceReservations
+from S3Manager import ScanPlan
+
+class FixedSpaceReservations(SpaceReservations):
+    """Reservations against a drive with a fixed amount of free space."""
+
+    def __init__(self, free, headroom_bytes=100):
+        super().__init__(headroom_bytes)
+        self.free = free
+
+    def free_bytes(self):
+        return self.free
+
+def test_reservations_keep_headroom(data_directory):
+    reservations = FixedSpaceReservations(1000)
+
+    assert reservations.reserve(600)
+    assert not reservations.reserve(301)
+    assert reservations.reserve(300)
+    assert reservations.available() == 0
+
+    reservations.release(600)
+
+    assert reservations.available() == 600
+    metrics = reservations.get_metrics()
+    assert (metrics['reservations_granted'], metrics['reservations_denied'], metrics['reserved_bytes']) == (2, 1, 300)
+
+def test_release_never_goes_negative():
+    reservations = FixedSpaceReservations(1000)
+
+    reservations.release(50)
+
+    assert reservations.reserved_bytes == 0
+
+def test_admit_files_defers_what_does_not_fit(data_directory, settings, monkeypatch):
+    reservations = FixedSpaceReservations(1000)
+    monkeypatch.setattr(LinkBLE, 'space_reservations', reservations)
+    client = LinkBLE.BLEFileTransferClient('AA:BB', os.path.join(data_directory, 'scan'), ScanPlan('scan', dt_rule='hours'))
+    files = [('a.csv', 400), ('b.csv', 400), ('c.csv', 200), ('d.csv', 50)]
+
+    admitted = asyncio.run(client.admit_files(files))
+    client.defer_files(files[len(admitted):])
+
+    # Admission stops at the first file that doesn't fit so files arrive in listing order
+    assert admitted == files[:2]
+    assert client.transfer_deferred
+    assert reservations.get_metrics()['files_deferred'] == 2
+    client.release_reservations()
+    assert reservations.reserved_bytes == 0
+
+def store(data_directory, scan, filename, content):
+    """Stores content as if received into scan/dev1/filename. Returns True if it was a duplicate."""
+    partial = os.path.join(data_directory, f'{scan}-{filename}.part')
+    with open(partial, 'wb') as f:
+        f.write(content)
+    final_path = os.path.join(data_directory, scan, 'dev1', filename)
+    return FileManager.content_store.store(partial, final_path, hashlib.sha256(content).hexdigest(), len(content))
+
+def test_content_store_keeps_one_copy_until_no_scan_links_it(data_directory):
+    content = b'x' * 100
+    assert not store(data_directory, 'scan1', 'a.csv', content)
+    assert store(data_directory, 'scan2', 'a.csv', content)
+    assert os.path.samefile(os.path.join(data_directory, 'scan1', 'dev1', 'a.csv'),
+                            os.path.join(data_directory, 'scan2', 'dev1', 'a.csv'))
+
+    # Still linked from scan2, so deleting scan1 frees nothing
+    assert FileManager.delete_scan_folder(os.path.join(data_directory, 'scan1')) == (0, 0)
+    assert FileManager.content_store.prune() == 0
+
+    assert FileManager.delete_scan_folder(os.path.join(data_directory, 'scan2')) == (0, 100)
+    assert FileManager.content_store.prune() == 100
+    assert FileManager.content_store.get_metrics()['objects_pruned'] == 1
+
+def test_content_store_keeps_objects_copied_out_where_hardlinks_fail(data_directory, monkeypatch):
+    def no_hardlinks(source, destination):
+        raise OSError("Operation not permitted")
+    monkeypatch.setattr(os, 'link', no_hardlinks)
+    content = b'x' * 100
+    target = FileManager.content_store.object_path(hashlib.sha256(content).hexdigest())
+
+    assert not store(data_directory, 'scan1', 'a.csv', content)
+    # The object stays in the store, so the same content received later is still recognised
+    assert store(data_directory, 'scan2', 'a.csv', content)
+    for scan in ('scan1', 'scan2'):
+        path = os.path.join(data_directory, scan, 'dev1', 'a.csv')
+        assert not os.path.samefile(path, target)
+        with open(path, 'rb') as f:
+            assert f.read() == content
+
+    # Kept while any scan folder holds a copy
+    FileManager.delete_scan_folder(os.path.join(data_directory, 'scan1'))
+    assert FileManager.content_store.prune() == 0
+    assert os.path.exists(target)
+    FileManager.delete_scan_folder(os.path.join(data_directory, 'scan2'))
+    assert FileManager.content_store.prune() == 100
+    assert os.listdir(os.path.dirname(target)) == []
+
+def test_reclaim_space_counts_only_bytes_actually_freed(data_directory, settings, monkeypatch):
+    import S3Manager
+
+    settings.update(use_cloud=True, delete_scans=True)
+    monkeypatch.setattr(S3Manager, 'scan_in_inventory', lambda folder: True)
+    reservations = FixedSpaceReservations(1000)
+    monkeypatch.setattr(FileManager, 'space_reservations', reservations)
+    store(data_directory, 'scan1', 'shared.csv', b's' * 500)
+    store(data_directory, 'scan1', 'a.csv', b'a' * 100)
+    store(data_directory, 'scan2', 'b.csv', b'b' * 100)
+    store(data_directory, 'scan3', 'shared.csv', b's' * 500)
+    for age, scan in enumerate(['scan3', 'scan2', 'scan1']):
+        os.utime(os.path.join(data_directory, scan), (1000 - age, 1000 - age))
+
+    # scan3 is being received; scan1 is oldest, and only its own a.csv is freed by deleting it
+    freed = FileManager.reclaim_space(reservations.available() + 100, exclude=[os.path.join(data_directory, 'scan3')])
+
+    assert freed == 100
+    assert sorted(FileManager.list_scan_folders()) == [os.path.join(data_directory, scan) for scan in ('scan2', 'scan3')]
+    assert reservations.get_metrics()['bytes_reclaimed'] == 100
+
+def test_receive_file_writes_chunks_at_their_offsets(data_directory):
+    final_path = os.path.join(data_directory, 'scan1', 'dev1', 'a.bin')
+    received = FileManager.ReceiveFile(final_path, 8)
+    received.write(b'5678', offset=4)
+    # Nothing is visible in the scan folder until the file is complete
+    assert not os.path.exists(final_path)
+    received.write(b'1234', offset=0)
+
+    assert received.commit()
+    with open(final_path, 'rb') as f:
+        assert f.read() == b'12345678'
+    assert not os.path.exists(received.partial_path)
+
+def test_receive_file_hashes_chunks_received_out_of_order(data_directory):
+    final_path = os.path.join(data_directory, 'scan1', 'dev1', 'a.bin')
+    received = FileManager.ReceiveFile(final_path, 8)
+    received.write(b'5678', offset=4)
+    received.write(b'1234', offset=0)
+
+    assert received.commit()
+    assert received.sha256 == hashlib.sha256(b'12345678').hexdigest()
+    assert os.path.samefile(final_path, FileManager.content_store.object_path(received.sha256))
+
+def test_receive_file_discards_incomplete_file(data_directory):
+    final_path = os.path.join(data_directory, 'scan1', 'dev1', 'a.bin')
+    received = FileManager.ReceiveFile(final_path, 8)
+    received.write(b'1234')
+
+    assert not received.commit()
+    assert not os.path.exists(final_path)
+    assert not os.path.exists(received.partial_path)
+
+    oversized = FileManager.ReceiveFile(final_path, 2)
+    with pytest.raises(ValueError):
+        oversized.write(b'too long')
+    oversized.discard()
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import pytest
+import requests
+import DBManager
+import LinkBLE
+import S3Manager
+from AdapterManager import AdapterPool, FakeAdapterBackend
+from EventLog import event_log
+from LinkBLE import BLEFileTransferClient, pack_filenames, CONTROL_BATCH, CHARACTERISTIC_UUID_FILENAME, CHARACTERISTIC_UUID_FILETRANSFER
+from config import MAX_ATTRIBUTE_SIZE
+from S3Manager import ScanPlan
+
+PAYLOAD = 20  # Notification payload at the default MTU of 23
+
+def chunks(data, size=PAYLOAD):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+@pytest.fixture
+def client(data_directory):
+    scan = os.path.join(data_directory, '20240101120000')
+    client = BLEFileTransferClient('AA:BB:CC:DD:EE:FF', scan, ScanPlan('20240101120000', dt_rule='hours'))
+    client.device_id = 'dev1'
+    return client
+
+def receive(client, notifications):
+    for data in notifications:
+        client.handle_batch_data(data)
+
+def read(client, filename):
+    with open(os.path.join(client.base_directory, client.device_id, filename), 'rb') as f:
+        return f.read()
+
+def test_batch_header_split_across_notifications(client):
+    filename = 'logger_2024-01-01_long_name.csv'
+    content = b'time,value\n' * 5
+    client.batch_pending = {filename: len(content)}
+
+    receive(client, chunks(f'HDR:{filename}|{len(content)}\n'.encode() + content) + [b'EOF'])
+
+    assert read(client, filename) == content
+    assert client.batch_pending == {}
+    assert [transfer['succeeded'] for transfer in client.transfers] == [True]
+
+def test_batch_files_back_to_back(client):
+    files = {'a.csv': b'EOF', 'b.csv': b'0123456789' * 3}
+    client.batch_pending = {filename: len(content) for filename, content in files.items()}
+
+    for filename, content in files.items():
+        receive(client, [f'HDR:{filename}|{len(content)}\n'.encode() + content[:5]] + chunks(content[5:]) + [b'EOF'])
+
+    assert {filename: read(client, filename) for filename in files} == files
+    assert client.eof_received and not client.transfer_failed
+    # The hashes computed while streaming are kept for the uploader
+    assert [(os.path.basename(path), size, sha256) for path, size, sha256 in client.received_files] == [
+        (filename, len(content), hashlib.sha256(content).hexdigest()) for filename, content in files.items()]
+
+def test_batch_discards_late_bytes_until_next_header(client):
+    client.batch_pending = {'b.csv': 4}
+
+    # The tail of a file from a window that timed out arrives before this window's first header
+    receive(client, [b'late data from the last window', b'EOF', b'HDR:b.csv|4\n', b'abcd', b'EOF'])
+
+    assert read(client, 'b.csv') == b'abcd'
+    assert client.batch_discarded == len(b'late data from the last window')
+
+def test_batch_skips_unrequested_and_unreadable_files(client):
+    client.batch_pending = {'a.csv': 3, 'b.csv': 2}
+
+    receive(client, [b'HDR:other.csv|3\n', b'xyz', b'EOF', b'HDR:a.csv|-1\n', b'EOF', b'HDR:b.csv|2\nok', b'EOF'])
+
+    assert read(client, 'b.csv') == b'ok'
+    assert not os.path.exists(os.path.join(client.base_directory, 'dev1', 'a.csv'))
+    assert client.transfer_failed
+    assert [(transfer['filename'], transfer['succeeded']) for transfer in client.transfers] == [('a.csv', False), ('b.csv', True)]
+
+class WritesClient:
+    def __init__(self):
+        self.writes = []
+
+    async def write_gatt_char(self, characteristic, data):
+        self.writes.append(data)
+
+def test_acknowledgements_only_follow_full_listings(client, database):
+    S3Manager.record_in_inventory('dev1/2024010112/a.csv', 3, 'a')
+    client.ack_action = 'delete'
+    client.file_list = [('a.csv', 3), ('b.csv', 4)]
+    ble = WritesClient()
+
+    # An incremental listing only names files changed since the cursor
+    client.full_listing = False
+    asyncio.run(client.acknowledge_uploads(ble))
+    assert ble.writes == []
+    assert S3Manager.acknowledgeable_files('dev1', [('a.csv', 3)]) == []
+
+    DBManager.record_upload_confirmation('dev1', 'a.csv', 3, 'a', 'dev1/2024010112/a.csv')
+    client.full_listing = True
+    asyncio.run(client.acknowledge_uploads(ble))
+    assert ble.writes == [b'DONE:a.csv']
+    assert client.file_list == [('b.csv', 4)]
+
+class FakePeripheral:
+    """Lists entries when the filename characteristic is subscribed and streams requested files back."""
+
+    def __init__(self, listing, files=None):
+        self.listing = listing
+        self.files = files or {}
+        self.is_connected = True
+        self.handlers = {}
+        self.writes = []
+
+    async def start_notify(self, characteristic, callback):
+        self.handlers[characteristic] = callback
+        if characteristic == CHARACTERISTIC_UUID_FILENAME:
+            for entry in self.listing:
+                await callback(characteristic, entry.encode())
+                await callback(characteristic, b'EON')
+            await callback(characteristic, b'EOF')
+
+    async def stop_notify(self, characteristic):
+        self.handlers.pop(characteristic, None)
+
+    async def write_gatt_char(self, characteristic, data):
+        self.writes.append(bytes(data))
+        filename = bytes(data).decode()
+        if filename in self.files:
+            transfer = self.handlers[CHARACTERISTIC_UUID_FILETRANSFER]
+            await transfer(CHARACTERISTIC_UUID_FILETRANSFER, self.files[filename])
+            await transfer(CHARACTERISTIC_UUID_FILETRANSFER, b'EOF')
+
+    async def disconnect(self):
+        self.is_connected = False
+
+@pytest.fixture
+def sync(client, database, settings, monkeypatch):
+    """Runs one connection's listing and transfers against a FakePeripheral, with the Hublink API unreachable."""
+    monkeypatch.setattr(requests, 'post', api_unreachable)
+
+    def run(peripheral):
+        connection = BLEFileTransferClient(client.address, client.base_directory, client.plan)
+        asyncio.run(connection.notification_manager(peripheral))
+        return connection
+    return run
+
+def api_unreachable(*args, **kwargs):
+    raise requests.exceptions.ConnectionError('Hublink API unreachable')
+
+def test_cursor_is_stored_after_every_listed_file_is_received(sync):
+    sync(FakePeripheral(['CURSOR:7', 'a.csv|3'], {'a.csv': b'abc'}))
+
+    state = DBManager.get_sync_cursor('AA:BB:CC:DD:EE:FF')
+    assert state['cursor'] == '7' and state['full_listing_at'] is not None
+
+    # The next connection only asks for what changed since
+    peripheral = FakePeripheral(['CURSOR:8'])
+    connection = sync(peripheral)
+    assert not connection.full_listing
+    assert peripheral.writes == [b'SINCE:7']
+    assert DBManager.get_sync_cursor('AA:BB:CC:DD:EE:FF')['cursor'] == '8'
+
+def test_cursor_is_not_stored_when_a_transfer_fails(sync):
+    connection = sync(FakePeripheral(['CURSOR:7', 'a.csv|3'], {'a.csv': b'ab'}))
+
+    assert connection.transfer_failed
+    assert DBManager.get_sync_cursor('AA:BB:CC:DD:EE:FF')['cursor'] is None
+
+def test_cursor_is_not_stored_when_files_are_deferred(sync, monkeypatch):
+    monkeypatch.setattr(LinkBLE.space_reservations, 'reserve', lambda size: False)
+    monkeypatch.setattr(LinkBLE, 'reclaim_space', lambda size, keep: (0, 0))
+
+    connection = sync(FakePeripheral(['CURSOR:7', 'a.csv|3'], {'a.csv': b'abc'}))
+
+    assert connection.transfer_deferred
+    assert DBManager.get_sync_cursor('AA:BB:CC:DD:EE:FF')['cursor'] is None
+
+def test_incremental_listing_records_changed_files(sync, database):
+    DBManager.store_sync_cursor('AA:BB:CC:DD:EE:FF', '7', 'dev1', full_listing=True)
+
+    sync(FakePeripheral(['CURSOR:8', 'ACK:delete', 'a.csv|3'], {'a.csv': b'abc'}))
+
+    conn = sqlite3.connect(database)
+    assert conn.execute('SELECT device_id, filename FROM changed_files').fetchall() == [('dev1', 'a.csv')]
+    conn.close()
+
+def test_failed_upload_without_a_queue_is_logged(database, settings, data_directory, monkeypatch):
+    monkeypatch.setattr(LinkBLE, 'DATA_DIRECTORY', data_directory)
+    pool = AdapterPool(['hci0'], FakeAdapterBackend({'hci0': {'AA': ('ESP32_BLE_SD', -50)}}))
+
+    async def transfer_device(adapter_pool, adapter, mac_address, base_directory, plan):
+        return True
+    def upload_files(base_directory):
+        raise RuntimeError("1 uploads failed verification")
+    monkeypatch.setattr(LinkBLE, 'transfer_device', transfer_device)
+    monkeypatch.setattr(LinkBLE, 'process_scan', lambda base_directory: None)
+    monkeypatch.setattr(LinkBLE, 'upload_files', upload_files)
+
+    # As in a one-shot cycle, the scan is uploaded before returning
+    asyncio.run(LinkBLE.searchForLinks(pool))
+
+    assert "1 uploads failed verification" in event_log.recent(kind='s3.upload', n=1)[0]['message']
+
+def test_pack_filenames_respects_max_files():
+    files = [(f'{i}.csv', i) for i in range(5)]
+
+    assert list(pack_filenames(CONTROL_BATCH, files, 2)) == [files[0:2], files[2:4], files[4:]]
+
+def test_pack_filenames_fits_each_message_in_one_write():
+    files = [(f'{i:03d}_' + 'x' * 96 + '.csv', i) for i in range(20)]
+
+    windows = list(pack_filenames(CONTROL_BATCH, files))
+
+    assert [file for window in windows for file in window] == files
+    for window in windows:
+        message = f"{CONTROL_BATCH}:{'|'.join(filename for filename, _ in window)}".encode()
+        assert len(message) <= MAX_ATTRIBUTE_SIZE
+    assert len(windows) == 5
+
+def test_pack_filenames_never_drops_a_long_name():
+    files = [('y' * 600 + '.csv', 1)]
+
+    assert list(pack_filenames(CONTROL_BATCH, files, 4)) == [files]
+    assert list(pack_filenames(CONTROL_BATCH, [])) == []
@@ -0,0 +1,90 @@
+import asyncio
+import sqlite3
+import DBManager
+import RuntimeManager
+from RuntimeManager import DurableUploadQueue, UploadQueue
+
+def job_states(database):
+    conn = sqlite3.connect(database)
+    states = conn.execute('SELECT scan_directory, state, attempts FROM upload_jobs ORDER BY id').fetchall()
+    conn.close()
+    return states
+
+def test_durable_queue_hands_out_scans_in_order(database):
+    queue = DurableUploadQueue(poll_interval=0)
+    asyncio.run(queue.put('/data/scan1'))
+    asyncio.run(queue.put('/data/scan2'))
+
+    assert asyncio.run(queue.get()) == '/data/scan1'
+    asyncio.run(queue.task_finished())
+
+    assert queue.qsize() == 1
+    assert job_states(database) == [('/data/scan1', 'done', 0), ('/data/scan2', 'pending', 0)]
+
+def test_claimed_scan_is_not_claimed_twice(database):
+    DBManager.enqueue_upload('/data/scan1')
+
+    assert DBManager.claim_upload() is not None
+    assert DBManager.claim_upload() is None
+
+def test_failed_upload_is_retried_after_backoff(database):
+    queue = DurableUploadQueue(poll_interval=0)
+    asyncio.run(queue.put('/data/scan1'))
+    asyncio.run(queue.get())
+
+    asyncio.run(queue.task_failed(RuntimeError('upload failed')))
+
+    assert job_states(database) == [('/data/scan1', 'pending', 1)]
+    # Not available again until the backoff has passed
+    assert DBManager.claim_upload() is None
+
+def test_upload_fails_for_good_after_max_attempts(database, monkeypatch):
+    monkeypatch.setattr(DBManager, 'UPLOAD_QUEUE_MAX_ATTEMPTS', 2)
+    DBManager.enqueue_upload('/data/scan1')
+    for _ in range(2):
+        conn = sqlite3.connect(database)
+        conn.execute('UPDATE upload_jobs SET available_at = 0')
+        conn.commit()
+        conn.close()
+        job_id, _ = DBManager.claim_upload()
+        DBManager.fail_upload(job_id, 'upload failed')
+
+    assert job_states(database) == [('/data/scan1', 'failed', 2)]
+
+def test_interrupted_uploads_are_requeued(database):
+    DBManager.enqueue_upload('/data/scan1')
+    DBManager.claim_upload()
+
+    assert DBManager.requeue_claimed_uploads() == 1
+    assert DBManager.claim_upload()[1] == '/data/scan1'
+
+def test_requeueing_a_scan_resets_its_attempts(database):
+    DBManager.enqueue_upload('/data/scan1')
+    job_id, _ = DBManager.claim_upload()
+    DBManager.fail_upload(job_id, 'upload failed')
+
+    DBManager.enqueue_upload('/data/scan1')
+
+    assert job_states(database) == [('/data/scan1', 'pending', 0)]
+
+def test_in_process_queue_retries_failed_uploads_with_backoff(monkeypatch):
+    monkeypatch.setattr(RuntimeManager, 'UPLOAD_QUEUE_MAX_ATTEMPTS', 3)
+    delays = []
+    monkeypatch.setattr(RuntimeManager, 'upload_retry_delay', lambda attempts: delays.append(attempts) or 0)
+
+    async def fail_every_attempt():
+        queue = UploadQueue()
+        await queue.put('/data/scan1')
+        handed_out = []
+        for _ in range(3):
+            handed_out.append(await asyncio.wait_for(queue.get(), 1))
+            await queue.task_failed(RuntimeError('upload failed'))
+        await asyncio.sleep(0.01)
+        return queue, handed_out
+
+    queue, handed_out = asyncio.run(fail_every_attempt())
+
+    assert handed_out == ['/data/scan1'] * 3
+    assert delays == [1, 2]
+    # Dropped after the last attempt
+    assert queue.qsize() == 0 and queue.attempts == {}
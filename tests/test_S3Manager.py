@@ -0,0 +1,356 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import pytest
+import requests
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+import APIManager
+import DBManager
+import S3Manager
+
+class FakeS3Client:
+    """Keeps uploaded objects in memory, failing the first uploads with the errors S3Transfer would raise."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.uploads = []
+        self.objects = {}
+
+    def upload_file(self, file_path, bucket, key, **kwargs):
+        if self.errors:
+            code = self.errors.pop(0)
+            try:
+                raise ClientError({'Error': {'Code': code, 'Message': code}}, 'PutObject')
+            except ClientError as e:
+                raise S3UploadFailedError(f"Failed to upload {file_path} to {bucket}/{key}: {e}")
+        self.uploads.append((file_path, bucket, key))
+        with open(file_path, 'rb') as f:
+            self.objects[key] = f.read()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        body = self.objects[Key]
+        return {'ContentLength': len(body), 'ChecksumSHA256': base64.b64encode(hashlib.sha256(body).digest()).decode()}
+
+@pytest.fixture
+def s3(monkeypatch, settings):
+    refreshes = []
+    monkeypatch.setattr(S3Manager, 'fetch_and_store_settings', lambda force=False: refreshes.append(force))
+
+    def use(client):
+        monkeypatch.setattr(S3Manager, 'get_s3_client', lambda: client)
+        return refreshes
+    return use
+
+def test_upload_file_refreshes_stale_keys_and_retries(s3, tmp_path):
+    client = FakeS3Client(['InvalidAccessKeyId'])
+    refreshes = s3(client)
+    (tmp_path / 'a.csv').write_bytes(b'1,2\n')
+
+    S3Manager.upload_file(str(tmp_path / 'a.csv'), 'device/a.csv')
+
+    assert refreshes == [True]
+    assert client.uploads == [(str(tmp_path / 'a.csv'), 'bucket', 'device/a.csv')]
+
+def test_upload_file_raises_other_errors_without_refreshing(s3, tmp_path):
+    client = FakeS3Client(['AccessDenied'])
+    refreshes = s3(client)
+
+    with pytest.raises(S3UploadFailedError):
+        S3Manager.upload_file(str(tmp_path / 'a.csv'), 'device/a.csv')
+    assert refreshes == []
+    assert client.uploads == []
+
+def test_credential_error_code_reads_the_wrapped_message():
+    error = S3UploadFailedError("Failed to upload a.csv to bucket/a.csv: An error occurred (ExpiredToken) when calling the PutObject operation")
+
+    assert S3Manager.credential_error_code(error) == 'ExpiredToken'
+    assert S3Manager.credential_error_code(S3UploadFailedError("Failed to upload: (NoSuchBucket)")) is None
+
+class FakeListing:
+    """list_objects_v2 paginator serving fixed pages, checking between pages that the database can be written."""
+
+    def __init__(self, database, pages):
+        self.database = database
+        self.pages = pages
+        self.requests = []
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **kwargs):
+        self.requests.append(kwargs)
+        for page in self.pages:
+            conn = sqlite3.connect(self.database, timeout=0)
+            conn.execute("INSERT INTO connection_attempts (mac_address, started_at, succeeded) VALUES ('AA:BB', 0, 1)")
+            conn.commit()
+            conn.close()
+            yield {'Contents': [{'Key': key, 'Size': size} for key, size in page]}
+
+def test_sync_s3_prefix_commits_each_page(database, settings, monkeypatch):
+    monkeypatch.setattr(S3Manager, 'get_device_ids', lambda: ['dev1'])
+    listing = FakeListing(database, [[('dev1/2024/a.csv', 10)], [('dev1/2024/b.csv', 20)], []])
+    monkeypatch.setattr(S3Manager, 'get_s3_client', lambda: listing)
+
+    S3Manager.sync_s3_inventory()
+
+    assert S3Manager.files_in_inventory('dev1', [('a.csv', 10), ('b.csv', 21), ('c.csv', 5)]) == {0}
+    assert listing.requests == [{'Bucket': 'bucket', 'Prefix': 'dev1/'}]
+
+    S3Manager.sync_s3_inventory()
+
+    assert listing.requests[-1] == {'Bucket': 'bucket', 'Prefix': 'dev1/', 'StartAfter': 'dev1/2024/b.csv'}
+
+def test_upload_scheduler_throttles_only_while_ble_transfers_run():
+    scheduler = S3Manager.UploadScheduler(rate_limit=0, coexistence='throttle', coexistence_rate=1000)
+    assert scheduler.current_rate() == 0
+
+    scheduler.ble_transfer_started()
+    assert scheduler.current_rate() == 1000
+    scheduler.ble_transfer_finished()
+
+    assert scheduler.current_rate() == 0
+
+def test_upload_scheduler_reports_upload_state():
+    scheduler = S3Manager.UploadScheduler(coexistence='throttle')
+    assert scheduler.upload_state() == 'idle'
+
+    scheduler.upload_started()
+    assert scheduler.upload_state() == 'throttled'
+    scheduler.coexistence = 'off'
+    assert scheduler.upload_state() == 'unthrottled'
+    scheduler.upload_finished()
+
+    assert scheduler.upload_state() == 'idle'
+
+def test_upload_scheduler_consume_paces_to_rate_after_one_second_burst(monkeypatch):
+    clock = [100.0]
+    sleeps = []
+    monkeypatch.setattr(S3Manager.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(S3Manager.time, 'sleep', sleeps.append)
+    scheduler = S3Manager.UploadScheduler(rate_limit=1000, coexistence='off')
+
+    scheduler.consume(1000)
+    scheduler.consume(500)
+
+    assert sleeps == [0.5]
+    assert scheduler.get_metrics()['bytes_uploaded'] == 1500
+    assert scheduler.get_metrics()['throttled_seconds'] == 0.5
+
+def test_upload_scheduler_shares_radio_state_across_processes():
+    import multiprocessing
+
+    shared = multiprocessing.Value('i', 0)
+    collector = S3Manager.UploadScheduler(coexistence='throttle', coexistence_rate=1000)
+    uploader = S3Manager.UploadScheduler(coexistence='throttle', coexistence_rate=1000)
+    collector.share_radio_state(shared)
+    uploader.share_radio_state(shared)
+
+    collector.ble_transfer_started()
+
+    assert uploader.radio_transfers() == 1
+    assert uploader.current_rate() == 1000
+    collector.ble_transfer_finished()
+    assert uploader.radio_transfers() == 0
+
+def test_upload_scheduler_tags_transfers_with_uploads_in_another_process():
+    import multiprocessing
+
+    ble_transfers, uploads = multiprocessing.Value('i', 0), multiprocessing.Value('i', 0)
+    collector = S3Manager.UploadScheduler(coexistence='throttle')
+    uploader = S3Manager.UploadScheduler(coexistence='throttle')
+    collector.share_radio_state(ble_transfers, uploads)
+    uploader.share_radio_state(ble_transfers, uploads)
+
+    uploader.upload_started()
+
+    assert collector.upload_state() == 'throttled'
+    assert collector.get_metrics()['uploads'] == 1
+    uploader.upload_finished()
+    assert collector.upload_state() == 'idle'
+
+def api_unreachable(*args, **kwargs):
+    raise requests.exceptions.ConnectionError('Hublink API unreachable')
+
+def write_scan(tmp_path, files, scan_id='20240101120000', id='dev1'):
+    id_path = tmp_path / scan_id / id
+    id_path.mkdir(parents=True)
+    for filename, content in files.items():
+        (id_path / filename).write_bytes(content)
+    return str(tmp_path / scan_id)
+
+def test_upload_files_uploads_replacement_instead_of_csv(database, s3, tmp_path, monkeypatch):
+    client = FakeS3Client()
+    s3(client)
+    summary = {'source': 'a.csv', 'output': 'a.npz', 'replaced': True}
+    scan = write_scan(tmp_path, {'a.csv': b'x,y\n1,2\n', 'a.npz': b'columns', 'a.summary.json': json.dumps(summary).encode()})
+
+    S3Manager.upload_files(scan)
+
+    assert sorted(client.objects) == ['dev1/2024010112/a.npz', 'dev1/2024010112/a.summary.json',
+                                      'dev1/manifests/20240101120000.json', 'dev1/manifests/latest.json']
+    assert not os.path.exists(os.path.join(scan, 'dev1', 'a.csv'))
+    manifest = json.loads(client.objects['dev1/manifests/20240101120000.json'])
+    assert [entry['replaced_by'] for entry in manifest['replaced']] == ['dev1/2024010112/a.npz']
+    assert DBManager.get_replaced_files('dev1') == {('a.csv', 8)}
+
+    # The CSV stays on the peripheral, but isn't requested again
+    monkeypatch.setattr(requests, 'post', api_unreachable)
+    assert APIManager.filter_needed_files('dev1', [('a.csv', 8), ('c.csv', 3)], 100) == [('c.csv', 3)]
+
+def test_scan_plan_buckets_keys_by_scan_time(settings):
+    plan = S3Manager.ScanPlan.for_directory('/data/20240102030405/')
+
+    assert plan.scan_id == '20240102030405'
+    assert S3Manager.ScanPlan('x', plan.scan_time, 'days').key('dev1', 'a.csv') == 'dev1/20240102/a.csv'
+    assert S3Manager.ScanPlan('x', plan.scan_time, 'never').keys('dev1', ['a.csv', 'b.csv']) == ['dev1/a.csv', 'dev1/b.csv']
+    assert plan.manifest_key('dev1') == 'dev1/manifests/20240102030405.json'
+    assert plan.latest_manifest_key('dev1') == 'dev1/manifests/latest.json'
+
+def test_scan_plan_keys_are_fixed_when_planned(settings):
+    plan = S3Manager.ScanPlan.for_directory('/data/20240102030405')
+    settings['dt_rule'] = 'years'
+
+    # The bucket was fixed from the hourly rule when the plan was made
+    assert plan.key('dev1', 'a.csv') == 'dev1/2024010203/a.csv'
+
+def test_saved_scan_plan_survives_a_dt_rule_change(database, s3, tmp_path, settings):
+    scan = write_scan(tmp_path, {'a.csv': b'abc'})
+    S3Manager.ScanPlan.for_directory(scan).save(scan)
+    settings['dt_rule'] = 'years'
+
+    plan = S3Manager.ScanPlan.for_directory(scan)
+    assert (plan.dt_rule, plan.key('dev1', 'a.csv')) == ('hours', 'dev1/2024010112/a.csv')
+
+    # A retried or queued upload uses the keys the listing was checked against
+    client = FakeS3Client()
+    s3(client)
+    S3Manager.upload_files(scan)
+    assert [key for _, _, key in client.uploads] == ['dev1/2024010112/a.csv']
+
+def test_scan_plan_for_unnamed_directory_uses_current_time(settings):
+    plan = S3Manager.ScanPlan.for_directory('/data/adhoc')
+
+    assert plan.scan_id == 'adhoc'
+    assert plan.datetime_str == S3Manager.format_datetime(plan.scan_time)
+
+def test_format_datetime_rejects_unknown_rule():
+    with pytest.raises(ValueError):
+        S3Manager.format_datetime(dt_rule='fortnights')
+
+def test_upload_files_uses_hash_recorded_while_receiving(database, s3, tmp_path, monkeypatch):
+    client = FakeS3Client()
+    s3(client)
+    scan = write_scan(tmp_path, {'a.bin': b'streamed', 'b.bin': b'rewritten'})
+    sha256 = hashlib.sha256(b'streamed').hexdigest()
+    DBManager.record_received_files([(os.path.join(scan, 'dev1', 'a.bin'), 8, sha256),
+                                     (os.path.join(scan, 'dev1', 'b.bin'), 4, 'stale')])
+    hashed = []
+    file_sha256 = S3Manager.file_sha256
+    monkeypatch.setattr(S3Manager, 'file_sha256', lambda path: hashed.append(os.path.basename(path)) or file_sha256(path))
+
+    S3Manager.upload_files(scan)
+
+    # Only the file whose size no longer matches what was received is hashed again
+    assert hashed == ['b.bin']
+    manifest = json.loads(client.objects['dev1/manifests/20240101120000.json'])
+    assert {entry['filename']: entry['sha256'] for entry in manifest['files']} == {
+        'a.bin': sha256, 'b.bin': hashlib.sha256(b'rewritten').hexdigest()}
+
+def test_upload_files_raises_when_verification_fails_so_the_scan_is_retried(database, s3, tmp_path):
+    class CorruptingS3Client(FakeS3Client):
+        def upload_file(self, file_path, bucket, key, **kwargs):
+            super().upload_file(file_path, bucket, key, **kwargs)
+            if key.endswith('b.bin'):
+                self.objects[key] = b'corrupt'
+
+    scan = write_scan(tmp_path, {'a.bin': b'good', 'b.bin': b'mangled'})
+    s3(CorruptingS3Client())
+
+    with pytest.raises(RuntimeError, match='dev1/2024010112/b.bin'):
+        S3Manager.upload_files(scan)
+    assert S3Manager.acknowledgeable_files('dev1', [('a.bin', 4), ('b.bin', 7)]) == [('a.bin', 4)]
+
+    # The retry skips the verified file and uploads the other again
+    client = FakeS3Client()
+    s3(client)
+    S3Manager.upload_files(scan)
+    assert [key for _, _, key in client.uploads] == ['dev1/2024010112/b.bin']
+    assert S3Manager.acknowledgeable_files('dev1', [('a.bin', 4), ('b.bin', 7)]) == [('a.bin', 4), ('b.bin', 7)]
+
+def test_acknowledgeable_files_need_a_verified_object_in_the_inventory(database):
+    S3Manager.record_in_inventory('dev1/2024010112/other_gateway.csv', 5)
+    S3Manager.record_in_inventory('dev1/2024010112/a.npz', 3, 'npz')
+    S3Manager.record_in_inventory('dev1/2024010112/rewritten.csv', 5, 'new')
+    S3Manager.record_in_inventory('dev1/2024010112/unhashed.csv', 5)
+    DBManager.record_upload_confirmation('dev1', 'a.csv', 8, 'csv', 'dev1/2024010112/a.npz', 'npz')
+    DBManager.record_upload_confirmation('dev1', 'rewritten.csv', 5, 'old', 'dev1/2024010112/rewritten.csv')
+    DBManager.record_upload_confirmation('dev1', 'deleted.csv', 5, 'gone', 'dev1/2024010112/deleted.csv')
+    DBManager.record_upload_confirmation('dev1', 'unhashed.csv', 5, 'unhashed', 'dev1/2024010112/unhashed.csv')
+    listing = [('other_gateway.csv', 5), ('a.csv', 8), ('rewritten.csv', 5), ('deleted.csv', 5), ('unhashed.csv', 5)]
+
+    # Only the columnar copy this gateway verified; a name and size match alone isn't trusted
+    assert S3Manager.acknowledgeable_files('dev1', listing) == [('a.csv', 8)]
+
+def test_inventory_sync_forgets_the_hash_of_an_overwritten_object(database, settings, monkeypatch):
+    S3Manager.record_in_inventory('dev1/2024010112/a.csv', 3, 'a')
+    DBManager.record_upload_confirmation('dev1', 'a.csv', 3, 'a', 'dev1/2024010112/a.csv')
+    # Another writer replaced the object since it was verified
+    monkeypatch.setattr(S3Manager, 'get_s3_client', lambda: FakeListing(database, [[('dev1/2024010112/a.csv', 6)]]))
+
+    S3Manager.sync_s3_inventory(['dev1'])
+
+    assert S3Manager.acknowledgeable_files('dev1', [('a.csv', 3)]) == []
+
+def test_acknowledgeable_files_hold_files_changed_since_their_upload(database, monkeypatch):
+    clock = [1000]
+    monkeypatch.setattr(DBManager.time, 'time', lambda: clock[0])
+    S3Manager.record_in_inventory('dev1/2024010112/a.csv', 5, 'a')
+    S3Manager.record_in_inventory('dev1/2024010112/b.csv', 5, 'b')
+    DBManager.record_changed_files('dev1', ['a.csv', 'b.csv'])
+    clock[0] = 1010
+    # a.csv was received and uploaded after the listing that showed it; b.csv was skipped by name and size
+    DBManager.record_upload_confirmation('dev1', 'a.csv', 5, 'a', 'dev1/2024010112/a.csv')
+
+    assert S3Manager.acknowledgeable_files('dev1', [('a.csv', 5), ('b.csv', 5)]) == [('a.csv', 5)]
+
+    clock[0] = 1020
+    DBManager.record_changed_files('dev1', ['a.csv'])
+    assert S3Manager.acknowledgeable_files('dev1', [('a.csv', 5), ('b.csv', 5)]) == []
+
+def test_manifests_link_to_the_previous_one_and_latest_only_moves_forward(database, s3, tmp_path):
+    client = FakeS3Client()
+    s3(client)
+    scans = {scan_id: write_scan(tmp_path, {f'{scan_id}.csv': b'abc'}, scan_id=scan_id)
+             for scan_id in ('20240101120000', '20240101130000', '20240101140000')}
+
+    S3Manager.upload_files(scans['20240101120000'])
+    S3Manager.upload_files(scans['20240101140000'])
+    # An older scan's upload finishing late, e.g. a queue retry
+    S3Manager.upload_files(scans['20240101130000'])
+
+    def manifest(scan_id):
+        return json.loads(client.objects[f'dev1/manifests/{scan_id}.json'])
+    # The late scan is linked into the chain in scan order
+    assert manifest('20240101140000')['previous'] == 'dev1/manifests/20240101130000.json'
+    assert manifest('20240101130000')['previous'] == 'dev1/manifests/20240101120000.json'
+    assert manifest('20240101120000')['previous'] is None
+    assert json.loads(client.objects['dev1/manifests/latest.json'])['scan_id'] == '20240101140000'
+
+    # Uploading a scan again keeps its place in the chain
+    S3Manager.upload_files(scans['20240101140000'])
+    S3Manager.upload_files(scans['20240101130000'])
+    assert manifest('20240101140000')['previous'] == 'dev1/manifests/20240101130000.json'
+    assert manifest('20240101130000')['previous'] == 'dev1/manifests/20240101120000.json'
+    assert json.loads(client.objects['dev1/manifests/latest.json'])['scan_id'] == '20240101140000'
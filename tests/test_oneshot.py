@@ -0,0 +1,37 @@
+import asyncio
+import json
+import pytest
+import DBManager
+import LinkBLE
+import oneshot
+
+@pytest.fixture
+def cycle(monkeypatch):
+    """Records the order in which a one-shot cycle fetches settings and scans."""
+    calls = []
+    monkeypatch.setattr(DBManager, 'fetch_and_store_settings', lambda: calls.append('fetch'))
+
+    async def search():
+        calls.append('scan')
+    monkeypatch.setattr(LinkBLE, 'searchForLinks', search)
+    return calls
+
+def test_stored_settings_scan_while_fresh_settings_are_fetched(cycle, settings):
+    asyncio.run(oneshot.run())
+
+    # The refresh runs in a worker thread and is awaited before exiting
+    assert sorted(cycle) == ['fetch', 'scan']
+
+def test_first_run_fetches_settings_before_scanning(cycle, monkeypatch):
+    monkeypatch.setattr(DBManager, 'settings_cache', {})
+
+    asyncio.run(oneshot.run())
+
+    assert cycle == ['fetch', 'scan']
+
+def test_benchmark_reports_timings_without_scanning(cycle, settings, capsys):
+    asyncio.run(oneshot.run(benchmark=True))
+
+    assert cycle == []
+    timings = json.loads(capsys.readouterr().out)
+    assert 0 <= timings['imports_ms'] <= timings['time_to_scan_ms']